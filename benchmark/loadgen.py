@@ -0,0 +1,286 @@
+#!/usr/bin/python
+"""
+Load Generator: Run many client processes against a local job server, to find how many clients one server sustains
+
+Starts a job server (utility/jobserver.py) in this process, and --clients runman client processes against it, each
+running --concurrency jobs at once.  Once every client has asked for work, --jobs synthetic jobs are queued: all at
+once, or at --rate jobs per second.  When every job is reported (or --timeout passes) the clients are stopped and we
+report:
+  jobs_per_second   Jobs reported per second, from the first job queued to the last reported
+  pickup_latency    Seconds from a job being queued to a client being handed it
+  report_latency    Seconds from a client being handed a job to its report arriving (running it, and reporting)
+  requests          Requests the server handled, failures it injected, and connections clients opened
+
+The server can be made slow (--latency) and unreliable (--failure-rate), to see how clients hold up.
+
+Without --run-spec, clients run a fixture of quick jobs (see startup.py).  With it, --input is the input data for
+every job.  Client logs are kept in the work directory with --keep.
+
+usage: python benchmark/loadgen.py [--clients <count>] [--concurrency <count>] [--jobs <count>] [--rate <jobs/sec>]
+                                   [--latency <seconds>] [--failure-rate <fraction>] [--timeout <seconds>]
+                                   [--run-spec <path> --input <json>] [--reports <path>] [--keep] [--json]
+"""
+
+
+import os
+import sys
+import json
+import time
+import getopt
+import shutil
+import signal
+import tempfile
+import threading
+import subprocess
+
+import startup
+
+sys.path.insert(0, startup.ROOT)
+
+from utility import specs
+from utility import jobserver
+
+
+# Client processes, and jobs each runs at once
+CLIENTS = 4
+CLIENT_CONCURRENCY = 2
+
+# Jobs to queue
+JOBS = 200
+
+# Job specs in the fixture run spec, and the input data for their jobs
+FIXTURE_JOBS = 10
+FIXTURE_INPUT = {'host':'localhost', 'port':80}
+
+# Seconds to wait for clients to start asking for work, and for all jobs to be reported
+CLIENT_START_TIMEOUT = 60.0
+TIMEOUT = 300.0
+
+# Seconds between checks on the server and clients
+CHECK_INTERVAL = 0.01
+
+# Seconds to wait for the server to finish with stopped clients' connections
+SHUTDOWN_TIMEOUT = 5.0
+
+
+def CreateClientRunSpecs(work_path, run_spec, websource, clients, concurrency):
+  """Returns list of strings, a run spec path for each client.  Each has its own report spool."""
+  websource_path = os.path.join(work_path, 'websource.json')
+  json.dump(websource, open(websource_path, 'w'))
+
+  run_spec_paths = []
+  for count in range(clients):
+    client_run_spec = dict(run_spec)
+    client_run_spec['websource'] = websource_path
+    client_run_spec['client concurrency'] = concurrency
+    client_run_spec['report spool path'] = os.path.join(work_path, 'client%s_spool' % count)
+
+    #NOTE(g): JSON is YAML, and faster for the client to load
+    run_spec_path = os.path.join(work_path, 'client%s.yaml' % count)
+    json.dump(client_run_spec, open(run_spec_path, 'w'))
+    run_spec_paths.append(run_spec_path)
+
+  return run_spec_paths
+
+
+def StartClients(work_path, run_spec_paths):
+  """Returns list of Popen, a runman client process for each run spec.  Logs go to client<N>.log in work_path."""
+  processes = []
+  for (count, run_spec_path) in enumerate(run_spec_paths):
+    log_file = open(os.path.join(work_path, 'client%s.log' % count), 'w')
+    try:
+      processes.append(subprocess.Popen([sys.executable, os.path.join(startup.ROOT, 'runman.py'), '-n', run_spec_path, 'client'],
+                                        stdout=log_file, stderr=subprocess.STDOUT))
+    finally:
+      log_file.close()
+
+  return processes
+
+
+def StopClients(processes):
+  for process in processes:
+    if process.poll() == None:
+      process.send_signal(signal.SIGTERM)
+
+  for process in processes:
+    process.wait()
+
+
+def WaitFor(condition, timeout, processes, description):
+  """Wait until condition() is true.  Raises if timeout passes, or every client has exited."""
+  started = time.time()
+  while not condition():
+    if time.time() - started > timeout:
+      raise Exception('Timed out after %s seconds waiting for %s' % (timeout, description))
+
+    if not [process for process in processes if process.poll() == None]:
+      raise Exception('All clients exited while waiting for %s' % description)
+
+    time.sleep(CHECK_INTERVAL)
+
+
+def QueueJobs(server, jobs, rate=None):
+  """Queue jobs on the server: all at once, or rate per second"""
+  started = time.time()
+  for (count, job_request) in enumerate(jobs):
+    if rate:
+      delay = started + count / rate - time.time()
+      if delay > 0:
+        time.sleep(delay)
+
+    server.AddJob(job_request)
+
+
+def GenerateLoad(run_spec, input_data, clients=CLIENTS, concurrency=CLIENT_CONCURRENCY, jobs_count=JOBS, rate=None,
+                 latency=0.0, failure_rate=0.0, timeout=TIMEOUT, reports_path=None, work_path=None):
+  """Returns dict, results: clients, concurrency, jobs, duration, jobs_per_second, and the server stats
+
+  Args:
+    run_spec: dict, the run spec the clients run.  Its job spec paths must work from our current directory.
+    input_data: dict, input data for every job
+    rate: float (optional), jobs to queue per second.  Default queues them all at once.
+    work_path: string (optional), directory for client run specs, spools and logs.  Default is a temporary directory,
+      removed when we finish.
+  """
+  remove_work_path = work_path == None
+  if work_path == None:
+    work_path = tempfile.mkdtemp(prefix='runman_loadgen_')
+
+  server = jobserver.JobServer(('localhost', 0), None, latency, failure_rate, reports_path)
+  server_thread = threading.Thread(target=server.serve_forever, name='loadgen-jobserver')
+  server_thread.daemon = True
+  server_thread.start()
+
+  processes = []
+  try:
+    jobs = jobserver.MakeSyntheticJobs(run_spec, jobs_count, input_data, prefix='loadgen')
+
+    run_spec_paths = CreateClientRunSpecs(work_path, run_spec, server.GetWebsource(), clients, concurrency)
+    processes = StartClients(work_path, run_spec_paths)
+
+    # Every client asks for work once it is running
+    WaitFor(lambda: server.requests >= clients, CLIENT_START_TIMEOUT, processes, 'clients to start')
+
+    QueueJobs(server, jobs, rate)
+
+    WaitFor(lambda: len(server.reported_times) >= jobs_count, timeout, processes, 'jobs to be reported')
+
+    stats = server.GetStats()
+
+  finally:
+    StopClients(processes)
+
+    # Let the server's connection threads see the clients are gone, before it goes away
+    deadline = time.time() + SHUTDOWN_TIMEOUT
+    while server.open_connections and time.time() < deadline:
+      time.sleep(CHECK_INTERVAL)
+
+    server.shutdown()
+    server.server_close()
+
+    if remove_work_path:
+      shutil.rmtree(work_path)
+
+  duration = max(server.reported_times.values()) - min(server.queued_times.values())
+
+  results = {
+    'clients':clients,
+    'concurrency':concurrency,
+    'jobs':jobs_count,
+    'rate':rate,
+    'latency':latency,
+    'failure_rate':failure_rate,
+    'duration':duration,
+    'jobs_per_second':jobs_count / duration,
+    'stats':stats,
+  }
+
+  return results
+
+
+def FormatLatency(stats):
+  """Returns string, latency stats in milliseconds"""
+  if not stats['count']:
+    return '-'
+
+  percentiles = ['p%s %.1f' % (percentile, stats['p%s' % percentile] * 1000) for percentile in jobserver.STATS_PERCENTILES]
+  return '%s  max %.1f  mean %.1f (ms)' % ('  '.join(percentiles), stats['max'] * 1000, stats['mean'] * 1000)
+
+
+def Main(args):
+  long_options = ['clients=', 'concurrency=', 'jobs=', 'rate=', 'latency=', 'failure-rate=', 'timeout=', 'run-spec=',
+                  'input=', 'reports=', 'keep', 'json']
+  (options, args) = getopt.getopt(args, '', long_options)
+
+  clients = CLIENTS
+  concurrency = CLIENT_CONCURRENCY
+  jobs_count = JOBS
+  rate = None
+  latency = 0.0
+  failure_rate = 0.0
+  timeout = TIMEOUT
+  run_spec_path = None
+  input_data = None
+  reports_path = None
+  keep = False
+  output_json = False
+  for (option, value) in options:
+    if option == '--clients':
+      clients = int(value)
+    elif option == '--concurrency':
+      concurrency = int(value)
+    elif option == '--jobs':
+      jobs_count = int(value)
+    elif option == '--rate':
+      rate = float(value)
+    elif option == '--latency':
+      latency = float(value)
+    elif option == '--failure-rate':
+      failure_rate = float(value)
+    elif option == '--timeout':
+      timeout = float(value)
+    elif option == '--run-spec':
+      run_spec_path = value
+    elif option == '--input':
+      input_data = json.loads(value)
+    elif option == '--reports':
+      reports_path = value
+    elif option == '--keep':
+      keep = True
+    elif option == '--json':
+      output_json = True
+
+  work_path = tempfile.mkdtemp(prefix='runman_loadgen_')
+  try:
+    if run_spec_path:
+      run_spec = specs.LoadRunSpec(run_spec_path)
+    else:
+      run_spec = specs.LoadRunSpec(startup.CreateFixture(work_path, FIXTURE_JOBS))
+      input_data = FIXTURE_INPUT
+
+    results = GenerateLoad(run_spec, input_data or {}, clients, concurrency, jobs_count, rate, latency, failure_rate,
+                           timeout, reports_path, work_path)
+
+  finally:
+    if keep:
+      print 'Work directory kept: %s' % work_path
+    else:
+      shutil.rmtree(work_path)
+
+  if output_json:
+    print json.dumps(results, indent=2, sort_keys=True)
+    return
+
+  stats = results['stats']
+  print 'Clients:         %s (concurrency %s)' % (results['clients'], results['concurrency'])
+  print 'Jobs:            %s (%s)' % (results['jobs'], 'all at once' if not results['rate'] else '%s/sec' % results['rate'])
+  print 'Server:          latency %s s, failure rate %s' % (results['latency'], results['failure_rate'])
+  print 'Duration:        %.2f s' % results['duration']
+  print 'Jobs/sec:        %.1f' % results['jobs_per_second']
+  print 'Pickup latency:  %s' % FormatLatency(stats['pickup_latency'])
+  print 'Report latency:  %s' % FormatLatency(stats['report_latency'])
+  print 'Requests:        %s (%s failed on purpose), connections: %s' % (stats['requests'], stats['failures'], stats['connections'])
+
+
+if __name__ == '__main__':
+  Main(sys.argv[1:])
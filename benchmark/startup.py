@@ -0,0 +1,189 @@
+#!/usr/bin/python
+"""
+Startup Benchmark: Time runman CLI invocations, per command
+
+Each command is run as a new process, as cron and monitoring scripts run it.  For each we report the wall time of the
+whole process, the time to import runman, the time in Main(), and the modules the command loaded, so a change that
+pulls a heavy import into a command shows up here.
+
+Caches (compiled specs, host facts) are warmed by a first run that is not counted, as they would be on a host that
+runs runman regularly.
+
+usage: python benchmark/startup.py [--runs <count>] [--commands info,list,...] [--json]
+"""
+
+
+import os
+import sys
+import json
+import time
+import getopt
+import shutil
+import tempfile
+import subprocess
+
+
+# Repository root, where runman.py is
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs of each command to time, after the warm up run
+RUNS = 20
+
+# Commands we time, and their command args
+COMMANDS = {
+  'info':[],
+  'list':[],
+  'print':[],
+  'validate':['job0', '%(fixture)s/records.jsonl'],
+  'run':['job0'],
+}
+
+# Job specs in the fixture run spec
+FIXTURE_JOBS = 10
+
+# Runs in the child process: times the import and Main(), and writes them with the loaded modules to RESULT_PATH
+CHILD_CODE = '''
+import sys, os, time
+started = time.time()
+sys.path.insert(0, %(root)r)
+args = %(args)r
+sys.argv = ['runman.py'] + args
+import runman
+imported = time.time()
+try:
+  runman.Main(args)
+except SystemExit:
+  pass
+finished = time.time()
+modules = sorted([name for (name, module) in sys.modules.items() if module != None])
+import json
+json.dump({'import':imported - started, 'main':finished - imported, 'modules':modules}, open(%(result_path)r, 'w'))
+'''
+
+
+def CreateFixture(path, jobs_count=FIXTURE_JOBS):
+  """Create a run spec, job specs and input records in path.  Returns string, run spec path."""
+  sys.path.insert(0, ROOT)
+  import utility.platform
+  platform = utility.platform.GetPlatform()
+
+  jobs = {}
+  for count in range(jobs_count):
+    job_spec_path = os.path.join(path, 'job%s.yaml' % count)
+    fp = open(job_spec_path, 'w')
+    fp.write('data: {name: Job %s, component: benchmark}\n' % count)
+    fp.write('input:\n  host: {type: text, min length: 1, regex validate: "^[a-z0-9.-]+$"}\n  port: {type: int, min: 1, max: 65535}\n')
+    fp.write('collect: []\n')
+    fp.write('run:\n  %s:\n    - execute: "true %%(host)s %%(port)s"\n' % platform)
+    fp.write('      tests:\n        - {when: finished, key: exit_code, function: equals, value: 0, critical: true, warning: false}\n')
+    fp.close()
+    jobs['job%s' % count] = job_spec_path
+
+  fp = open(os.path.join(path, 'records.jsonl'), 'w')
+  for count in range(1000):
+    fp.write(json.dumps({'host':'host%s.example.com' % count, 'port':8000 + count}) + '\n')
+  fp.close()
+
+  fp = open(os.path.join(path, 'input.json'), 'w')
+  json.dump({'host':'localhost', 'port':80}, fp)
+  fp.close()
+
+  run_spec_path = os.path.join(path, 'run_spec.yaml')
+  fp = open(run_spec_path, 'w')
+  fp.write('jobs: %s\n' % json.dumps(jobs))
+  fp.write('websource: %s\n' % json.dumps(os.path.join(ROOT, 'defaults', 'websource.yaml')))
+  fp.write('cache path: %s\n' % json.dumps(os.path.join(path, 'cache')))
+  fp.write('facts path: %s\n' % json.dumps(os.path.join(path, 'facts.json')))
+  fp.close()
+
+  return run_spec_path
+
+
+def RunCommand(fixture_path, run_spec_path, command):
+  """Returns dict, timing of one invocation of the command: total, import, main (seconds), modules"""
+  result_path = os.path.join(fixture_path, 'result.json')
+  command_args = [arg % {'fixture':fixture_path} for arg in COMMANDS[command]]
+  args = ['-n', '-f', 'json', '-i', os.path.join(fixture_path, 'input.json'), run_spec_path, command] + command_args
+
+  code = CHILD_CODE % {'root':ROOT, 'args':args, 'result_path':result_path}
+
+  devnull = open(os.devnull, 'w')
+  try:
+    started = time.time()
+    subprocess.call([sys.executable, '-c', code], stdout=devnull, stderr=devnull)
+    total = time.time() - started
+  finally:
+    devnull.close()
+
+  result = json.load(open(result_path))
+  os.remove(result_path)
+  result['total'] = total
+
+  return result
+
+
+def Median(values):
+  values = sorted(values)
+  return values[len(values) / 2]
+
+
+def BenchmarkStartup(commands=None, runs=RUNS):
+  """Returns dict, command: {"total", "total_min", "import", "main" (median seconds), "module_count", "utility_modules"}"""
+  if not commands:
+    commands = sorted(COMMANDS)
+
+  fixture_path = tempfile.mkdtemp(prefix='runman_startup_')
+  try:
+    run_spec_path = CreateFixture(fixture_path)
+
+    results = {}
+    for command in commands:
+      # Warm up: compiles specs and gathers facts into their caches
+      RunCommand(fixture_path, run_spec_path, command)
+
+      timings = [RunCommand(fixture_path, run_spec_path, command) for count in range(runs)]
+
+      results[command] = {
+        'total':Median([timing['total'] for timing in timings]),
+        'total_min':min([timing['total'] for timing in timings]),
+        'import':Median([timing['import'] for timing in timings]),
+        'main':Median([timing['main'] for timing in timings]),
+        'module_count':len(timings[-1]['modules']),
+        'utility_modules':[name for name in timings[-1]['modules'] if name.startswith('utility.')],
+      }
+
+    return results
+
+  finally:
+    shutil.rmtree(fixture_path)
+
+
+def Main(args):
+  (options, args) = getopt.getopt(args, '', ['runs=', 'commands=', 'json'])
+
+  runs = RUNS
+  commands = None
+  output_json = False
+  for (option, value) in options:
+    if option == '--runs':
+      runs = int(value)
+    elif option == '--commands':
+      commands = value.split(',')
+    elif option == '--json':
+      output_json = True
+
+  results = BenchmarkStartup(commands, runs)
+
+  if output_json:
+    print json.dumps(results, indent=2, sort_keys=True)
+    return
+
+  print '%-10s %10s %10s %10s %10s %8s  %s' % ('command', 'total ms', 'min ms', 'import ms', 'main ms', 'modules', 'utility modules')
+  for (command, result) in sorted(results.items()):
+    print '%-10s %10.1f %10.1f %10.1f %10.1f %8s  %s' % (command, result['total'] * 1000, result['total_min'] * 1000,
+                                                       result['import'] * 1000, result['main'] * 1000, result['module_count'],
+                                                       ', '.join([name[len('utility.'):] for name in result['utility_modules']]))
+
+
+if __name__ == '__main__':
+  Main(sys.argv[1:])
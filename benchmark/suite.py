@@ -0,0 +1,491 @@
+#!/usr/bin/python
+"""
+Benchmark Suite: Time RunMan's hot paths, save the results as a baseline, and compare later runs against it
+
+Scenarios:
+  run_shell     RunShell() per call with small output, and per MB of large text and binary output
+  specs         Job spec loading per spec, as list (headers) and print (full specs) do it, with cold and warm caches
+  validate      ValidateInput() per call, with the job plan's compiled validator and without
+  test_result   TestRunResult() per call, with the job plan's compiled tests and without
+  log           log() per line written, and per line skipped (debug, not verbose)
+  startup       CLI startup per command, in new processes (see startup.py)
+  client        ProcessRequestsForever() per job, against a local job server (see utility/jobserver.py)
+
+Every metric is seconds, so lower is better.  Each scenario is run --repeat times, and the median of each metric is
+kept, as the first runs on a busy host are noisy.
+
+Baselines are JSON: {"version", "created", "host" (facts), "python", "repeat", "metrics": {name: seconds}}.  Baselines
+are only meaningful on the host they were saved on.  Comparing flags metrics that are more than --threshold slower
+than the baseline, and exits 1 if any are, so it can gate a change.
+
+usage: python benchmark/suite.py [--scenarios run_shell,specs,...] [--repeat <count>] [--save <baseline.json>]
+                                 [--compare <baseline.json>] [--threshold <fraction>] [--json]
+"""
+
+
+import os
+import sys
+import json
+import time
+import getopt
+import shutil
+import tempfile
+import threading
+
+import startup
+
+sys.path.insert(0, startup.ROOT)
+
+from utility import specs
+from utility import facts
+from utility import platform
+from utility import log
+from utility import plan
+from utility import run
+from utility import client
+from utility import jobserver
+from utility import transport
+
+
+# Baseline file format version
+BASELINE_VERSION = 1
+
+# Times to run each scenario, the median of each metric is kept
+REPEAT = 3
+
+# Fraction slower than the baseline that is a regression
+THRESHOLD = 0.25
+
+# Job specs in the fixture run spec
+FIXTURE_JOBS = 200
+
+# RunShell: calls with small output, and commands for large output: (name, command, bytes)
+RUN_SHELL_CALLS = 50
+RUN_SHELL_OUTPUTS = [
+  ('text', 'yes 0123456789abcdef | head -c %(size)s', 64 * 1024 * 1024),
+  ('binary', 'cat %(fixture)s/binary.bin', 16 * 1024 * 1024),
+]
+MEGABYTE = 1024 * 1024
+
+# Per call scenarios: calls to time
+VALIDATE_CALLS = 20000
+TEST_RESULT_CALLS = 20000
+LOG_CALLS = 50000
+
+# CLI startup runs of each command, per repeat
+STARTUP_RUNS = 5
+
+# Client: jobs to process, workers to run them, seconds the job server holds job_get, and the most seconds to wait
+CLIENT_JOBS = 100
+CLIENT_CONCURRENCY = 4
+CLIENT_LONG_POLL = 0.2
+CLIENT_TIMEOUT = 120.0
+
+
+def CreateFixture(path):
+  """Returns dict, fixture: path, run_spec_path, run_spec, job_spec_paths, command_options, input_data"""
+  run_spec_path = startup.CreateFixture(path, FIXTURE_JOBS)
+  # Use the fixture caches, not our own
+  run_spec = specs.LoadRunSpec(run_spec_path)
+  facts.FACTS_PATH = run_spec['facts path']
+
+  # Binary output for RunShell
+  fp = open(os.path.join(path, 'binary.bin'), 'wb')
+  fp.write(os.urandom(dict([(name, size) for (name, command, size) in RUN_SHELL_OUTPUTS])['binary']))
+  fp.close()
+
+  command_options = {'platform':platform.GetPlatform(), 'noninteractive':True, 'verbose':False, 'format':'json',
+                     'remote':False, 'strict':False, 'input_path':None}
+
+  fixture = {
+    'path':path,
+    'run_spec_path':run_spec_path,
+    'run_spec':run_spec,
+    'job_spec_paths':[run_spec['jobs'][job_key] for job_key in sorted(run_spec['jobs'])],
+    'command_options':command_options,
+    'input_data':{'host':'localhost', 'port':80},
+  }
+
+  return fixture
+
+
+def TimeCalls(function, count):
+  """Returns float, seconds per call of function()"""
+  started = time.time()
+  for _ in xrange(count):
+    function()
+
+  return (time.time() - started) / count
+
+
+def ClearSpecCache(fixture, disk=True):
+  """Forget loaded specs, in memory, and on disk if disk"""
+  specs.CACHE.clear()
+
+  if disk and os.path.isdir(specs.CACHE_PATH):
+    shutil.rmtree(specs.CACHE_PATH)
+
+
+def BenchmarkRunShell(fixture):
+  """Returns dict, metrics: seconds per small RunShell() call, and seconds per MB of large output"""
+  metrics = {}
+  metrics['run_shell.small.per_call'] = TimeCalls(lambda: run.RunShell('echo runman'), RUN_SHELL_CALLS)
+
+  for (name, command, size) in RUN_SHELL_OUTPUTS:
+    started = time.time()
+    (status, output, output_error) = run.RunShell(command % {'size':size, 'fixture':fixture['path']})
+    metrics['run_shell.%s.per_mb' % name] = (time.time() - started) / (float(size) / MEGABYTE)
+
+  return metrics
+
+
+def BenchmarkSpecs(fixture):
+  """Returns dict, metrics: seconds per spec loaded, as list and print load them, with cold and warm disk caches"""
+  paths = fixture['job_spec_paths']
+  metrics = {}
+
+  for (command, header) in (('list', True), ('print', False)):
+    # Cold: nothing compiled yet.  Warm: compiled on disk by a previous run, but this is a new process.
+    for cache in ('cold', 'warm'):
+      ClearSpecCache(fixture, disk=(cache == 'cold'))
+
+      started = time.time()
+      specs.LoadMany(paths, header=header)
+      metrics['specs.%s.%s.per_spec' % (command, cache)] = (time.time() - started) / len(paths)
+
+  return metrics
+
+
+def GetJobPlan(fixture):
+  """Returns (job_spec_path, JobPlan, RunItemPlan): the first fixture job, and its first run item"""
+  job_spec_path = fixture['job_spec_paths'][0]
+  job_plan = plan.GetPlan(job_spec_path)
+  item_plan = job_plan.platforms[fixture['command_options']['platform']].graph[0][1]
+
+  return (job_spec_path, job_plan, item_plan)
+
+
+def BenchmarkValidate(fixture):
+  """Returns dict, metrics: seconds per ValidateInput() call"""
+  (job_spec_path, job_plan, item_plan) = GetJobPlan(fixture)
+  command_options = fixture['command_options']
+
+  def Validate(validator):
+    run.ValidateInput(job_plan.job_spec, job_spec_path, 'host', 'host1.example.com', command_options, validator=validator)
+    run.ValidateInput(job_plan.job_spec, job_spec_path, 'port', '8080', command_options, validator=validator)
+
+  metrics = {}
+  metrics['validate.compiled.per_call'] = TimeCalls(lambda: Validate(job_plan.validator), VALIDATE_CALLS) / 2
+  metrics['validate.uncompiled.per_call'] = TimeCalls(lambda: Validate(None), VALIDATE_CALLS) / 2
+
+  return metrics
+
+
+def BenchmarkTestResult(fixture):
+  """Returns dict, metrics: seconds per TestRunResult() call"""
+  (job_spec_path, job_plan, item_plan) = GetJobPlan(fixture)
+  command_options = fixture['command_options']
+
+  now = time.time()
+  run_result = {'started':now, 'finished':now, 'duration':0.0, 'exit_code':0, 'stdout':'', 'stderr':''}
+
+  def Test(test_item_plan):
+    run.TestRunResult(fixture['run_spec'], job_plan.job_spec, job_spec_path, item_plan.run_item, fixture['input_data'],
+                      run_result, {}, command_options, [], item_plan=test_item_plan)
+
+  metrics = {}
+  metrics['test_result.compiled.per_call'] = TimeCalls(lambda: Test(item_plan), TEST_RESULT_CALLS)
+  metrics['test_result.uncompiled.per_call'] = TimeCalls(lambda: Test(None), TEST_RESULT_CALLS)
+
+  return metrics
+
+
+def BenchmarkLog(fixture):
+  """Returns dict, metrics: seconds per log() line, including writing it out"""
+  metrics = {}
+
+  started = time.time()
+  for count in xrange(LOG_CALLS):
+    log.log('Benchmark log line: %s' % count)
+  log.Flush()
+  metrics['log.written.per_call'] = (time.time() - started) / LOG_CALLS
+
+  metrics['log.skipped.per_call'] = TimeCalls(lambda: log.log('Benchmark debug line', level='debug'), LOG_CALLS)
+
+  return metrics
+
+
+def BenchmarkStartup(fixture):
+  """Returns dict, metrics: seconds of each CLI command process, and of its Main()"""
+  metrics = {}
+  for (command, result) in startup.BenchmarkStartup(None, STARTUP_RUNS).items():
+    metrics['startup.%s.total' % command] = result['total']
+    metrics['startup.%s.main' % command] = result['main']
+
+  return metrics
+
+
+def BenchmarkClient(fixture):
+  """Returns dict, metrics: seconds per job for ProcessRequestsForever() to get, run and report jobs from a job server"""
+  server = jobserver.JobServer(('localhost', 0))
+  server_thread = threading.Thread(target=server.serve_forever, name='benchmark-jobserver')
+  server_thread.daemon = True
+  server_thread.start()
+
+  spool_path = tempfile.mkdtemp(prefix='spool_', dir=fixture['path'])
+
+  try:
+    websource = server.GetWebsource()
+    websource['job_get']['long poll'] = CLIENT_LONG_POLL
+    websource_path = os.path.join(spool_path, 'websource.json')
+    json.dump(websource, open(websource_path, 'w'))
+
+    run_spec = dict(fixture['run_spec'])
+    run_spec['websource'] = websource_path
+    run_spec['report spool path'] = spool_path
+    run_spec['client concurrency'] = CLIENT_CONCURRENCY
+
+    job_keys = sorted(run_spec['jobs'])
+    for count in range(CLIENT_JOBS):
+      job_key = job_keys[count % len(job_keys)]
+      server.AddJob(jobserver.MakeJobRequest('benchmark-%s' % count, job_key, run_spec['jobs'][job_key], fixture['input_data']))
+
+    client.RUNNING = True
+    client_thread = threading.Thread(target=client.ProcessRequestsForever, args=(run_spec, fixture['command_options'], []),
+                                     name='benchmark-client')
+    client_thread.daemon = True
+
+    started = time.time()
+    client_thread.start()
+
+    # Done when every job is reported
+    while len(server.reports) < CLIENT_JOBS:
+      if time.time() - started > CLIENT_TIMEOUT or not client_thread.is_alive():
+        raise Exception('Client reported %s of %s jobs' % (len(server.reports), CLIENT_JOBS))
+      time.sleep(0.005)
+
+    duration = time.time() - started
+
+    client.RUNNING = False
+    client_thread.join()
+
+    failed = [job_id for (job_id, data) in server.reports if not json.loads(data).get('success', False)]
+    if failed:
+      raise Exception('Client jobs failed: %s' % ', '.join(failed))
+
+  finally:
+    client.RUNNING = False
+
+    # Close our keep-alive connections, so the server's connection threads finish before it goes away
+    transport.TRANSPORT.Close()
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(spool_path)
+
+  return {'client.per_job':duration / CLIENT_JOBS}
+
+
+# Scenarios we run by default, in this order
+SCENARIOS = [
+  ('run_shell', BenchmarkRunShell),
+  ('specs', BenchmarkSpecs),
+  ('validate', BenchmarkValidate),
+  ('test_result', BenchmarkTestResult),
+  ('log', BenchmarkLog),
+  ('startup', BenchmarkStartup),
+  ('client', BenchmarkClient),
+]
+
+
+def RunSuite(scenarios=None, repeat=REPEAT):
+  """Returns dict, metric name: median seconds over repeat runs of each scenario"""
+  scenario_functions = dict(SCENARIOS)
+  if not scenarios:
+    scenarios = [name for (name, function) in SCENARIOS]
+
+  for name in scenarios:
+    if name not in scenario_functions:
+      raise Exception('Unknown scenario "%s", scenarios: %s' % (name, ', '.join([name for (name, function) in SCENARIOS])))
+
+  #NOTE(g): Log lines go nowhere, we are timing logging, not the terminal
+  devnull = open(os.devnull, 'w')
+  log.Flush()
+  log_output = log.WRITER.output
+  log.WRITER.output = devnull
+
+  fixture_path = tempfile.mkdtemp(prefix='runman_benchmark_')
+  try:
+    fixture = CreateFixture(fixture_path)
+
+    samples = {}
+    for name in scenarios:
+      for _ in range(repeat):
+        for (metric, value) in scenario_functions[name](fixture).items():
+          samples.setdefault(metric, []).append(value)
+
+    return dict([(metric, startup.Median(values)) for (metric, values) in samples.items()])
+
+  finally:
+    log.Flush()
+    log.WRITER.output = log_output
+    devnull.close()
+    shutil.rmtree(fixture_path)
+
+
+def CreateBaseline(metrics, repeat):
+  """Returns dict, a baseline of these metrics, with what we ran them on"""
+  host_facts = facts.GetFacts()
+
+  baseline = {
+    'version':BASELINE_VERSION,
+    'created':time.time(),
+    'host':dict([(key, host_facts.get(key, None)) for key in ('hostname', 'platform', 'kernel', 'machine', 'cpu_count', 'memory_total')]),
+    'python':sys.version.split()[0],
+    'repeat':repeat,
+    'metrics':metrics,
+  }
+
+  return baseline
+
+
+def LoadBaseline(path):
+  """Returns dict, the baseline saved at path"""
+  baseline = json.load(open(path))
+
+  if baseline.get('version', None) != BASELINE_VERSION:
+    raise Exception('Baseline is version %s, we compare version %s: %s' % (baseline.get('version', None), BASELINE_VERSION, path))
+
+  return baseline
+
+
+def SaveBaseline(path, baseline):
+  fp = open(path, 'w')
+  try:
+    json.dump(baseline, fp, indent=2, sort_keys=True)
+    fp.write('\n')
+  finally:
+    fp.close()
+
+
+def Compare(baseline_metrics, metrics, threshold=THRESHOLD):
+  """Returns list of dicts, for every metric in either: metric, baseline, current, change, status
+
+  change is the fraction slower (negative is faster) than the baseline.  status is "regression" if more than threshold
+  slower, "improvement" if more than threshold faster, else "ok".  Metrics only in one of them are "new" or "missing".
+  """
+  comparison = []
+  for metric in sorted(set(baseline_metrics) | set(metrics)):
+    baseline_value = baseline_metrics.get(metric, None)
+    value = metrics.get(metric, None)
+    item = {'metric':metric, 'baseline':baseline_value, 'current':value, 'change':None}
+
+    if baseline_value == None:
+      item['status'] = 'new'
+    elif value == None:
+      item['status'] = 'missing'
+    else:
+      if baseline_value > 0:
+        item['change'] = (value - baseline_value) / baseline_value
+      else:
+        item['change'] = 0.0
+
+      if item['change'] > threshold:
+        item['status'] = 'regression'
+      elif item['change'] < -threshold:
+        item['status'] = 'improvement'
+      else:
+        item['status'] = 'ok'
+
+    comparison.append(item)
+
+  return comparison
+
+
+def FormatSeconds(value):
+  """Returns string, seconds in a readable unit"""
+  if value == None:
+    return '-'
+  elif value >= 1.0:
+    return '%.2f s' % value
+  elif value >= 0.001:
+    return '%.2f ms' % (value * 1000)
+  else:
+    return '%.2f us' % (value * 1000000)
+
+
+def Main(args):
+  (options, args) = getopt.getopt(args, '', ['scenarios=', 'repeat=', 'save=', 'compare=', 'threshold=', 'json'])
+
+  scenarios = None
+  repeat = REPEAT
+  save_path = None
+  compare_path = None
+  threshold = THRESHOLD
+  output_json = False
+  for (option, value) in options:
+    if option == '--scenarios':
+      scenarios = value.split(',')
+    elif option == '--repeat':
+      repeat = int(value)
+    elif option == '--save':
+      save_path = value
+    elif option == '--compare':
+      compare_path = value
+    elif option == '--threshold':
+      threshold = float(value)
+    elif option == '--json':
+      output_json = True
+
+  # Load the baseline first, so a bad path fails before we spend time running
+  baseline = None
+  if compare_path:
+    baseline = LoadBaseline(compare_path)
+
+  metrics = RunSuite(scenarios, repeat)
+  result = CreateBaseline(metrics, repeat)
+
+  if save_path:
+    SaveBaseline(save_path, result)
+
+  comparison = None
+  if baseline:
+    # Only compare the scenarios we ran
+    baseline_metrics = baseline['metrics']
+    if scenarios:
+      baseline_metrics = dict([(metric, value) for (metric, value) in baseline_metrics.items() if metric.split('.')[0] in scenarios])
+
+    comparison = Compare(baseline_metrics, metrics, threshold)
+    result['comparison'] = comparison
+
+  regressions = [item for item in comparison or [] if item['status'] == 'regression']
+
+  if output_json:
+    print json.dumps(result, indent=2, sort_keys=True)
+
+  elif comparison == None:
+    print '%-36s %12s' % ('metric', 'median')
+    for (metric, value) in sorted(metrics.items()):
+      print '%-36s %12s' % (metric, FormatSeconds(value))
+
+  else:
+    if baseline['host'].get('hostname', None) != result['host']['hostname']:
+      print 'WARNING: Baseline is from another host: %s' % baseline['host'].get('hostname', None)
+
+    print '%-36s %12s %12s %8s  %s' % ('metric', 'baseline', 'current', 'change', 'status')
+    for item in comparison:
+      if item['change'] == None:
+        change = '-'
+      else:
+        change = '%+.0f%%' % (item['change'] * 100)
+
+      print '%-36s %12s %12s %8s  %s' % (item['metric'], FormatSeconds(item['baseline']), FormatSeconds(item['current']),
+                                          change, item['status'].upper() if item['status'] == 'regression' else item['status'])
+
+    print '\n%s regression(s), threshold: %.0f%% slower' % (len(regressions), threshold * 100)
+
+  if regressions:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  Main(sys.argv[1:])
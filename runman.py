@@ -13,17 +13,20 @@ TODO:
 import sys
 import os
 import getopt
-import yaml
-import json
-import pprint
 
 
-import utility
+#NOTE(g): Only what every command needs is imported here.  Each command imports its own subsystems, and output formats
+#   import their modules, so startup only pays for what this invocation uses.  See benchmark/startup.py.
+import utility.log
+import utility.specs
+import utility.platform
+import utility.facts
+import utility.output
 from utility.log import log
 
 
 # Output formats we support
-OUTPUT_FORMATS = ['json', 'yaml', 'pprint']
+OUTPUT_FORMATS = utility.output.OUTPUT_FORMATS
 
 # Commands we support
 COMMANDS = {
@@ -32,8 +35,43 @@ COMMANDS = {
   'run':'Run a job from the runman spec',
   'info':'Information about this environment',
   'client':'Run forever processing server requests',
+  'validate':'Validate a file of input records for a job: <job_key> <records.json|.yaml|.jsonl>',
+  'index':'Update the job spec index, for job specs that changed',
+  'search':'Search the job spec index: [platform=<platform>] [input=<key>] [component=<component>] [<text>]',
+  'describe':'Describe a job from the job spec index: <job_key>',
 }
 
+# Search command terms: term: Index.Search() argument
+SEARCH_TERMS = {
+  'platform':'platform',
+  'input':'input_key',
+  'component':'component',
+}
+
+
+def GetJobSpecPaths(run_spec):
+  """Returns list of strings, the run spec's job spec paths that exist"""
+  return [job_path for job_path in run_spec['jobs'].values() if os.path.isfile(job_path)]
+
+
+def GenerateJobSpecs(run_spec, errors):
+  """Yields (job, job spec) for the run spec's jobs, as they are loaded.  Errors are appended to errors."""
+  # Spec paths can be shared by many jobs
+  jobs_by_path = {}
+  for (job, job_path) in sorted(run_spec['jobs'].items()):
+    if os.path.isfile(job_path):
+      jobs_by_path.setdefault(job_path, []).append(job)
+    else:
+      errors.append('Job spec file not found: %s: %s' % (job, job_path))
+  
+  for (job_path, job_spec, error) in utility.specs.IterateMany(jobs_by_path.keys()):
+    for job in jobs_by_path[job_path]:
+      log('Job: %s' % job, level='debug')
+      if error:
+        errors.append('Job spec could not be loaded: %s: %s: %s' % (job, job_path, error))
+      else:
+        yield (job, job_spec)
+
 
 def ProcessCommand(run_spec, command, command_options, command_args):
   """Process a command against this run_spec_path"""
@@ -47,22 +85,23 @@ def ProcessCommand(run_spec, command, command_options, command_args):
   elif command == 'list':
     output_data['errors'] = []
     
-    # Jobs
-    #output_data['jobs'] = {}
-    for (job, job_path) in run_spec['jobs'].items():
-      if os.path.isfile:
-        try:
-          job_data = yaml.load(open(job_path))
-          #output_data['jobs'][job] = {}
-          #output_data['jobs'][job]['data'] = job_data['data']
-          
-          print 'Job: %s: %s: %s' % (job, job_data['data']['component'], job_data['data']['name'])
-          
-        except Exception, e:
-          output_data['errors'].append('Job spec could not be loaded: %s: %s: %s' % (job, job_path, e))
-          
-      else:
-        output_data['errors'].append('Job spec file not found: %s' % job_path)
+    # Jobs: we only need their data block, and load them all at once
+    job_headers = utility.specs.LoadMany(GetJobSpecPaths(run_spec), header=True)
+    
+    for (job, job_path) in sorted(run_spec['jobs'].items()):
+      if job_path not in job_headers:
+        output_data['errors'].append('Job spec file not found: %s: %s' % (job, job_path))
+        continue
+      
+      (job_header, error) = job_headers[job_path]
+      try:
+        if error:
+          raise Exception(error)
+        
+        print 'Job: %s: %s: %s' % (job, job_header['component'], job_header['name'])
+      
+      except Exception, e:
+        output_data['errors'].append('Job spec could not be loaded: %s: %s: %s' % (job, job_path, e))
 
   # Print: Print out job spec
   elif command == 'print':
@@ -74,7 +113,7 @@ def ProcessCommand(run_spec, command, command_options, command_args):
     # Websource: If we have the websource (HTTP based datasource), load its data
     if 'websource' in run_spec:
       try:
-        output_data['websource'] = yaml.load(open(run_spec['websource']))
+        output_data['websource'] = utility.specs.Load(run_spec['websource'])
         
       except Exception, e:
         output_data['errors'].append('Could not load run_spec\'s websource: %s: %s' % (run_spec['websource'], e))
@@ -83,27 +122,121 @@ def ProcessCommand(run_spec, command, command_options, command_args):
     else:
       output_data['errors'].append('No websource block specified in the run_spec')
     
-    # Jobs
-    output_data['jobs'] = {}
-    for (job, job_path) in run_spec['jobs'].items():
-      log('Job: %s' % job)
-      if os.path.isfile:
+    # Jobs, streamed out as they are loaded
+    output_data['jobs'] = utility.output.Stream(GenerateJobSpecs(run_spec, output_data['errors']), mapping=True)
+  
+  # Run a job
+  elif command == 'run':
+    from utility import run
+    from utility import batch
+    
+    if command_options['batch_path'] and command_options['hosts']:
+      Usage('Batch (--batch) and fan-out (--hosts) runs cannot be combined')
+    
+    # Batch: run the job once for each input record, streaming each record's result as it completes.  The summary is
+    #   filled in when they are all finished.
+    if command_options['batch_path']:
+      output_data['batch'] = {}
+      output_data['results'] = utility.output.Stream(batch.IterateBatch(run_spec, command_options, command_args,
+                                                                        command_options['batch_path'], output_data['batch']))
+    
+    # Fan-out: run the job on each host, streaming each host's result as it finishes.  Input is collected once, first,
+    #   as it may prompt for it.
+    elif command_options['hosts']:
+      from utility import fanout
+      
+      input_data = fanout.RetrieveInputData(run_spec, command_options, command_args)
+      output_data['fanout'] = {}
+      output_data['hosts'] = utility.output.Stream(fanout.IterateFanout(run_spec, command_options, command_args, input_data,
+                                                                        output_data['fanout']), mapping=True)
+    
+    else:
+      output_data['result'] = run.Run(run_spec, command_options, command_args)
+  
+  # Validate input records for a job, from a file of many records
+  elif command == 'validate':
+    from utility import validate
+    
+    output_data['errors'] = []
+    
+    if len(command_args) < 1:
+      output_data['errors'].append('Missing job spec name to validate input for')
+    
+    elif command_args[0] not in run_spec['jobs']:
+      output_data['errors'].append('Missing job spec key in run spec: %s' % command_args[0])
+    
+    else:
+      # Records path from the command args, or the input path option
+      if len(command_args) > 1:
+        records_path = command_args[1]
+      else:
+        records_path = command_options['input_path']
+      
+      if not records_path:
+        output_data['errors'].append('Missing input records path to validate')
+      
+      else:
         try:
-          output_data['jobs'][job] = yaml.load(open(job_path))
-          
+          output_data['validation'] = validate.ValidateFile(run_spec['jobs'][command_args[0]], records_path)
+        
         except Exception, e:
-          output_data['errors'].append('Job spec could not be loaded: %s: %s: %s' % (job, job_path, e))
-          
+          output_data['errors'].append('Input records could not be validated: %s: %s' % (records_path, e))
+  
+  # Index: update the job spec index
+  elif command == 'index':
+    from utility import index
+    
+    job_index = index.Index(index.GetIndexPath(run_spec))
+    try:
+      output_data['index'] = job_index.Update(run_spec)
+    finally:
+      job_index.Close()
+  
+  # Search: find jobs in the job spec index, updated first for any job specs that changed
+  elif command == 'search':
+    from utility import index
+    
+    output_data['errors'] = []
+    search_args = {}
+    for command_arg in command_args:
+      if '=' in command_arg:
+        (term, value) = command_arg.split('=', 1)
+        if term not in SEARCH_TERMS:
+          output_data['errors'].append('Unknown search term: %s (terms: %s)' % (term, ', '.join(sorted(SEARCH_TERMS))))
+        else:
+          search_args[SEARCH_TERMS[term]] = value
       else:
-        output_data['errors'].append('Job spec file not found: %s' % job_path)
+        search_args['text'] = command_arg
+    
+    if not output_data['errors']:
+      job_index = index.GetIndex(run_spec)
+      try:
+        output_data['jobs'] = job_index.Search(**search_args)
+      finally:
+        job_index.Close()
   
-  # Run a job
-  elif command == 'run':
-    utility.run.Run(run_spec, command_options, command_args)
+  # Describe: a job from the job spec index
+  elif command == 'describe':
+    from utility import index
+    
+    output_data['errors'] = []
+    if len(command_args) < 1:
+      output_data['errors'].append('Missing job key to describe')
+    
+    else:
+      job_index = index.GetIndex(run_spec)
+      try:
+        output_data['job'] = job_index.Describe(command_args[0])
+      finally:
+        job_index.Close()
+      
+      if output_data['job'] == None:
+        output_data['errors'].append('Job not in run spec: %s' % command_args[0])
   
   # Client - Run forever processing server requests
   elif command == 'client':
-    utility.client.ProcessRequestsForever(run_spec, command_options, command_args)
+    from utility import client
+    client.ProcessRequestsForever(run_spec, command_options, command_args)
   
   # Unknown command
   else:
@@ -114,21 +247,8 @@ def ProcessCommand(run_spec, command, command_options, command_args):
 
 
 def FormatAndOuput(result, command_options):
-  """Format the output and return it"""
-  # PPrint
-  if command_options['format'] == 'pprint':
-    pprint.pprint(result)
-  
-  # YAML
-  elif command_options['format'] == 'yaml':
-    print yaml.dump(result)
-  
-  # JSON
-  elif command_options['format'] == 'json':
-    print json.dumps(result)
-  
-  else:
-    raise Exception('Unknown output format "%s", result as text: %s' % (command_options['format'], result))
+  """Format the output and write it.  Streamed result values are written as they are generated."""
+  utility.output.Write(result, command_options['format'])
 
 
 def Usage(error=None):
@@ -155,8 +275,16 @@ def Usage(error=None):
   print '  -s, --strict                Strict mode: fail if input fields not specified for collection are missing'
   print '  -f, --format <format>       Format output, types: %s' % ', '.join(OUTPUT_FORMATS)
   print '  -n, --noninteractive        Do not use STDIN to prompt for missing input fields'
-  print '  -i, --input <path>          Path to input file (Format specified by suffic: (.yaml, .json)'
-  print '  --override-host <hostname>  Hostname to run jobs as.  Allows '
+  print '  -i, --input <path>          Path to input file (Format specified by suffic: (.yaml, .json).  "-" reads JSON from STDIN.'
+  print '  -b, --batch <path>          Run: run the job for each input record in the file (.json, .yaml, .jsonl)'
+  print '  -c, --concurrency <count>   Run: input records (batch mode) or hosts (fan-out) to run at once'
+  print '  --hosts <hosts>             Run: fan-out, run the job on these hosts: host, web[01-20], @file, glob of run spec "hosts"'
+  print '  --rolling <count>           Run: fan-out in rolling batches of this many hosts, each finishing before the next'
+  print '  --max-failures <count|N%>   Run: fan-out stops starting hosts once more than this many hosts fail'
+  print '  --transport <name>          Run: fan-out transport: ssh, local (default: run spec "fanout transport", or ssh)'
+  print '  --log-json                  Log to STDERR as JSON lines: {"time", "level", "message"}'
+  print '  --override-host <hostname>  Hostname to run jobs as.  Allows running as another host (client job requests,'
+  print '                              "fact: hostname" input)'
   print
   print 'Commands:'
   print
@@ -173,23 +301,32 @@ def Main(args=None):
   if not args:
     args = []
 
-  long_options = ['help', 'format=', 'verbose', 'strict', 'noninteractive', 'input=']
+  long_options = ['help', 'format=', 'verbose', 'strict', 'noninteractive', 'input=', 'batch=', 'concurrency=', 'log-json',
+                  'override-host=', 'hosts=', 'rolling=', 'max-failures=', 'transport=']
   
   try:
-    (options, args) = getopt.getopt(args, '?hvnsi:f:', long_options)
+    (options, args) = getopt.getopt(args, '?hvnsi:f:b:c:', long_options)
   except getopt.GetoptError, e:
     Usage(e)
   
   # Dictionary of command options, with defaults
   command_options = {}
   command_options['remote'] = False   # Remote invocation.  When quitting or Error(), report back remotely with details.
-  command_options['platform'] = utility.platform.GetPlatform()
+  command_options['platform'] = None   # From host facts, once we have the run spec
   command_options['verbose'] = False
   command_options['format'] = 'pprint'
   command_options['noninteractive'] = False
   command_options['input_path'] = None
   command_options['strict'] = False
   command_options['override_host'] = None
+  command_options['batch_path'] = None
+  command_options['concurrency'] = None
+  command_options['log_format'] = 'text'
+  command_options['run_spec_path'] = None
+  command_options['hosts'] = None
+  command_options['rolling'] = None
+  command_options['max_failures'] = None
+  command_options['transport'] = None
   
   
   # Process out CLI options
@@ -214,6 +351,21 @@ def Main(args=None):
     elif option in ('-i', '--input'):
       command_options['input_path'] = value
     
+    # Batch: input records file, run the job for each of them
+    elif option in ('-b', '--batch'):
+      command_options['batch_path'] = value
+    
+    # Batch: input records to run at once
+    elif option in ('-c', '--concurrency'):
+      try:
+        command_options['concurrency'] = int(value)
+      except ValueError:
+        Usage('Concurrency must be a number: %s' % value)
+    
+    # Log as JSON lines, instead of text
+    elif option == '--log-json':
+      command_options['log_format'] = 'json'
+    
     # Format output
     elif option in ('-f', '--format'):
       if value not in (OUTPUT_FORMATS):
@@ -225,6 +377,25 @@ def Main(args=None):
     elif option == '--override-host':
       command_options['override_host'] = value
     
+    # Fan-out: hosts to run the job on
+    elif option == '--hosts':
+      command_options['hosts'] = value
+    
+    # Fan-out: rolling batch size
+    elif option == '--rolling':
+      try:
+        command_options['rolling'] = int(value)
+      except ValueError:
+        Usage('Rolling batch size must be a number: %s' % value)
+    
+    # Fan-out: abort threshold, count or percent of hosts
+    elif option == '--max-failures':
+      command_options['max_failures'] = value
+    
+    # Fan-out: transport to the hosts
+    elif option == '--transport':
+      command_options['transport'] = value
+    
     # Invalid option
     else:
       Usage('Unknown option: %s' % option)
@@ -240,15 +411,29 @@ def Main(args=None):
   
   # Get the command
   run_spec_path = args[0]
+  command_options['run_spec_path'] = os.path.abspath(run_spec_path)
   
   if not os.path.isfile(run_spec_path):
     Usage('Run spec file does not exist: %s' % run_spec_path)
   
+  # Loading it sets the compiled spec cache directory, if the run spec specifies it (false disables it)
   try:
-    run_spec = yaml.load(open(run_spec_path))
+    run_spec = utility.specs.LoadRunSpec(run_spec_path)
   
   except Exception, e:
     Usage('Failed to load run_spec: %s: %s' % (run_spec_path, e))
+  
+  # Host facts disk cache, if the run spec specifies it (false disables it)
+  if run_spec.get('facts path', None) != None:
+    utility.facts.FACTS_PATH = run_spec['facts path']
+  if run_spec.get('facts ttl', None) != None:
+    utility.facts.FACTS_TTL = run_spec['facts ttl']
+  
+  # Run as another host
+  if command_options['override_host']:
+    utility.facts.OVERRIDES['hostname'] = command_options['override_host']
+  
+  command_options['platform'] = utility.platform.GetPlatform()
     
   
   # Ensure we at least have a command, it's required
@@ -280,7 +465,8 @@ def Main(args=None):
   #   debugging information
   #except Exception, e:
   else:
-    utility.error.Error({'exception':str(e)}, command_options)
+    from utility.error import Error
+    Error({'exception':str(e)}, command_options)
 
 
 if __name__ == '__main__':
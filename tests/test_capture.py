@@ -0,0 +1,81 @@
+"""
+Tests: Output capture head/tail limits
+
+Run from the repository root: python -m unittest discover tests
+"""
+
+
+import os
+import sys
+import json
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utility import run
+from utility import capture
+
+
+# Two byte UTF-8 character (e acute), and one of three bytes (euro sign)
+TWO_BYTE = '\xc3\xa9'
+THREE_BYTE = '\xe2\x82\xac'
+
+
+class StreamCaptureTest(unittest.TestCase):
+
+  def Capture(self, data, head_size, tail_size, chunk_size=7):
+    """Returns string, the text of a capture written data in chunk_size pieces"""
+    stream = capture.StreamCapture('stdout', head_size=head_size, tail_size=tail_size)
+    for offset in range(0, len(data), chunk_size):
+      stream.Write(data[offset:offset + chunk_size])
+    stream.Close()
+
+    return stream.GetText()
+
+
+  def testUntruncatedIsUnchanged(self):
+    data = 'a' + TWO_BYTE * 10
+    self.assertEqual(self.Capture(data, 100, 100), data)
+
+
+  def testMultiByteAcrossLimits(self):
+    # Odd sizes cut two byte characters in the middle, at both the head and the tail
+    for character in (TWO_BYTE, THREE_BYTE):
+      for (head_size, tail_size) in ((10, 10), (11, 13), (0, 9), (9, 0)):
+        data = 'a' + character * 100
+        text = self.Capture(data, head_size, tail_size)
+
+        # Valid UTF-8 with whole characters only, and serializable as a job result
+        text.decode('utf8')
+        json.dumps({'output':text})
+
+        (head, rest) = text.split('\n... [', 1)
+        tail = rest.split('] ...\n', 1)[1]
+        self.assertTrue(len(head) <= head_size)
+        self.assertTrue(len(tail) <= tail_size)
+        self.assertTrue(data.startswith(head))
+        self.assertTrue(data.endswith(tail))
+
+
+  def testTruncatedCountIncludesTrimmedBytes(self):
+    data = 'a' + TWO_BYTE * 100
+    text = self.Capture(data, 10, 10)
+
+    # Head keeps 'a' and 4 characters, tail keeps 5 characters: the rest is counted as truncated
+    self.assertEqual(text, 'a' + TWO_BYTE * 4 + capture.TRUNCATED_MARKER % (len(data) - 9 - 10) + TWO_BYTE * 5)
+
+
+  def testRunShellLargeUtf8Output(self):
+    # Output past both the head and the tail limits, cut mid character by the default sizes
+    stdout_capture = capture.StreamCapture('stdout', head_size=capture.HEAD_SIZE, tail_size=capture.TAIL_SIZE)
+    command = '''%s -c "import sys; sys.stdout.write('a' + '\\xc3\\xa9' * 1500001)"''' % sys.executable
+    (status, output, output_error) = run.RunShell(command, stdout_capture)
+
+    self.assertEqual(status, 0)
+    self.assertTrue(stdout_capture.IsTruncated())
+    output.decode('utf8')
+    json.dumps({'output':output})
+
+
+if __name__ == '__main__':
+  unittest.main()
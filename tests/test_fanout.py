@@ -0,0 +1,213 @@
+"""
+Tests: Fan-out runs of a job on many hosts: host expansion, failure thresholds, rolling batches, and local runs
+
+Run from the repository root: python -m unittest discover tests
+"""
+
+
+import os
+import sys
+import json
+import pipes
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utility import facts
+from utility import fanout
+from utility import platform
+
+
+RUNMAN_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'runman.py')
+
+# Each "host" runs this instead of runman: hosts named fail* fail, the rest succeed
+SCRIPT_COMMAND = ('sleep 0.05; case %(host)s in fail*) echo "ERROR: broken on %(host)s" >&2; exit 1;; esac; '
+                  'echo \'{"result": {"success": true}}\'')
+
+# Job for the end-to-end run: the hostname input defaults to the fact, which the host has from --override-host
+JOB_SPEC = '''
+data:
+  name: Fan-out test
+input:
+  hostname:
+    type: text
+    fact: hostname
+  amount:
+    type: decimal
+run:
+  %s:
+    - execute: "echo host=%%(hostname)s amount=%%(amount)s"
+'''
+
+
+class ExpandHostsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp(prefix='runman_test_fanout_')
+
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+
+  def testRanges(self):
+    self.assertEqual(fanout.ExpandHosts('web[01-03].example.com'), ['web01.example.com', 'web02.example.com', 'web03.example.com'])
+    self.assertEqual(fanout.ExpandHosts('web[8-10]'), ['web8', 'web9', 'web10'])
+    self.assertEqual(fanout.ExpandHosts('web[098-100]'), ['web098', 'web099', 'web100'])
+    self.assertEqual(fanout.ExpandHosts('rack[1-2]-node[01-02]'), ['rack1-node01', 'rack1-node02', 'rack2-node01', 'rack2-node02'])
+    self.assertRaises(fanout.FanoutError, fanout.ExpandHosts, 'web[3-1]')
+
+
+  def testUniqueInOrder(self):
+    self.assertEqual(fanout.ExpandHosts('db1, web[1-2],, web1,db1'), ['db1', 'web1', 'web2'])
+
+
+  def testFile(self):
+    hosts_path = os.path.join(self.path, 'hosts.txt')
+    open(hosts_path, 'w').write('# Web servers\nweb01\n\nweb[02-03]  # more\ndb01\n')
+
+    self.assertEqual(fanout.ExpandHosts('@%s,lb01' % hosts_path), ['web01', 'web02', 'web03', 'db01', 'lb01'])
+    self.assertRaises(fanout.FanoutError, fanout.ExpandHosts, '@%s' % os.path.join(self.path, 'missing.txt'))
+
+
+  def testGlob(self):
+    inventory = ['web01', 'web02', 'db01', 'web10']
+    self.assertEqual(fanout.ExpandHosts('web0?', inventory), ['web01', 'web02'])
+    self.assertEqual(fanout.ExpandHosts('db*,web*', inventory), ['db01', 'web01', 'web02', 'web10'])
+    self.assertRaises(fanout.FanoutError, fanout.ExpandHosts, 'cache*', inventory)
+    self.assertRaises(fanout.FanoutError, fanout.ExpandHosts, 'web*')
+
+
+class MaxFailuresTest(unittest.TestCase):
+
+  def testCount(self):
+    self.assertEqual(fanout.GetMaxFailures('3', 10), 3)
+    self.assertEqual(fanout.GetMaxFailures(0, 10), 0)
+    self.assertEqual(fanout.GetMaxFailures(None, 10), None)
+    self.assertEqual(fanout.GetMaxFailures('', 10), None)
+
+
+  def testPercent(self):
+    self.assertEqual(fanout.GetMaxFailures('25%', 10), 2)
+    self.assertEqual(fanout.GetMaxFailures('50%', 4), 2)
+    self.assertEqual(fanout.GetMaxFailures('10%', 5), 0)
+
+
+  def testInvalid(self):
+    self.assertRaises(fanout.FanoutError, fanout.GetMaxFailures, 'some', 10)
+    self.assertRaises(fanout.FanoutError, fanout.GetMaxFailures, 'x%', 10)
+
+
+class RunFanoutTest(unittest.TestCase):
+  """Runs SCRIPT_COMMAND for each host, with the local transport"""
+
+  def RunFanout(self, hosts, **options):
+    """Returns (summary, results): the fan-out summary, and list of (host, result) in the order they finished"""
+    run_spec = {'fanout transport':'local', 'fanout command':SCRIPT_COMMAND, 'fanout run spec':'run_spec.yaml'}
+    command_options = {'hosts':hosts}
+    command_options.update(options)
+
+    results = []
+    summary = fanout.RunFanout(run_spec, command_options, ['job'], {}, lambda host, result: results.append((host, result)))
+
+    return (summary, results)
+
+
+  def testSuccess(self):
+    (summary, results) = self.RunFanout('web[1-4]', concurrency=4)
+
+    self.assertTrue(summary['success'])
+    self.assertEqual((summary['hosts'], summary['batches'], summary['succeeded'], summary['failed']), (4, 1, 4, 0))
+    self.assertEqual(sorted([host for (host, result) in results]), ['web1', 'web2', 'web3', 'web4'])
+
+
+  def testRolling(self):
+    (summary, results) = self.RunFanout('web[1-6]', concurrency=10, rolling=2)
+    self.assertEqual((summary['batches'], summary['succeeded']), (3, 6))
+
+    # Each batch finishes before the next one starts
+    by_host = dict(results)
+    batches = [['web1', 'web2'], ['web3', 'web4'], ['web5', 'web6']]
+    for (batch, next_batch) in zip(batches, batches[1:]):
+      finished = max([by_host[host]['finished'] for host in batch])
+      started = min([by_host[host]['started'] for host in next_batch])
+      self.assertTrue(started >= finished, (batch, next_batch))
+
+
+  def testAbortCount(self):
+    # Both hosts of the first batch fail, which is more than 1, so no other batch is started
+    (summary, results) = self.RunFanout('fail1,fail2,web[1-4]', concurrency=10, rolling=2, max_failures='1')
+
+    self.assertTrue(summary['aborted'])
+    self.assertFalse(summary['success'])
+    self.assertEqual((summary['succeeded'], summary['failed']), (0, 2))
+    self.assertEqual(summary['skipped'], ['web1', 'web2', 'web3', 'web4'])
+    self.assertEqual(dict(results)['fail1']['error'], 'broken on fail1')
+
+
+  def testAbortPercent(self):
+    # 25% of 5 hosts is 1, the second failure aborts, one host at a time
+    (summary, results) = self.RunFanout('web1,fail1,fail2,web2,web3', concurrency=1, max_failures='25%')
+
+    self.assertTrue(summary['aborted'])
+    self.assertEqual((summary['succeeded'], summary['failed']), (1, 2))
+    self.assertEqual(summary['skipped'], ['web2', 'web3'])
+    self.assertEqual([host for (host, result) in results], ['web1', 'fail1', 'fail2'])
+
+
+  def testUnderThreshold(self):
+    # Failures up to the threshold do not abort, but the fan-out did not succeed
+    (summary, results) = self.RunFanout('fail1,web[1-3]', concurrency=2, max_failures='1')
+
+    self.assertFalse(summary['aborted'])
+    self.assertFalse(summary['success'])
+    self.assertEqual((summary['succeeded'], summary['failed'], summary['skipped']), (3, 1, []))
+
+
+class LocalRunTest(unittest.TestCase):
+  """Fan-out through runman.py, with each host running runman.py with --override-host on this machine"""
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp(prefix='runman_test_fanout_')
+
+    job_spec_path = os.path.join(self.path, 'job.yaml')
+    open(job_spec_path, 'w').write(JOB_SPEC % platform.DetectPlatform(facts.ReadOsRelease()))
+
+    command = '%s %s -n -f json -i - --override-host %%(host)s %%(run_spec)s run %%(job)s' % (
+      pipes.quote(sys.executable), pipes.quote(RUNMAN_PATH))
+
+    self.run_spec_path = os.path.join(self.path, 'run_spec.yaml')
+    run_spec = {'jobs':{'job':job_spec_path}, 'cache path':False, 'facts path':False, 'fanout transport':'local',
+                'fanout command':command}
+    open(self.run_spec_path, 'w').write(json.dumps(run_spec))
+
+    self.input_path = os.path.join(self.path, 'input.json')
+    open(self.input_path, 'w').write(json.dumps({'amount':'1.10'}))
+
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+
+  def testRun(self):
+    process = subprocess.Popen([sys.executable, RUNMAN_PATH, '-n', '-f', 'json', '-i', self.input_path,
+                                '--hosts', 'web[01-02]', self.run_spec_path, 'run', 'job'],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (stdout, stderr) = process.communicate()
+    self.assertEqual(process.returncode, 0, stderr)
+
+    output = json.loads(stdout)
+    self.assertTrue(output['fanout']['success'], stderr)
+    self.assertEqual(sorted(output['hosts']), ['web01', 'web02'])
+
+    # Each host used its own hostname fact, and got the decimal as sent
+    for (host, result) in output['hosts'].items():
+      self.assertTrue(result['success'], result)
+      self.assertEqual(result['result']['run_results'][0]['stdout'], 'host=%s amount=1.10\n' % host)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,223 @@
+"""
+Tests: Local fcntl locks, and shared locks on a LockServer started for the test
+
+Run from the repository root: python -m unittest discover tests
+"""
+
+
+import os
+import sys
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utility import lock
+
+
+# Seconds to wait on a lock in timeout tests
+TIMEOUT = 0.3
+
+# Seconds to wait for the server to see a released lock
+RELEASE_TIMEOUT = 5.0
+
+
+class LockBackendTests(object):
+  """Tests for any LockBackend.  Subclasses make self.backend in setUp()."""
+
+  def testExclusiveContention(self):
+    handle = self.backend.Acquire('key', blocking=False)
+    try:
+      self.assertRaises(lock.LockUnavailable, self.backend.Acquire, 'key', blocking=False)
+      self.assertRaises(lock.LockUnavailable, self.backend.Acquire, 'key', blocking=False, shared=True)
+
+      # Other keys are not held
+      self.backend.Release(self.backend.Acquire('other key', blocking=False))
+    finally:
+      self.backend.Release(handle)
+
+    # Released, so available again
+    self.backend.Release(self.backend.Acquire('key', blocking=False))
+
+
+  def testSharedSharedCompatible(self):
+    first = self.backend.Acquire('key', blocking=False, shared=True)
+    second = self.backend.Acquire('key', blocking=False, shared=True)
+
+    # Exclusive waits for every shared holder
+    self.assertRaises(lock.LockUnavailable, self.backend.Acquire, 'key', blocking=False)
+    self.backend.Release(first)
+    self.assertRaises(lock.LockUnavailable, self.backend.Acquire, 'key', blocking=False)
+    self.backend.Release(second)
+
+    self.backend.Release(self.backend.Acquire('key', blocking=False))
+
+
+  def testTimeout(self):
+    handle = self.backend.Acquire('key')
+    try:
+      started = time.time()
+      self.assertRaises(lock.LockUnavailable, self.backend.Acquire, 'key', timeout=TIMEOUT)
+      self.assertTrue(time.time() - started >= TIMEOUT)
+    finally:
+      self.backend.Release(handle)
+
+
+  def testWaitUntilReleased(self):
+    handle = self.backend.Acquire('key')
+    timer = threading.Timer(TIMEOUT, self.backend.Release, [handle])
+    timer.start()
+    try:
+      self.backend.Release(self.backend.Acquire('key', timeout=RELEASE_TIMEOUT))
+    finally:
+      timer.join()
+
+
+class LocalLockTest(LockBackendTests, unittest.TestCase):
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp(prefix='runman_test_locks_')
+    self.backend = lock.LocalLockBackend(self.path)
+
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+
+  def testReleaseOnProcessExit(self):
+    # Another process holds the lock, until we kill it
+    code = ('import sys, fcntl; fp = open(sys.argv[1], "a"); fcntl.flock(fp.fileno(), fcntl.LOCK_EX); '
+            'sys.stdout.write("held\\n"); sys.stdout.flush(); sys.stdin.read()')
+    process = subprocess.Popen([sys.executable, '-c', code, self.backend.GetLockPath('key')], stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE)
+    try:
+      self.assertEqual(process.stdout.readline(), 'held\n')
+      self.assertRaises(lock.LockUnavailable, self.backend.Acquire, 'key', blocking=False)
+    finally:
+      process.kill()
+      process.wait()
+
+    self.backend.Release(self.backend.Acquire('key', blocking=False))
+
+
+  def testAcquireLocksDuplicateKeys(self):
+    # Both items format to the same key: held once, not waiting on ourselves
+    run_spec = {'locks':{'backend':'local', 'path':self.path}}
+    run_item = {'acquire locks':[{'key':'%(hostname)s', 'lock timeout':TIMEOUT}, {'key':'web01', 'lock timeout':TIMEOUT}]}
+
+    held = lock.AcquireLocks(run_spec, run_item, {'hostname':'web01'})
+    try:
+      self.assertEqual([key for (backend, key, handle) in held], ['web01'])
+      self.assertRaises(lock.LockUnavailable, self.backend.Acquire, 'web01', blocking=False, shared=True)
+    finally:
+      lock.ReleaseLocks(held)
+
+
+class LockRequestsTest(unittest.TestCase):
+
+  def testMerged(self):
+    run_item = {'acquire locks':[
+      {'key':'b', 'shared':True},
+      {'key':'a', 'shared':True, 'lock timeout':5},
+      {'key':'a', 'shared':True, 'lock timeout':2, 'fail if lock unavailable':True},
+      {'key':'b', 'shared':False, 'lock timeout':1},
+    ]}
+
+    # Sorted.  Shared only if all are, not waiting if any wont, shortest timeout.
+    self.assertEqual(lock.GetLockRequests(run_item, {}), [('a', False, 2.0, True), ('b', True, 1.0, False)])
+
+
+  def testBadKey(self):
+    for key in ('%(missing)s', '%(count)d', '100%'):
+      run_item = {'acquire locks':[{'key':key}]}
+      self.assertRaises(lock.LockUnavailable, lock.AcquireLocks, {}, run_item, {'count':'text'})
+
+
+  def testServerDown(self):
+    # Nothing listening on the port we had
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('localhost', 0))
+    port = listener.getsockname()[1]
+    listener.close()
+
+    run_spec = {'locks':{'backend':'shared', 'host':'localhost', 'port':port}}
+    self.assertRaises(lock.LockUnavailable, lock.AcquireLocks, run_spec, {'acquire locks':[{'key':'a'}]}, {})
+
+
+class SharedLockTest(LockBackendTests, unittest.TestCase):
+
+  def setUp(self):
+    self.server = lock.LockServer(('localhost', 0))
+    self.server_thread = threading.Thread(target=self.server.serve_forever)
+    self.server_thread.daemon = True
+    self.server_thread.start()
+
+    self.backend = lock.SharedLockBackend('localhost', self.server.server_address[1])
+
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+
+  def WaitFor(self, condition):
+    """Wait until condition() is true: the server sees closed connections from its own threads"""
+    deadline = time.time() + RELEASE_TIMEOUT
+    while not condition() and time.time() < deadline:
+      time.sleep(0.01)
+
+
+  def WaitForReleased(self, key):
+    self.WaitFor(lambda: key not in self.server.held)
+
+
+  def testReleaseOnDisconnect(self):
+    # Held until the connection closes, without a RELEASE, as when the holder dies
+    handle = self.backend.Acquire('key', blocking=False)
+    self.assertRaises(lock.LockUnavailable, self.backend.Acquire, 'key', blocking=False)
+
+    handle.shutdown(socket.SHUT_RDWR)
+    handle.close()
+    self.WaitForReleased('key')
+
+    self.backend.Release(self.backend.Acquire('key', blocking=False))
+
+
+  def testSharedReleaseOnDisconnect(self):
+    first = self.backend.Acquire('key', blocking=False, shared=True)
+    second = self.backend.Acquire('key', blocking=False, shared=True)
+
+    first.close()
+    second.close()
+    self.WaitForReleased('key')
+
+    self.assertEqual(self.server.held, {})
+    self.backend.Release(self.backend.Acquire('key', blocking=False))
+
+
+  def testAcquireLocks(self):
+    run_spec = {'locks':{'backend':'shared', 'host':'localhost', 'port':self.server.server_address[1]}}
+    run_item = {'acquire locks':[{'key':'%(hostname)s: b', 'fail if lock unavailable':True},
+                                 {'key':'%(hostname)s: a', 'shared':True}]}
+
+    held = lock.AcquireLocks(run_spec, run_item, {'hostname':'web01'})
+    try:
+      # Sorted by key, so concurrent jobs acquire in the same order
+      self.assertEqual([key for (backend, key, handle) in held], ['web01: a', 'web01: b'])
+      self.assertEqual(self.server.held, {'web01: a':1, 'web01: b':lock.EXCLUSIVE})
+
+      # Shared with another job, but not the exclusive lock: the locks already held are released
+      self.assertRaises(lock.LockUnavailable, lock.AcquireLocks, run_spec, run_item, {'hostname':'web01'})
+      self.WaitFor(lambda: self.server.held['web01: a'] == 1)
+      self.assertEqual(self.server.held['web01: a'], 1)
+    finally:
+      lock.ReleaseLocks(held)
+
+
+if __name__ == '__main__':
+  unittest.main()
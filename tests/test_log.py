@@ -0,0 +1,91 @@
+"""
+Tests: The background log writer
+
+Run from the repository root: python -m unittest discover tests
+"""
+
+
+import os
+import sys
+import json
+import StringIO
+import subprocess
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utility import log
+
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Logs right up to exit, from many threads, so the writer is busy when the interpreter shuts down
+EXIT_SCRIPT = '''
+import sys
+import threading
+sys.path.insert(0, 'utility')
+from log import log
+
+def Logger(number):
+  for count in range(200):
+    log('thread %s line %s' % (number, count))
+
+threads = [threading.Thread(target=Logger, args=(number,)) for number in range(4)]
+for thread in threads:
+  thread.start()
+for thread in threads:
+  thread.join()
+log('last line')
+'''
+
+
+class LogWriterTest(unittest.TestCase):
+
+  def testStop(self):
+    output = StringIO.StringIO()
+    writer = log.LogWriter(output)
+    writer.Write(0.0, 'info', 'first')
+    writer.Write(0.0, 'error', 'second')
+    thread = writer.thread
+
+    writer.Stop()
+    self.assertFalse(thread.is_alive())
+    self.assertEqual([line.split('] ', 1)[1] for line in output.getvalue().splitlines()], ['first', 'ERROR: second'])
+
+    # Stopped: written right away, without starting the thread again
+    writer.Write(0.0, 'info', 'third')
+    self.assertEqual(writer.thread, thread)
+    self.assertTrue(output.getvalue().endswith('third\n'))
+
+
+  def testJsonBadLine(self):
+    # Text that is not UTF-8 cannot be JSON encoded as is, it is written with a replacement character
+    log.RUN_OPTIONS['log_format'] = 'json'
+    try:
+      output = StringIO.StringIO()
+      writer = log.LogWriter(output)
+      for text in ('before', 'bad \xff byte', 'after'):
+        writer.Write(1.0, 'info', text)
+      writer.Stop()
+    finally:
+      del log.RUN_OPTIONS['log_format']
+
+    lines = [json.loads(line) for line in output.getvalue().splitlines()]
+    self.assertEqual([line['message'] for line in lines], ['before', u'bad \ufffd byte', 'after'])
+    self.assertEqual(lines[0], {'time':1.0, 'level':'info', 'message':'before'})
+
+
+  def testExit(self):
+    process = subprocess.Popen([sys.executable, '-c', EXIT_SCRIPT], cwd=REPOSITORY_PATH, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    (stdout, stderr) = process.communicate()
+
+    self.assertEqual(process.returncode, 0)
+    self.assertFalse('Exception' in stderr, stderr)
+    lines = stderr.splitlines()
+    self.assertEqual(len(lines), 801)
+    self.assertTrue(lines[-1].endswith('last line'))
+
+
+if __name__ == '__main__':
+  unittest.main()
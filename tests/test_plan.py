@@ -0,0 +1,47 @@
+"""
+Tests: Compiled job spec templates
+
+Run from the repository root: python -m unittest discover tests
+"""
+
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utility import plan
+
+
+class TemplateTest(unittest.TestCase):
+
+  def testConversions(self):
+    template = plan.Template('took %(duration).1f s, %(count)d items, %(name)r, 100%% done')
+    self.assertEqual(template.keys, ('duration', 'count', 'name'))
+    self.assertEqual(template.Format({'duration':1.234, 'count':3, 'name':'x'}), "took 1.2 s, 3 items, 'x', 100% done")
+
+
+  def testAlwaysFormatted(self):
+    # Log messages are always formatted, as they always were, so "%%" is a "%" without any keys
+    self.assertEqual(plan.Template('100%% done').Format({}), '100% done')
+    self.assertRaises(ValueError, plan.Template('done: 100%').Format, {})
+
+
+  def testKeysOnly(self):
+    # Commands without keys are left as is, so shell "%" needs no escaping
+    self.assertEqual(plan.Template('date +%Y-%m-%d', keys_only=True).Format({}), 'date +%Y-%m-%d')
+
+    template = plan.Template('sleep %(seconds)d && echo 50%%', keys_only=True)
+    self.assertEqual(template.keys, ('seconds',))
+    self.assertEqual(template.Format({'seconds':2}), 'sleep 2 && echo 50%')
+
+
+  def testTestPlanLogs(self):
+    test_plan = plan.TestPlan(0, {'when':'finished', 'key':'duration', 'function':'>', 'value':30.0,
+                                  'log failure':'Took %(duration).1f seconds, over 100%%'})
+    self.assertEqual(test_plan.log_failure.Format({'duration':31.25}), 'Took 31.2 seconds, over 100%')
+
+
+if __name__ == '__main__':
+  unittest.main()
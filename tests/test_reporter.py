@@ -0,0 +1,141 @@
+"""
+Tests: Spooled job reports, sent to the local job server (utility/jobserver.py)
+
+Run from the repository root: python -m unittest discover tests
+"""
+
+
+import os
+import sys
+import json
+import socket
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utility import jobserver
+from utility import reporter
+
+
+def ReadLines(path):
+  """Returns list of parsed JSON lines in the file at path"""
+  fp = open(path)
+  try:
+    return [json.loads(line) for line in fp if line.strip()]
+  finally:
+    fp.close()
+
+
+def GetClosedPort():
+  """Returns int, a local port nothing is listening on"""
+  listener = socket.socket()
+  listener.bind(('localhost', 0))
+  port = listener.getsockname()[1]
+  listener.close()
+  return port
+
+
+class ReporterTest(unittest.TestCase):
+
+  def setUp(self):
+    self.spool_path = tempfile.mkdtemp(prefix='runman_test_')
+
+    self.server = jobserver.JobServer(('localhost', 0))
+    self.server_thread = threading.Thread(target=self.server.serve_forever)
+    self.server_thread.daemon = True
+    self.server_thread.start()
+
+
+  def tearDown(self):
+    # The reporter sends on the shared transport, close its pooled connections to this server
+    reporter.transport.TRANSPORT.Close()
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.spool_path)
+
+
+  def GetWebsource(self, endpoint='job_report', **options):
+    websource = {'url':self.server.GetUrl(endpoint), 'retry delay':0.001}
+    websource.update(options)
+    return websource
+
+
+  def testSent(self):
+    for batch in (False, True):
+      job_reporter = reporter.Reporter(self.GetWebsource(batch=batch), self.spool_path)
+      for count in range(5):
+        job_reporter.Report('job-%s-%s' % (batch, count), '{}')
+      job_reporter.Stop()
+
+      self.assertEqual(job_reporter.Pending(), 0)
+      self.assertEqual(os.path.getsize(job_reporter.spool_file_path), 0)
+
+    self.assertEqual([job_id for (job_id, data) in self.server.reports],
+                     ['job-%s-%s' % (batch, count) for batch in (False, True) for count in range(5)])
+
+
+  def testRejectedDeadLettered(self):
+    # The server answers 404, the reports are not retried
+    for batch in (False, True):
+      job_reporter = reporter.Reporter(self.GetWebsource('missing', batch=batch), self.spool_path)
+      job_reporter.Report('job-%s' % batch, '{"success": true}')
+      job_reporter.Stop()
+
+      self.assertEqual(job_reporter.Pending(), 0)
+
+    dead = ReadLines(os.path.join(self.spool_path, 'reports.dead'))
+    self.assertEqual([report['id'] for report in dead], ['job-False', 'job-True'])
+    self.assertEqual(dead[0]['data'], '{"success": true}')
+    self.assertTrue('404' in dead[0]['error'])
+    self.assertEqual(self.server.requests, 2)
+
+
+  def testIsRejected(self):
+    self.assertTrue(reporter.IsRejected(reporter.transport.TransportError('Bad Request', 400)))
+    self.assertFalse(reporter.IsRejected(reporter.transport.TransportError('Too Many Requests', 429)))
+    self.assertFalse(reporter.IsRejected(reporter.transport.TransportError('Service Unavailable', 503)))
+    self.assertFalse(reporter.IsRejected(reporter.transport.TransportError('Connection refused')))
+    self.assertFalse(reporter.IsRejected(ValueError('not a transport error')))
+
+
+  def testCompact(self):
+    original = reporter.SPOOL_COMPACT_ACKED
+    reporter.SPOOL_COMPACT_ACKED = 3
+    try:
+      # Nothing is listening, so the reports stay pending until we acknowledge them
+      websource = {'url':'http://localhost:%s/job_report' % GetClosedPort(), 'retries':0}
+      job_reporter = reporter.Reporter(websource, self.spool_path)
+      for count in range(6):
+        job_reporter.Report('job-%s' % count, '{}')
+
+      pending = list(job_reporter.pending)
+      job_reporter.Acknowledge(pending[:2])
+      self.assertEqual(len(ReadLines(job_reporter.spool_file_path)), 6)
+
+      # The third acknowledgement compacts the spool to the pending reports
+      job_reporter.Acknowledge(pending[2:3])
+      self.assertEqual([report['id'] for report in ReadLines(job_reporter.spool_file_path)], ['job-3', 'job-4', 'job-5'])
+      self.assertEqual(os.path.getsize(job_reporter.ack_file_path), 0)
+      self.assertFalse(os.path.exists(job_reporter.spool_file_path + '.tmp'))
+
+      # New reports go to the compacted spool, which is still locked
+      job_reporter.Report('job-6', '{}')
+      job_reporter.Acknowledge(pending[3:4])
+      self.assertRaises(reporter.ReporterError, reporter.Reporter, websource, self.spool_path)
+      job_reporter.Stop(timeout=0)
+
+      # The next reporter replays only what was never acknowledged
+      job_reporter = reporter.Reporter(websource, self.spool_path)
+      self.assertEqual([job_id for (sequence, job_id, data) in job_reporter.pending], ['job-4', 'job-5', 'job-6'])
+      self.assertEqual(job_reporter.sequence, 7)
+      job_reporter.Stop(timeout=0)
+
+    finally:
+      reporter.SPOOL_COMPACT_ACKED = original
+
+
+if __name__ == '__main__':
+  unittest.main()
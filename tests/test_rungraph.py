@@ -0,0 +1,156 @@
+"""
+Tests: Run items as a dependency graph
+
+Run from the repository root: python -m unittest discover tests
+"""
+
+
+import os
+import sys
+import time
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utility import rungraph
+
+
+# Seconds a slow run item takes, so others start while it runs
+SLOW = 0.2
+
+
+class Runner(object):
+  """Run function for ExecuteRunGraph: records what ran, and fails the items it is told to"""
+
+  def __init__(self, failures=None, critical=None, raises=None, slow=None):
+    self.failures = set(failures or [])
+    self.critical = set(critical or [])
+    self.raises = dict(raises or {})
+    self.slow = set(slow or [])
+
+    self.started = []
+    self.finished = []
+    self.lock = threading.Lock()
+
+
+  def __call__(self, item_id, run_item):
+    self.lock.acquire()
+    try:
+      self.started.append(item_id)
+    finally:
+      self.lock.release()
+
+    try:
+      if item_id in self.slow:
+        time.sleep(SLOW)
+
+      if item_id in self.raises:
+        raise self.raises[item_id]
+
+      run_result = {'id':item_id, 'success':item_id not in self.failures and item_id not in self.critical,
+                    'test_results':[]}
+      if item_id in self.critical:
+        run_result['test_results'].append({'success':False, 'critical':True})
+
+      return run_result
+
+    finally:
+      self.lock.acquire()
+      try:
+        self.finished.append(item_id)
+      finally:
+        self.lock.release()
+
+
+class BuildRunGraphTest(unittest.TestCase):
+
+  def testSequenceAndGroups(self):
+    graph = rungraph.BuildRunGraph([
+      {'execute':'a', 'id':'a'},
+      {'execute':'b', 'parallel group':'g'},
+      {'execute':'c', 'parallel group':'g'},
+      {'execute':'d'},
+      {'execute':'e', 'depends on':'a'},
+    ])
+
+    self.assertEqual([(item_id, depends_on) for (item_id, run_item, depends_on) in graph],
+                     [('a', []), ('#1', ['a']), ('#2', ['a']), ('#3', ['#1', '#2']), ('#4', ['a'])])
+
+
+  def testCycle(self):
+    run_items = [{'id':'a', 'depends on':'c'}, {'id':'b', 'depends on':'a'}, {'id':'c', 'depends on':['b']}, {'id':'d'}]
+    self.assertRaises(rungraph.RunGraphError, rungraph.BuildRunGraph, run_items)
+
+    self.assertRaises(rungraph.RunGraphError, rungraph.BuildRunGraph, [{'id':'a', 'depends on':'a'}])
+
+
+  def testInvalid(self):
+    self.assertRaises(rungraph.RunGraphError, rungraph.BuildRunGraph, [{'id':'a'}, {'id':'a'}])
+    self.assertRaises(rungraph.RunGraphError, rungraph.BuildRunGraph, [{'id':'a', 'depends on':'missing'}])
+
+
+class ExecuteRunGraphTest(unittest.TestCase):
+
+  def Execute(self, run_items, runner, concurrency=4):
+    return rungraph.ExecuteRunGraph(rungraph.BuildRunGraph(run_items), runner, concurrency)
+
+
+  def testSuccess(self):
+    runner = Runner()
+    (run_results, skipped) = self.Execute([{'id':'a'}, {'id':'b'}, {'id':'c', 'depends on':'a'}], runner)
+
+    self.assertEqual([run_result['id'] for run_result in run_results], ['a', 'b', 'c'])
+    self.assertEqual(skipped, [])
+    self.assertEqual(runner.started, ['a', 'b', 'c'])
+
+
+  def testConcurrent(self):
+    # A slow group item does not hold up the other one
+    runner = Runner(slow=['a'])
+    self.Execute([{'id':'a', 'parallel group':'g'}, {'id':'b', 'parallel group':'g'}], runner)
+    self.assertEqual(runner.finished, ['b', 'a'])
+
+
+  def testSkipDownstreamOfFailure(self):
+    # b fails: c depends on it, d depends on c.  e only depends on a, so it still runs.
+    runner = Runner(failures=['b'])
+    run_items = [{'id':'a'}, {'id':'b'}, {'id':'c'}, {'id':'d'}, {'id':'e', 'depends on':'a'}]
+    (run_results, skipped) = self.Execute(run_items, runner)
+
+    self.assertEqual([(run_result['id'], run_result['success']) for run_result in run_results],
+                     [('a', True), ('b', False), ('e', True)])
+    self.assertEqual(skipped, ['c', 'd'])
+    self.assertTrue('c' not in runner.started)
+
+
+  def testCriticalStopsNewStarts(self):
+    # b fails critically while a (slow) is running: a finishes, but nothing else starts, even items that dont depend on b
+    runner = Runner(critical=['b'], slow=['a'])
+    run_items = [{'id':'a', 'parallel group':'g'}, {'id':'b', 'parallel group':'g'}, {'id':'c', 'depends on':[]},
+                 {'id':'d', 'depends on':'a'}]
+    (run_results, skipped) = self.Execute(run_items, runner, concurrency=2)
+
+    self.assertEqual([run_result['id'] for run_result in run_results], ['a', 'b'])
+    self.assertEqual(skipped, ['c', 'd'])
+    self.assertEqual(sorted(runner.finished), ['a', 'b'])
+
+
+  def testErrorRaisedAfterRunningFinish(self):
+    # Error() exits with SystemExit.  It is raised once a (slow), already running, has finished.
+    runner = Runner(raises={'b':SystemExit(1)}, slow=['a'])
+    run_items = [{'id':'a', 'parallel group':'g'}, {'id':'b', 'parallel group':'g'}, {'id':'c'}]
+
+    self.assertRaises(SystemExit, self.Execute, run_items, runner)
+    self.assertEqual(sorted(runner.finished), ['a', 'b'])
+    self.assertTrue('c' not in runner.started)
+
+
+  def testExceptionRaised(self):
+    runner = Runner(raises={'a':ValueError('bad')})
+    self.assertRaises(ValueError, self.Execute, [{'id':'a'}, {'id':'b'}], runner)
+    self.assertEqual(runner.started, ['a'])
+
+
+if __name__ == '__main__':
+  unittest.main()
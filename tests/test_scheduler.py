@@ -0,0 +1,105 @@
+"""
+Tests: Scheduling job instances on "start at" and "job dependencies"
+
+Run from the repository root: python -m unittest discover tests
+"""
+
+
+import os
+import sys
+import time
+import Queue
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utility import scheduler
+
+
+# Seconds to wait for the scheduler to dispatch or fail a job instance
+WAIT = 5.0
+
+
+class SchedulerTest(unittest.TestCase):
+
+  def setUp(self):
+    # ('dispatch', job id, time) or ('fail', job id, reason, time)
+    self.events = Queue.Queue()
+    self.scheduler = scheduler.Scheduler(lambda job_request: self.events.put(('dispatch', job_request['id'], time.time())),
+                                         lambda job_request, reason: self.events.put(('fail', job_request['id'], reason, time.time())),
+                                         dependency_timeout=60.0)
+
+
+  def tearDown(self):
+    self.scheduler.Stop()
+
+
+  def GetEvent(self):
+    return self.events.get(timeout=WAIT)
+
+
+  def testDispatchNow(self):
+    self.scheduler.Add({'id':'1'})
+    self.assertEqual(self.GetEvent()[:2], ('dispatch', '1'))
+
+
+  def testStartAt(self):
+    start_at = time.time() + 0.2
+    self.scheduler.Add({'id':'1', 'start_at':start_at})
+    self.assertEqual(self.scheduler.Pending(), 1)
+
+    event = self.GetEvent()
+    self.assertEqual(event[:2], ('dispatch', '1'))
+    self.assertTrue(event[2] >= start_at)
+    self.assertEqual(self.scheduler.Pending(), 0)
+
+
+  def testBadRequestNotScheduled(self):
+    self.assertRaises(ValueError, self.scheduler.Add, {'id':'1', 'start_at':'next tuesday'})
+    self.assertRaises(ValueError, self.scheduler.Add, {'id':'2', 'dependency_timeout':'soon'})
+    self.assertEqual(self.scheduler.Pending(), 0)
+
+
+  def testDependencies(self):
+    self.scheduler.Add({'id':'2', 'job_dependencies':['1']})
+    self.scheduler.Add({'id':'3', 'job_dependencies':'1'})
+    self.assertRaises(Queue.Empty, self.events.get, timeout=0.1)
+
+    self.scheduler.Complete('1', True)
+    self.assertEqual(sorted([self.GetEvent()[:2] for count in range(2)]), [('dispatch', '2'), ('dispatch', '3')])
+
+
+  def testDependencyFailed(self):
+    self.scheduler.Add({'id':'2', 'job_dependencies':['1']})
+    self.scheduler.Complete('1', False)
+
+    event = self.GetEvent()
+    self.assertEqual(event[:2], ('fail', '2'))
+    self.assertTrue('failed' in event[2])
+
+
+  def testDependencyTimeout(self):
+    # The dependency never completes: the job instance fails once its timeout passes, not before
+    added = time.time()
+    self.scheduler.Add({'id':'2', 'job_dependencies':['1'], 'dependency_timeout':0.2})
+
+    event = self.GetEvent()
+    self.assertEqual(event[:2], ('fail', '2'))
+    self.assertTrue('did not complete within 0.2 seconds: 1' in event[2])
+    self.assertTrue(event[3] - added >= 0.2)
+    self.assertEqual(self.scheduler.Pending(), 0)
+
+
+  def testDependencyTimeoutDefault(self):
+    quick = scheduler.Scheduler(lambda job_request: self.events.put(('dispatch', job_request['id'], time.time())),
+                                lambda job_request, reason: self.events.put(('fail', job_request['id'], reason, time.time())),
+                                dependency_timeout=0.1)
+    try:
+      quick.Add({'id':'2', 'job_dependencies':['1']})
+      self.assertEqual(self.GetEvent()[:2], ('fail', '2'))
+    finally:
+      quick.Stop()
+
+
+if __name__ == '__main__':
+  unittest.main()
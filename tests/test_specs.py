@@ -0,0 +1,87 @@
+"""
+Tests: Loading the run spec, and the spec disk cache it configures
+
+Run from the repository root: python -m unittest discover tests
+"""
+
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utility import specs
+
+
+class LoadRunSpecTest(unittest.TestCase):
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp(prefix='runman_test_specs_')
+    self.default_cache_path = os.path.join(self.path, 'default_cache')
+
+    self.saved_cache_path = specs.CACHE_PATH
+    specs.CACHE_PATH = self.default_cache_path
+
+
+  def tearDown(self):
+    specs.CACHE_PATH = self.saved_cache_path
+    specs.CACHE.clear()
+    shutil.rmtree(self.path)
+
+
+  def WriteRunSpec(self, cache_path_line):
+    run_spec_path = os.path.join(self.path, 'run_spec.yaml')
+    job_spec_path = os.path.join(self.path, 'job.yaml')
+    open(job_spec_path, 'w').write('data:\n  name: Job\n')
+    open(run_spec_path, 'w').write('jobs:\n  job: %s\n%s\n' % (job_spec_path, cache_path_line))
+    return (run_spec_path, job_spec_path)
+
+
+  def GetCachedFiles(self, cache_path):
+    if not os.path.isdir(cache_path):
+      return []
+    return os.listdir(cache_path)
+
+
+  def testDisabled(self):
+    (run_spec_path, job_spec_path) = self.WriteRunSpec('cache path: false')
+    run_spec = specs.LoadRunSpec(run_spec_path)
+    specs.Load(run_spec['jobs']['job'])
+
+    self.assertEqual(specs.CACHE_PATH, False)
+    self.assertEqual(self.GetCachedFiles(self.default_cache_path), [])
+
+
+  def testCustom(self):
+    custom_cache_path = os.path.join(self.path, 'custom cache')
+    (run_spec_path, job_spec_path) = self.WriteRunSpec('cache path: "%s"  # comment' % custom_cache_path)
+    specs.LoadRunSpec(run_spec_path)
+    specs.Load(job_spec_path)
+
+    # Only the job spec is cached, and only where the run spec says
+    self.assertEqual(specs.CACHE_PATH, custom_cache_path)
+    self.assertEqual(self.GetCachedFiles(self.default_cache_path), [])
+    self.assertEqual(self.GetCachedFiles(custom_cache_path), [os.path.basename(specs.GetCacheFilePath(job_spec_path))])
+
+
+  def testExpandUser(self):
+    (run_spec_path, job_spec_path) = self.WriteRunSpec('cache path: ~/runman_cache')
+    specs.LoadRunSpec(run_spec_path)
+    self.assertEqual(specs.CACHE_PATH, os.path.join(os.path.expanduser('~'), 'runman_cache'))
+
+
+  def testDefault(self):
+    (run_spec_path, job_spec_path) = self.WriteRunSpec('cache path: null')
+    run_spec = specs.LoadRunSpec(run_spec_path)
+
+    # The run spec itself is not disk cached, but is kept in memory
+    self.assertEqual(specs.CACHE_PATH, self.default_cache_path)
+    self.assertEqual(self.GetCachedFiles(self.default_cache_path), [])
+    self.assertTrue(specs.Load(run_spec_path) is run_spec)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,189 @@
+"""
+Tests: Pooled keep-alive websource requests, against the local job server (utility/jobserver.py)
+
+Run from the repository root: python -m unittest discover tests
+"""
+
+
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utility import jobserver
+from utility import transport
+
+
+# Seconds the job server keeps idle connections, in the stale connection test
+IDLE_TIMEOUT = 0.2
+
+
+class JobServerTest(unittest.TestCase):
+  """Runs a job server for each test.  Subclasses can set server_options."""
+  server_options = {}
+
+  def setUp(self):
+    self.server = jobserver.JobServer(('localhost', 0), **self.server_options)
+    self.server_thread = threading.Thread(target=self.server.serve_forever)
+    self.server_thread.daemon = True
+    self.server_thread.start()
+
+    self.transport = transport.HttpTransport()
+
+
+  def tearDown(self):
+    self.transport.Close()
+    self.server.shutdown()
+    self.server.server_close()
+
+
+  def GetWebsource(self, endpoint, **options):
+    websource = {'url':self.server.GetUrl(endpoint), 'retry delay':0.001}
+    websource.update(options)
+    return websource
+
+
+class TransportTest(JobServerTest):
+
+  def testConnectionReuse(self):
+    websource = self.GetWebsource('job_report')
+    for count in range(10):
+      self.transport.Request(websource, {'id':'job-%s' % count, 'data':'{}'})
+
+    self.assertEqual(self.server.requests, 10)
+    self.assertEqual(self.server.connections, 1)
+    self.assertEqual(self.transport.connections_opened, 1)
+    self.assertEqual([job_id for (job_id, data) in self.server.reports], ['job-%s' % count for count in range(10)])
+
+
+  def testGzipRoundTrip(self):
+    # Compressed request body, and the server compresses its response as we accept gzip
+    data = json.dumps({'output':'runman ' * 10000})
+    self.transport.Request(self.GetWebsource('job_report', compress=True), {'id':'job-1', 'data':data})
+    self.assertEqual(self.server.reports, [('job-1', data)])
+
+    self.server.AddJob({'id':'job-2', 'output':'runman ' * 10000})
+    result = json.loads(self.transport.Request(self.GetWebsource('job_get'), {'hostname':'web01'}))
+    self.assertEqual(json.loads(result['jobs']), [{'id':'job-2', 'output':'runman ' * 10000}])
+
+    self.assertEqual(transport.zlib.decompress(transport.Compress(data), 16 + transport.zlib.MAX_WBITS), data)
+
+
+  def testRetriesBounded(self):
+    self.server.failure_rate = 1.0
+
+    websource = self.GetWebsource('job_report', retries=3)
+    self.assertRaises(transport.TransportError, self.transport.Request, websource, {'id':'job-1', 'data':'{}'})
+
+    # The first attempt and 3 retries, none of them handled
+    self.assertEqual(self.server.requests, 4)
+    self.assertEqual(self.server.failures, 4)
+    self.assertEqual(self.server.reports, [])
+
+
+  def testClientErrorNotRetried(self):
+    self.assertRaises(transport.TransportError, self.transport.Request, self.GetWebsource('unknown', retries=3), {'id':'1'})
+    self.assertEqual(self.server.requests, 1)
+
+
+class StaleConnectionTest(JobServerTest):
+  server_options = {'idle_timeout':IDLE_TIMEOUT}
+
+  def testStaleConnectionNotCounted(self):
+    # The server closes our pooled connection while it is idle.  Without retries, the next request still works.
+    websource = self.GetWebsource('job_report', retries=0)
+    self.transport.Request(websource, {'id':'job-1', 'data':'{}'})
+
+    deadline = time.time() + 5.0
+    while self.server.open_connections and time.time() < deadline:
+      time.sleep(0.01)
+
+    self.transport.Request(websource, {'id':'job-2', 'data':'{}'})
+
+    self.assertEqual(self.server.requests, 2)
+    self.assertEqual(self.server.connections, 2)
+    self.assertEqual(self.transport.connections_opened, 2)
+
+
+class DroppingServer(object):
+  """Answers the first request on a connection, then reads the next one and closes the connection without answering,
+  like a server that fails mid request.  Counts the requests it reads.
+  """
+
+  def __init__(self):
+    self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.listener.bind(('localhost', 0))
+    self.listener.listen(5)
+    self.requests = 0
+
+    self.thread = threading.Thread(target=self.Serve)
+    self.thread.daemon = True
+    self.thread.start()
+
+
+  def GetUrl(self):
+    return 'http://localhost:%s/job_report' % self.listener.getsockname()[1]
+
+
+  def ReadRequest(self, fp):
+    """Returns boolean, True if a request was read"""
+    length = 0
+    line = fp.readline()
+    if not line:
+      return False
+
+    while line.strip():
+      if line.lower().startswith('content-length:'):
+        length = int(line.split(':', 1)[1])
+      line = fp.readline()
+
+    fp.read(length)
+    self.requests += 1
+    return True
+
+
+  def Serve(self):
+    while True:
+      try:
+        (connection, address) = self.listener.accept()
+      except socket.error:
+        return
+
+      fp = connection.makefile('rb')
+      if self.ReadRequest(fp):
+        connection.sendall('HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n{}')
+        self.ReadRequest(fp)
+
+      fp.close()
+      connection.close()
+
+
+  def Close(self):
+    self.listener.close()
+
+
+class SentRequestTest(unittest.TestCase):
+
+  def testFailureAfterSendCounted(self):
+    # A request that fails after it was sent, on a pooled connection, is not sent again for free
+    server = DroppingServer()
+    try:
+      http_transport = transport.HttpTransport()
+      websource = {'url':server.GetUrl(), 'retries':0}
+
+      http_transport.Request(websource, {'id':'job-1', 'data':'{}'})
+      self.assertRaises(transport.TransportError, http_transport.Request, websource, {'id':'job-2', 'data':'{}'})
+      self.assertEqual(server.requests, 2)
+
+      http_transport.Close()
+    finally:
+      server.Close()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,108 @@
+"""
+Tests: Validating input records against the job spec input block
+
+Run from the repository root: python -m unittest discover tests
+"""
+
+
+import os
+import sys
+import json
+import shutil
+import decimal
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utility import facts
+from utility import specs
+from utility import validate
+
+
+JOB_SPEC = '''
+data:
+  name: Validate test
+input:
+  count:
+    type: int
+    min: 1
+  price:
+    type: decimal
+  hostname:
+    type: text
+    regex validate: ^web
+    fact: hostname
+run: {}
+'''
+
+
+class ValidatorTest(unittest.TestCase):
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp(prefix='runman_test_validate_')
+    self.job_spec_path = os.path.join(self.path, 'job.yaml')
+    open(self.job_spec_path, 'w').write(JOB_SPEC)
+
+    self.validator = validate.Validator(specs.ParseYaml(self.job_spec_path), self.job_spec_path)
+
+    # This host's facts, without gathering them or using the disk caches
+    self.facts = facts.FACTS
+    facts.FACTS = {'hostname':'web01'}
+    self.cache_path = specs.CACHE_PATH
+    specs.CACHE_PATH = None
+
+
+  def tearDown(self):
+    facts.FACTS = self.facts
+    specs.CACHE_PATH = self.cache_path
+    shutil.rmtree(self.path)
+
+
+  def testRecord(self):
+    (validated, errors) = self.validator.ValidateRecord({'count':'3', 'price':'1.50', 'hostname':'web02', 'other':1})
+    self.assertEqual(errors, {})
+    self.assertEqual(validated, {'count':3, 'price':decimal.Decimal('1.50'), 'hostname':'web02'})
+
+
+  def testRecordErrors(self):
+    (validated, errors) = self.validator.ValidateRecord({'count':0, 'price':'cheap', 'hostname':'db01'})
+    self.assertEqual(sorted(errors), ['count', 'hostname', 'price'])
+
+    (validated, errors) = self.validator.ValidateRecord(['not', 'a', 'record'])
+    self.assertEqual(errors.keys(), [None])
+
+
+  def testFactDefault(self):
+    # The hostname input defaults to this host's fact, as it does when the job runs
+    (validated, errors) = self.validator.ValidateRecord({'count':1, 'price':'2'})
+    self.assertEqual(errors, {})
+    self.assertEqual(validated['hostname'], 'web01')
+
+    # Facts are validated like any other input
+    facts.FACTS = {'hostname':'db01'}
+    (validated, errors) = self.validator.ValidateRecord({'count':1, 'price':'2'})
+    self.assertEqual(errors.keys(), ['hostname'])
+
+    # Without the fact, the key is missing
+    facts.FACTS = {}
+    (validated, errors) = self.validator.ValidateRecord({'count':1, 'price':'2'})
+    self.assertTrue('Missing input key' in errors['hostname'])
+
+
+  def testFile(self):
+    records_path = os.path.join(self.path, 'records.jsonl')
+    fp = open(records_path, 'w')
+    fp.write(json.dumps({'count':1, 'price':'2'}) + '\n')
+    fp.write(json.dumps({'count':0, 'price':'2', 'hostname':'web02'}) + '\n')
+    fp.write('{not json\n')
+    fp.close()
+
+    report = validate.ValidateFile(self.job_spec_path, records_path)
+    self.assertEqual((report['records'], report['valid'], report['invalid'], report['success']), (3, 1, 2, False))
+    self.assertEqual([error['record'] for error in report['errors']], [1, 2])
+    self.assertEqual(report['errors'][0]['errors'].keys(), ['count'])
+
+
+if __name__ == '__main__':
+  unittest.main()
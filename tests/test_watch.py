@@ -0,0 +1,89 @@
+"""
+Tests: "during" tests evaluated on streaming output, and aborting the run item when a critical one fails
+
+Run from the repository root: python -m unittest discover tests
+"""
+
+
+import os
+import sys
+import time
+import signal
+import subprocess
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utility import watch
+
+
+def GetWatcher(function='not regex', value='FATAL', critical=True):
+  """Returns OutputWatcher, for one stdout test"""
+  tests = [{'when':'during', 'key':'stdout', 'function':function, 'value':value, 'critical':critical}]
+  return watch.OutputWatcher(watch.GetWatches(tests))
+
+
+def StartProcess(command):
+  """Returns Popen, the shell command started in its own process group, like run.py does"""
+  return subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, preexec_fn=os.setsid)
+
+
+class OutputWatcherTest(unittest.TestCase):
+
+  def setUp(self):
+    self.kill_grace = watch.KILL_GRACE
+    watch.KILL_GRACE = 0.2
+
+
+  def tearDown(self):
+    watch.KILL_GRACE = self.kill_grace
+
+
+  def testMatchAcrossChunks(self):
+    watcher = GetWatcher(function='regex', value='DONE', critical=False)
+    watcher.Output('stdout', 'all DO')
+    watcher.Output('stdout', 'NE here')
+
+    self.assertEqual(watcher.GetMatches(), {0:'DONE'})
+    self.assertEqual(watcher.aborted, None)
+
+
+  def testAbortTerminates(self):
+    process = StartProcess('exec sleep 30')
+    watcher = GetWatcher()
+    watcher.SetProcess(process)
+    watcher.Output('stdout', 'FATAL: disk full')
+
+    self.assertTrue(watcher.aborted)
+    self.assertEqual(process.wait(), -signal.SIGTERM)
+
+    # It exited and was waited for, so the kill timer leaves its pid alone
+    watcher.kill_timer.join()
+    self.assertEqual(process.poll(), -signal.SIGTERM)
+
+
+  def testAbortKillsAfterGrace(self):
+    # The process ignores SIGTERM, so it is killed once the grace period is over
+    process = StartProcess("trap '' TERM; echo ready; while true; do sleep 0.05; done")
+    self.assertEqual(process.stdout.readline(), 'ready\n')
+    watcher = GetWatcher()
+    watcher.SetProcess(process)
+
+    started = time.time()
+    watcher.Output('stdout', 'FATAL: disk full')
+    self.assertEqual(process.wait(), -signal.SIGKILL)
+    self.assertTrue(time.time() - started >= watch.KILL_GRACE)
+
+
+  def testAbortBeforeProcess(self):
+    # Failed before the process was known, it is killed as soon as it is
+    watcher = GetWatcher()
+    watcher.Output('stdout', 'FATAL')
+
+    process = StartProcess('exec sleep 30')
+    watcher.SetProcess(process)
+    self.assertEqual(process.wait(), -signal.SIGTERM)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,9 +1,4 @@
-"""Utility package"""
-
-
-import platform
-import log
-import error
-import run
-import client
+"""Utility package
 
+Subsystems are not imported here, so a command only pays for importing what it uses: import utility.run, etc.
+"""
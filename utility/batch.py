@@ -0,0 +1,158 @@
+"""
+Batch: Run one job over many input records, with bounded concurrency
+
+Records are read from a JSON, YAML or JSONL file (see validate.LoadRecords), validated against the job's compiled
+input validator, and run through a worker pool.  Each record's result is handed to a callback as soon as it completes,
+so results stream out in completion order, not record order.  Each result has its "record" index.
+
+Records are read only as workers free up, so a large JSONL file is never held in memory all at once.
+
+IterateBatch() yields the results instead, for the output layer to write as they arrive (see output.Stream).
+"""
+
+
+import time
+import Queue
+import threading
+
+from log import log
+from error import Error
+
+import run
+import plan
+import pool
+import validate
+
+
+# Default records to run at once, if neither the command options nor the run spec "batch concurrency" say
+BATCH_CONCURRENCY = 4
+
+
+def GetConcurrency(run_spec, command_options):
+  """Returns int, records to run at once"""
+  if command_options.get('concurrency', None):
+    return int(command_options['concurrency'])
+
+  return int(run_spec.get('batch concurrency', BATCH_CONCURRENCY))
+
+
+def RunBatch(run_spec, command_options, command_args, records_path, result_function):
+  """Run a job once for every input record in records_path.  Returns dict, summary of the batch.
+
+  Args:
+    records_path: string, path to the input records file
+    result_function: function(dict), called with each record's result as it completes, one call at a time:
+      {"record":index, "success":bool, "result":run result data} or {"record":index, "success":False, "errors":...}
+  """
+  if len(command_args) < 1:
+    Error('Missing job spec name to run', command_options)
+
+  job_spec_key = command_args[0]
+  if job_spec_key not in run_spec['jobs']:
+    Error('Missing job spec key in run spec: %s' % job_spec_key, command_options)
+
+  # Every record's input comes from the batch file, so we never prompt for input
+  batch_options = dict(command_options)
+  batch_options['noninteractive'] = True
+
+  try:
+    job_plan = plan.GetPlan(run_spec['jobs'][job_spec_key])
+  except Exception, e:
+    Error('Failed to load job spec: %s: %s' % (run_spec['jobs'][job_spec_key], e), command_options)
+
+  concurrency = GetConcurrency(run_spec, command_options)
+
+  summary = {'records':0, 'succeeded':0, 'failed':0, 'invalid':0, 'started':time.time()}
+  lock = threading.Lock()
+
+  def Finished(record_result):
+    """Count and pass on a record result.  Called from worker threads, so one at a time."""
+    lock.acquire()
+    try:
+      if record_result['success']:
+        summary['succeeded'] += 1
+      else:
+        summary['failed'] += 1
+
+      result_function(record_result)
+    finally:
+      lock.release()
+
+  def RunRecord(index, input_data):
+    return run.Run(run_spec, batch_options, command_args, input_data=input_data)
+
+  def RunRecordFinished(index, result, error):
+    if error != None:
+      #NOTE(g): Error() exits, and has already written its message to stderr
+      Finished({'record':index, 'success':False, 'error':'Run failed: %s: %s' % (type(error).__name__, error)})
+    else:
+      Finished({'record':index, 'success':result['success'], 'result':result})
+
+  log('Batch run: %s: %s (concurrency %s)' % (job_spec_key, records_path, concurrency))
+
+  worker_pool = pool.WorkerPool(concurrency, name='batch')
+  try:
+    for (index, record) in enumerate(validate.LoadRecords(records_path)):
+      summary['records'] += 1
+
+      # Invalid records are not run, their errors are the result.  Input keys that default to host facts are filled in.
+      (input_data, errors) = job_plan.validator.ValidateRecord(record)
+      if errors:
+        summary['invalid'] += 1
+        Finished({'record':index, 'success':False, 'errors':errors})
+        continue
+
+      # Only read the next record when there is a worker for it
+      while worker_pool.Free() == 0:
+        worker_pool.WaitForFree(1.0)
+
+      callback = lambda result, error, index=index: RunRecordFinished(index, result, error)
+      worker_pool.Submit(RunRecord, (index, input_data), callback=callback)
+
+    worker_pool.Join()
+
+  finally:
+    worker_pool.Stop()
+
+  summary['finished'] = time.time()
+  summary['duration'] = summary['finished'] - summary['started']
+  summary['success'] = summary['failed'] == 0
+
+  log('Batch run finished: %s: %s record(s), %s succeeded, %s failed' % (job_spec_key, summary['records'], summary['succeeded'], summary['failed']))
+
+  return summary
+
+
+def IterateBatch(run_spec, command_options, command_args, records_path, summary):
+  """Yields each record's result as it completes, running the batch in a thread.  See RunBatch().
+
+  Args:
+    summary: dict, updated with the batch summary when the batch is finished
+  """
+  results = Queue.Queue()
+  finished = []
+
+  def Batch():
+    #NOTE(g): Catching BaseException, because Error() uses sys.exit(), which we re-raise in the caller's thread
+    try:
+      summary.update(RunBatch(run_spec, command_options, command_args, records_path, results.put))
+    except BaseException, e:
+      finished.append(e)
+    finally:
+      results.put(None)
+
+  thread = threading.Thread(target=Batch, name='batch-run')
+  thread.daemon = True
+  thread.start()
+
+  while True:
+    record_result = results.get()
+    if record_result == None:
+      break
+
+    yield record_result
+
+  thread.join()
+
+  if finished:
+    raise finished[0]
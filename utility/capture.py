@@ -0,0 +1,217 @@
+"""
+Output Capture: Drain process output streams while they run, keeping bounded memory
+
+Each stream keeps a head and a tail in memory.  Anything in between is dropped from memory, but can be kept in full
+by spooling the stream to a file.
+"""
+
+
+import os
+import collections
+import threading
+import tempfile
+
+
+# Bytes to read from a pipe at a time
+CHUNK_SIZE = 65536
+
+# Default bytes to keep in memory from the start and the end of each stream
+HEAD_SIZE = 1024 * 1024
+TAIL_SIZE = 1024 * 1024
+
+# Marker placed between the head and tail when the middle of a stream was not kept in memory
+TRUNCATED_MARKER = '\n... [%s bytes truncated] ...\n'
+
+# Longest UTF-8 character, in bytes
+UTF8_MAX_LENGTH = 4
+
+
+class StreamCapture(object):
+  """Capture a single output stream: head/tail ring buffer in memory, optional full spool file."""
+
+  def __init__(self, name, head_size=HEAD_SIZE, tail_size=TAIL_SIZE, spool_path=None):
+    self.name = name
+    self.head_size = head_size
+    self.tail_size = tail_size
+    self.spool_path = spool_path
+
+    # Total bytes seen on this stream
+    self.size = 0
+
+    # Head chunks, until we have head_size bytes
+    self.head = []
+    self.head_length = 0
+
+    # Tail chunks, trimmed from the left to stay at tail_size bytes
+    self.tail = collections.deque()
+    self.tail_length = 0
+
+    # Functions called with (name, data) for each chunk as it arrives, from the draining thread
+    self.listeners = []
+
+    # Spool the full stream to disk, if we have a path
+    if spool_path:
+      self.spool = open(spool_path, 'wb')
+    else:
+      self.spool = None
+
+
+  def AddListener(self, listener):
+    """Call listener(name, data) with each chunk of stream data as it arrives.  Listeners must not block."""
+    self.listeners.append(listener)
+
+
+  def Write(self, data):
+    """Add a chunk of stream data"""
+    self.size += len(data)
+
+    for listener in self.listeners:
+      listener(self.name, data)
+
+    if self.spool:
+      self.spool.write(data)
+
+    # Fill the head first
+    if self.head_length < self.head_size:
+      head_data = data[:self.head_size - self.head_length]
+      self.head.append(head_data)
+      self.head_length += len(head_data)
+      data = data[len(head_data):]
+
+    # Anything left goes in the tail ring
+    if data and self.tail_size > 0:
+      self.tail.append(data)
+      self.tail_length += len(data)
+
+      # Drop whole chunks we no longer need
+      while self.tail_length - len(self.tail[0]) >= self.tail_size:
+        self.tail_length -= len(self.tail.popleft())
+
+      # Trim the oldest chunk down so we hold exactly tail_size
+      if self.tail_length > self.tail_size:
+        excess = self.tail_length - self.tail_size
+        self.tail[0] = self.tail[0][excess:]
+        self.tail_length -= excess
+
+
+  def Close(self):
+    """Finished with this stream, close the spool file"""
+    if self.spool:
+      self.spool.close()
+      self.spool = None
+
+
+  def IsTruncated(self):
+    """Returns boolean, True if we did not keep all of the stream in memory"""
+    return self.size > self.head_length + self.tail_length
+
+
+  def GetText(self):
+    """Returns string, the head and tail of the stream, with a marker where data was dropped.  Where data was dropped,
+    the head and tail are trimmed to whole UTF-8 characters, so UTF-8 output stays valid."""
+    head = ''.join(self.head)
+    tail = ''.join(self.tail)
+
+    if self.IsTruncated():
+      head = TrimUtf8End(head)
+      tail = TrimUtf8Start(tail)
+      return head + TRUNCATED_MARKER % (self.size - len(head) - len(tail)) + tail
+    else:
+      return head + tail
+
+
+def TrimUtf8End(data):
+  """Returns string, data without a UTF-8 character cut off at its end"""
+  # Find the start of the last character, within the longest character from the end
+  for offset in range(1, min(len(data), UTF8_MAX_LENGTH) + 1):
+    byte = ord(data[-offset])
+
+    # ASCII: nothing cut
+    if byte < 0x80:
+      return data
+
+    # Lead byte: cut if its character needs more bytes than we have
+    if byte >= 0xC0:
+      if byte >= 0xF0:
+        length = 4
+      elif byte >= 0xE0:
+        length = 3
+      else:
+        length = 2
+
+      if length > offset:
+        return data[:-offset]
+
+      return data
+
+  # Only continuation bytes: not UTF-8, leave it be
+  return data
+
+
+def TrimUtf8Start(data):
+  """Returns string, data without the continuation bytes of a UTF-8 character cut off at its start"""
+  offset = 0
+  while offset < min(len(data), UTF8_MAX_LENGTH - 1) and 0x80 <= ord(data[offset]) < 0xC0:
+    offset += 1
+
+  return data[offset:]
+
+
+def CreateCapture(name, run_item, spool_dir=None):
+  """Returns StreamCapture, configured from the run item output options.
+
+  Args:
+    name: string, stream name (stdout, stderr)
+    run_item: dict, run item from the job spec
+    spool_dir: string (optional), directory for spool files, defaults to the temp directory
+  """
+  head_size = run_item.get('output head size', None)
+  if head_size is None:
+    head_size = HEAD_SIZE
+
+  tail_size = run_item.get('output tail size', None)
+  if tail_size is None:
+    tail_size = TAIL_SIZE
+
+  # If we want the full stream, make a spool file for it
+  spool_path = None
+  if run_item.get('output spool', False):
+    if not spool_dir:
+      spool_dir = tempfile.gettempdir()
+
+    (spool_fd, spool_path) = tempfile.mkstemp(prefix='runman_', suffix='.%s' % name, dir=spool_dir)
+    os.close(spool_fd)
+
+  return StreamCapture(name, head_size=int(head_size), tail_size=int(tail_size), spool_path=spool_path)
+
+
+def DrainPipe(pipe_file, capture):
+  """Read pipe_file until EOF, writing into capture.  Runs in its own thread."""
+  fd = pipe_file.fileno()
+
+  try:
+    while True:
+      data = os.read(fd, CHUNK_SIZE)
+      if not data:
+        break
+
+      capture.Write(data)
+
+  finally:
+    pipe_file.close()
+    capture.Close()
+
+
+def DrainProcess(pipe, stdout_capture, stderr_capture):
+  """Drain the stdout and stderr of a subprocess.Popen concurrently, then wait for it.  Returns int, exit code."""
+  threads = []
+  for (pipe_file, capture) in ((pipe.stdout, stdout_capture), (pipe.stderr, stderr_capture)):
+    thread = threading.Thread(target=DrainPipe, args=(pipe_file, capture))
+    thread.daemon = True
+    thread.start()
+    threads.append(thread)
+
+  for thread in threads:
+    thread.join()
+
+  return pipe.wait()
@@ -3,24 +3,38 @@ RunMan Client: Run forever processing server requests
 """
 
 
-import yaml
-import urllib2
-import urllib
-import base64
 import json
-import hashlib
 import time
 import signal
 import sys
+import threading
 
 from log import log
 from error import Error
 
 import run
 import platform
+import specs
+import digest
+import transport
+import reporter
+import progress
+import metrics
+from pool import WorkerPool
+from scheduler import Scheduler
+from scheduler import DEPENDENCY_TIMEOUT
 
 
-# Loop for second before checking again
+# Adaptive polling, when the server doesnt long-poll: seconds between polls starts at the minimum when there is work,
+#   and backs off (multiplied each idle poll) to the maximum while idle
+POLL_DELAY_MIN = 0.5
+POLL_DELAY_MAX = 30.0
+POLL_BACKOFF = 2.0
+
+# Long-poll: seconds the server may hold our job_get request open waiting for work, if the websource doesnt specify "long poll"
+LONG_POLL_WAIT = 30.0
+
+# Seconds to wait for all workers to be busy before checking if we are still running
 LOOP_DELAY = 10.0
 
 # Default to running, SIGKILL changes that
@@ -32,6 +46,20 @@ MAX_CONSECUTIVE_ERRORS = 5
 # Seconds to wait after a consecutive processing error (more than 1 error in a row)
 CONSECUTIVE_ERROR_WAIT = 5.0
 
+# Jobs to run at once on this host, if the run spec doesnt specify "client concurrency"
+CLIENT_CONCURRENCY = 1
+
+# Client metrics, served on the run spec "metrics port" and written to "metrics path" (see metrics.py)
+JOBS_TOTAL = metrics.GetCounter('runman_jobs_total', 'Jobs run, by result: success, failure')
+JOBS_REJECTED = metrics.GetCounter('runman_jobs_rejected_total', 'Job requests not run, by reason: unknown_job, spec_error, digest_mismatch')
+JOBS_RECEIVED = metrics.GetCounter('runman_jobs_received_total', 'Job requests received from the server')
+JOBS_RUNNING = metrics.GetGauge('runman_jobs_running', 'Jobs running now')
+JOB_SECONDS = metrics.GetHistogram('runman_job_seconds', 'Seconds to process each job request, from verifying it to spooling its report')
+POLL_SECONDS = metrics.GetHistogram('runman_poll_seconds', 'Seconds for each job_get request, including any time a long-poll server held it')
+POLL_ERRORS = metrics.GetCounter('runman_poll_errors_total', 'Main loop errors')
+REPORTS_PENDING = metrics.GetGauge('runman_reports_pending', 'Job reports spooled and not yet sent')
+WORKERS = metrics.GetGauge('runman_workers', 'Jobs this client may run at once')
+
 
 def SignalHandler_Quit(signum, frame):
   """Quit during a safe time after receiving a quit signal."""
@@ -41,119 +69,170 @@ def SignalHandler_Quit(signum, frame):
   RUNNING = False
 
 
+def GetConcurrency(run_spec, hostname):
+  """Returns int, the number of jobs this host may run at once.
+  
+  The run spec "client concurrency" is either an int for all hosts, or a dict of hostname to int, with an optional "default".
+  """
+  concurrency = run_spec.get('client concurrency', CLIENT_CONCURRENCY)
+  
+  # Per-host dict
+  if type(concurrency) == dict:
+    concurrency = concurrency.get(hostname, concurrency.get('default', CLIENT_CONCURRENCY))
+  
+  return max(1, int(concurrency))
+
+
 def ProcessRequestsForever(run_spec, command_options, command_args):
   global RUNNING
   
-  log('Running forever in Client Mode... (%s) [%s]' % (platform.GetHostname(), platform.GetPlatform()))
+  hostname = platform.GetHostname()
+  concurrency = GetConcurrency(run_spec, hostname)
+  
+  log('Running forever in Client Mode... (%s) [%s] (concurrency: %s)' % (hostname, platform.GetPlatform(), concurrency))
+  
+  # Export our metrics, if the run spec wants them
+  WORKERS.Set(concurrency)
+  StartMetrics(run_spec)
 
   # Get the Web Source we load and report our jobs to and from  
-  websource = yaml.load(open(run_spec['websource']))
+  websource = specs.Load(run_spec['websource'])
   
   # Create data to pass to the web request
-  job_get_data = {'hostname':platform.GetHostname()}
+  job_get_data = {'hostname':hostname}
+  
+  # Results are spooled and sent in the background, so reporting never holds up running jobs.  Unsent reports from a
+  #   previous run are sent first.
+  job_reporter = reporter.Reporter(websource['job_report'], run_spec.get('report spool path', None) or reporter.SPOOL_PATH)
+  
+  # Workers run the jobs, and report each one as it finishes.  Track what they are running, so we dont start a job twice.
+  pool = WorkerPool(concurrency, name='job')
+  running_job_ids = set()
+  running_lock = threading.Lock()
   
+  # When finished, the job is no longer running, and anything depending on it may now be dispatched
+  def JobFinished(result, error, job_id):
+    running_lock.acquire()
+    try:
+      running_job_ids.discard(job_id)
+    finally:
+      running_lock.release()
+    
+    JOBS_RUNNING.Increment(amount=-1)
+    
+    scheduler.Complete(job_id, error == None and result == True)
+  
+  # Dispatch a job request to the workers, as soon as the scheduler finds it runnable
+  def DispatchJob(job_request):
+    JOBS_RUNNING.Increment()
+    pool.Submit(ProcessJobRequest, (run_spec, websource, job_reporter, command_options, job_request),
+                callback=lambda result, error: JobFinished(result, error, job_request['id']))
+  
+  # Job request can never run, report its failure
+  def FailJob(job_request, reason):
+    job_reporter.Report(job_request['id'], json.dumps({'success':False, 'error':reason}))
+    
+    running_lock.acquire()
+    try:
+      running_job_ids.discard(job_request['id'])
+    finally:
+      running_lock.release()
+  
+  # Job instances wait in the scheduler for their "start at" time and "job dependencies"
+  scheduler = Scheduler(DispatchJob, FailJob, run_spec.get('dependency timeout', None) or DEPENDENCY_TIMEOUT)
+  
+  # Ask the server to long-poll: hold our request until it has work for us.  Servers that dont support it ignore "wait".
+  long_poll_wait = websource['job_get'].get('long poll', LONG_POLL_WAIT)
+  job_get_websource = dict(websource['job_get'])
+  if long_poll_wait:
+    job_get_data['wait'] = long_poll_wait
+    
+    # The request must not time out while the server holds it
+    job_get_websource['timeout'] = max(job_get_websource.get('timeout', None) or transport.TIMEOUT, long_poll_wait + transport.TIMEOUT)
+  
+  poll_delay = POLL_DELAY_MIN
   consecutive_errors = 0
   
   # Run forever, until we quit
   while RUNNING:
     try:
-      # Get the jobs the server has for us
-      result = WebGet(websource['job_get'], job_get_data)
-      server_result = json.loads(result)
-      jobs = json.loads(server_result['jobs'])
+      # Dont ask for more jobs than we have free workers to run
+      job_get_data['limit'] = pool.Free()
       
-      # Loop over the jobs the server gave us
-      for job_request in jobs:
-        log('Processing job request: %s: %s' % (job_request['id'], job_request['job_key']))
-        # Load Selected job
-        fp = open(run_spec['jobs'][job_request['job_key']])
-        job = yaml.load(fp)
-        fp.close()
-        
-        # Create an MD5 digest of it
-        #print job_spec
-        #NOTE(g): Using the above JSON dump allows us to test the data, ignoring comments (stripped in YAML load), and any reording
-        #   of keys (sort_keys).  This produces a more stable md5 digest than a strict text file eval, and also allows working with
-        #   already loaded data.
-        job_json = json.dumps(job, sort_keys=True)
-        job_json_md5 = hashlib.md5(job_json).hexdigest()
-        
-        
-        
-        
-        #TODO ---->  Switch this to receiving the job data from the server, and not having local data, because we are taking it
-        #   in snippets.  No double verification, but no having to sync all the time either....
-        pass
+      # Get the jobs the server has for us.  A long-poll server holds the request until it has work, or the wait expires.
+      poll_started = time.time()
+      result = WebGet(job_get_websource, job_get_data)
+      POLL_SECONDS.Observe(time.time() - poll_started)
       
+      server_result = json.loads(result)
+      jobs = json.loads(server_result['jobs'])
+      JOBS_RECEIVED.Increment(amount=len(jobs))
+      REPORTS_PENDING.Set(job_reporter.Pending())
       
+      # Dependencies the server knows have completed elsewhere (other hosts)
+      for job_id in server_result.get('completed_jobs', []):
+        scheduler.Complete(job_id, True)
+      for job_id in server_result.get('failed_jobs', []):
+        scheduler.Complete(job_id, False)
       
+      # Digest all the job specs for this batch of jobs at once, each spec version is only digested once
+      job_spec_paths = [run_spec['jobs'][job_request['job_key']] for job_request in jobs if job_request['job_key'] in run_spec['jobs']]
+      job_digest_errors = {}
+      job_digests = digest.GetDigests(job_spec_paths, job_digest_errors)
       
-        
-        # Compare local client and remote server md5 digests of this Job
-        #NOTE(g): Using the above JSON dump allows us to test the data, ignoring comments (stripped in YAML load), and any reording
-        #   of keys (sort_keys).  This produces a more stable md5 digest than a strict text file eval, and also allows working with
-        #   already loaded data.
-        if job_json_md5 == job_request['job_data_server_md5_digest']:
-          log('Matched MD5 digests: (client) %s == %s (server)' % (job_json_md5, job_request['job_data_server_md5_digest']))
-          
-        # Else, failed to match MD5 digest of data
-        else:
-          log('ERROR: Failed to match MD5 digests, skipping: (client) %s != %s (server)' % (job_json_md5, job_request['job_data_server_md5_digest']))
-          
-          # Report the changes
-          report_result = WebGet(websource['job_report'], {'id':job_request['id'], 'data':json.dumps({'job_data_remote_md5_digest':job_json_md5})})
-          log('Report Result: %s' % report_result)
-          
-          # Skip this one until it's MD5 issues are corrected
+      # Loop over the jobs the server gave us, scheduling each one to run
+      for job_request in jobs:
+        # Verify we have the same job spec as the server, or report and skip it
+        if not VerifyJobDigest(run_spec, job_reporter, job_request, job_digests, job_digest_errors):
           continue
         
-        import pprint
-        input_data = json.loads(job_request['input_data_json'])
-        pprint.pprint(input_data)
-        
-        print job_request['job_key']
-        
-        
-        
-        
-        
-        
-        
-        # Run the job
-        #TODO(g): Run a job item, not the full Job...  Get the input data for the job from WebGet...
-        #
-        #   Should report on ongoing processing, and then finally when finished...
-        #
-        run_result = run.Run(run_spec, command_options, [job_request['job_key']], input_data=input_data)
-        
-        
-        
-        
-        
-        
-        pprint.pprint(run_result)
-        
-        # Add in the local MD5 digest
-        run_result['job_data_remote_md5_digest'] = job_json_md5
-        run_result['result_data_json'] = json.dumps(run_result, sort_keys=True)
-        
-        run_result_json = json.dumps(run_result)
-        
-        # Report the results
-        report_result = WebGet(websource['job_report'], {'id':job_request['id'], 'data':run_result_json})
-        log('Report Result: %s' % report_result)
+        schedule_error = None
+        running_lock.acquire()
+        try:
+          if job_request['id'] in running_job_ids:
+            continue
+          
+          #NOTE(g): Tracked while we hold the lock, so it cant finish before we track it
+          try:
+            scheduler.Add(job_request)
+            running_job_ids.add(job_request['id'])
+          except Exception, e:
+            schedule_error = str(e)
+        finally:
+          running_lock.release()
         
+        # Cant be scheduled (ex: bad "start at"), report it and carry on with the rest of the batch
+        if schedule_error:
+          log('Failed to schedule job instance: %s: %s' % (job_request['id'], schedule_error))
+          FailJob(job_request, schedule_error)
+          scheduler.Complete(job_request['id'], False)
       
       # Sleep - Give back to the system, if we are going to keep running (otherwise, quit faster)
-      #log('Sleeping... (%s seconds)' % LOOP_DELAY)
       if RUNNING:
-        time.sleep(LOOP_DELAY)
+        # Long-poll server: it already waited for work, so ask again right away
+        if server_result.get('long_poll', False):
+          poll_delay = POLL_DELAY_MIN
+        
+        # Adaptive polling: tighten while work is flowing, back off while idle
+        else:
+          if jobs:
+            poll_delay = POLL_DELAY_MIN
+          else:
+            poll_delay = min(POLL_DELAY_MAX, poll_delay * POLL_BACKOFF)
+          
+          #log('Sleeping... (%s seconds)' % poll_delay)
+          time.sleep(poll_delay)
+        
+        # If all our workers are busy, there is no point asking for more jobs
+        while RUNNING and pool.WaitForFree(LOOP_DELAY) == 0:
+          pass
         
         # Clear any consecutive errors, we made it to the end of processing
         consecutive_errors = 0
     
     except Exception, e:
       log('Main loop exception:\n\n%s' % e)
+      POLL_ERRORS.Increment()
       consecutive_errors += 1
       
       # Reaches max?  Quit
@@ -164,35 +243,159 @@ def ProcessRequestsForever(run_spec, command_options, command_args):
       # Else, if we have had 2 errors in a row, sleep for a back-off time
       elif consecutive_errors >= 2:
         log('Sleeping for consecutive error backoff: %s seconds' % CONSECUTIVE_ERROR_WAIT)
-        time.wait(CONSECUTIVE_ERROR_WAIT)
-    
+        time.sleep(CONSECUTIVE_ERROR_WAIT)
+  
+  # Let any running jobs finish and report before we quit
+  log('Waiting for running jobs to finish: %s' % len(running_job_ids))
+  scheduler.Stop()
+  pool.Stop()
+  job_reporter.Stop()
+  
+  # Last word on what we did
+  if run_spec.get('metrics path', None):
+    metrics.WriteFile(run_spec['metrics path'])
 
-def WebGet(websource, args=None):
-  """Wrap dealing with web requests.  The job server uses this to avoid giving out database credentials to all machines."""
-  #log('WebGet: %s' % websource)
-  try:
-    http_request = urllib2.Request(websource['url'])
+
+def StartMetrics(run_spec):
+  """Serve metrics on the run spec "metrics port" (on "metrics host", default localhost), and write them to
+  "metrics path" every "metrics interval" seconds, if the run spec specifies them
+  """
+  if run_spec.get('metrics port', None):
+    metrics_host = run_spec.get('metrics host', None) or 'localhost'
+    metrics.StartServer(int(run_spec['metrics port']), metrics_host)
+    log('Serving metrics: http://%s:%s/metrics' % (metrics_host, run_spec['metrics port']))
   
-    # If Authorization
-    if websource.get('username', None):
-      auth = base64.standard_b64encode('%s:%s' % (websource['username'], websource['password'])).replace('\n', '')
-      http_request.add_header("Authorization", "Basic %s" % auth)
+  if run_spec.get('metrics path', None):
+    metrics.StartFileWriter(run_spec['metrics path'], run_spec.get('metrics interval', None) or metrics.FILE_INTERVAL)
+    log('Writing metrics: %s' % run_spec['metrics path'])
+
+
+def VerifyJobDigest(run_spec, job_reporter, job_request, job_digests, job_digest_errors=None):
+  """Returns boolean, True if our job spec digest matches the server's.  Reports why not to the server.
+  
+  Args:
+    job_digests: dict, job spec path: digest (from digest.GetDigests)
+    job_digest_errors: dict (optional), job spec path: error text, for specs that failed to load (from digest.GetDigests)
+  """
+  # Unknown job, we cant run it
+  if job_request['job_key'] not in run_spec['jobs']:
+    log('Unknown job key, skipping: %s: %s' % (job_request['id'], job_request['job_key']), level='error')
+    JOBS_REJECTED.Increment({'reason':'unknown_job'})
+    job_reporter.Report(job_request['id'], json.dumps({'success':False, 'error':'Unknown job key: %s' % job_request['job_key']}))
+    return False
+  
+  job_spec_path = run_spec['jobs'][job_request['job_key']]
+  job_json_md5 = job_digests.get(job_spec_path, None)
+  
+  # Failed to load the job spec
+  if job_json_md5 == None:
+    error = (job_digest_errors or {}).get(job_spec_path, None) or 'Unknown error'
+    log('Failed to load job spec, skipping: %s: %s: %s' % (job_request['id'], job_spec_path, error), level='error')
+    JOBS_REJECTED.Increment({'reason':'spec_error'})
+    job_reporter.Report(job_request['id'], json.dumps({'success':False, 'error':'Failed to load job spec: %s: %s' % (job_spec_path, error)}))
+    return False
+  
+  # Compare local client and remote server md5 digests of this Job
+  #NOTE(g): Using a JSON dump of the data allows us to test the data, ignoring comments (stripped in YAML load), and any
+  #   reording of keys (sort_keys).  This produces a more stable md5 digest than a strict text file eval, and also allows
+  #   working with already loaded data.
+  if job_json_md5 == job_request['job_data_server_md5_digest']:
+    log('Matched MD5 digests: (client) %s == %s (server)' % (job_json_md5, job_request['job_data_server_md5_digest']), level='debug')
+    return True
+    
+  # Else, failed to match MD5 digest of data
+  else:
+    log('Failed to match MD5 digests, skipping: (client) %s != %s (server)' % (job_json_md5, job_request['job_data_server_md5_digest']), level='error')
+    JOBS_REJECTED.Increment({'reason':'digest_mismatch'})
     
+    # Report the changes
+    job_reporter.Report(job_request['id'], json.dumps({'job_data_remote_md5_digest':job_json_md5}))
     
-    # If args (POST)
-    if args:
-      http_request.add_data(urllib.urlencode(args))
+    # Skip this one until it's MD5 issues are corrected
+    return False
+
+
+def ProcessJobRequest(run_spec, websource, job_reporter, command_options, job_request):
+  """Run a single job request from the server, and report its result.  Runs in a worker thread.
+  
+  Returns boolean, True if the job ran successfully.
+  """
+  started = time.time()
+  
+  success = HandleJobRequest(run_spec, websource, job_reporter, command_options, job_request)
+  
+  JOB_SECONDS.Observe(time.time() - started)
+  JOBS_TOTAL.Increment({'result':'success' if success else 'failure'})
+  
+  return success
+
+
+def HandleJobRequest(run_spec, websource, job_reporter, command_options, job_request):
+  """Process a job request for ProcessJobRequest(), which counts and times it.  Returns boolean, True if the job ran successfully."""
+  log('Processing job request: %s: %s' % (job_request['id'], job_request['job_key']))
   
+  # Check the job spec again, it may have changed while this job was scheduled
+  verify_span = metrics.StartSpan('verify')
+  job_digest_errors = {}
+  job_digests = digest.GetDigests([run_spec['jobs'][job_request['job_key']]], job_digest_errors)
+  verified = VerifyJobDigest(run_spec, job_reporter, job_request, job_digests, job_digest_errors)
+  verify_span.Finish()
   
-    result = urllib2.urlopen(http_request)
-    data = result.read()
+  if not verified:
+    return False
+  
+  job_json_md5 = job_request['job_data_server_md5_digest']
+  
+  #TODO ---->  Switch this to receiving the job data from the server, and not having local data, because we are taking it
+  #   in snippets.  No double verification, but no having to sync all the time either....
+  pass
+  
+  input_data = json.loads(job_request['input_data_json'])
+  log('Job Input Data: %s: %s' % (job_request['job_key'], input_data))
+  
+  # Report progress while the job runs (heartbeats and recent output), if the server takes it
+  job_progress = None
+  if websource.get('job_progress', None):
+    job_progress = progress.ProgressReporter(websource['job_progress'], job_request['id'])
+  
+  # Run the job
+  #TODO(g): Run a job item, not the full Job...  Get the input data for the job from WebGet...
+  #
+  #NOTE(g): Error() exits, which in a worker only ends this job.  Report it as a failure, so the server isnt left waiting.
+  try:
+    run_result = run.Run(run_spec, command_options, [job_request['job_key']], input_data=input_data, progress=job_progress)
+  except SystemExit, e:
+    run_result = {'success':False, 'error':'Job aborted with exit code: %s' % e.code}
+  except Exception, e:
+    run_result = {'success':False, 'error':'Job failed with exception: %s' % e}
+  
+  if job_progress:
+    job_progress.Stop()
+  
+  # Add in the local MD5 digest
+  run_result['job_data_remote_md5_digest'] = job_json_md5
+  run_result['result_data_json'] = json.dumps(run_result, sort_keys=True)
+  
+  # Report the results.  This only spools them, the reporter sends them.
+  report_span = metrics.StartSpan('report')
+  run_result_json = json.dumps(run_result)
+  job_reporter.Report(job_request['id'], run_result_json)
+  report_span.Finish()
+  
+  return run_result['success'] == True
     
-    return data
+
+def WebGet(websource, args=None):
+  """Wrap dealing with web requests.  The job server uses this to avoid giving out database credentials to all machines.
+  
+  Requests go over the shared keep-alive transport, which handles retries.
+  """
+  #log('WebGet: %s' % websource)
+  try:
+    return transport.TRANSPORT.Request(websource, args)
 
   except Exception, e:
     log('WebGet error: %s' % (e))
     
     # No jobs, just keep going, we logged the error (in JSON format)
     return """{"jobs":[]}"""
-
-
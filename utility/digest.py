@@ -0,0 +1,82 @@
+"""
+Digest: Canonical MD5 digests of spec files, computed once per file version
+
+The canonical digest is the MD5 of the spec data dumped as JSON with sorted keys.  This ignores comments (stripped in
+the YAML load) and any reordering of keys, so it is stable between the client and server.
+"""
+
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+import specs
+
+
+# Seconds to trust a cached digest without checking the file again
+CHECK_INTERVAL = 1.0
+
+# Cached digests: absolute path: (identity, checked_time, digest)
+DIGESTS = {}
+DIGESTS_LOCK = threading.Lock()
+
+
+def CanonicalDigest(data):
+  """Returns string, hex MD5 digest of data as sorted key JSON"""
+  return hashlib.md5(json.dumps(data, sort_keys=True)).hexdigest()
+
+
+def GetDigest(path):
+  """Returns string, canonical digest of the spec at path.  Raises the same errors as loading the spec."""
+  path = os.path.abspath(path)
+  now = time.time()
+
+  DIGESTS_LOCK.acquire()
+  try:
+    cached = DIGESTS.get(path, None)
+  finally:
+    DIGESTS_LOCK.release()
+
+  # Checked recently, no need to look at the file
+  if cached and now - cached[1] < CHECK_INTERVAL:
+    return cached[2]
+
+  # Same file version as we have a digest for: only the stat was needed
+  if cached and specs.GetIdentity(path) == cached[0]:
+    digest = cached[2]
+    identity = cached[0]
+
+  # Changed, or new: digest it
+  else:
+    (identity, data) = specs.LoadWithIdentity(path)
+    digest = CanonicalDigest(data)
+
+  DIGESTS_LOCK.acquire()
+  try:
+    DIGESTS[path] = (identity, now, digest)
+  finally:
+    DIGESTS_LOCK.release()
+
+  return digest
+
+
+def GetDigests(paths, errors=None):
+  """Returns dict of path: digest, for many spec paths at once.  Each unique path is checked once.
+
+  Paths that cannot be loaded have None for their digest, and are logged by the caller.
+
+  Args:
+    errors: dict (optional), filled with path: error text, for the paths that cannot be loaded
+  """
+  digests = {}
+  for path in set(paths):
+    try:
+      digests[path] = GetDigest(path)
+    except Exception, e:
+      digests[path] = None
+      if errors != None:
+        errors[path] = '%s: %s' % (type(e).__name__, e)
+
+  return digests
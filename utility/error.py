@@ -5,6 +5,8 @@ Error Reporting
 
 import sys
 
+import log
+
 
 def Error(text, options, exit_code=1):
   """Fail with an error. Options are required to deliver proper output."""
@@ -13,6 +15,9 @@ def Error(text, options, exit_code=1):
   ## Format errors and output them, in the specified fashion
   #format.FormatAndOuput(output, options)
 
+  # Anything logged before this goes out first
+  log.Flush()
+
   sys.stderr.write('ERROR: %s\n' % text)
   
   #TODO(g): Clean-up work we have done so far, so this system is not left in
@@ -0,0 +1,213 @@
+"""
+Facts: Details of this host, gathered once and cached
+
+Facts are kept in memory for the process, and on disk for FACTS_TTL seconds so new processes do not gather them again.
+The disk cache is ignored if the hostname has changed since it was written.
+
+Facts:
+  hostname        Short hostname
+  hostname_full   Hostname as the system has it (may be fully qualified)
+  platform        RunMan platform (see platform.DetectPlatform), None if it could not be determined
+  os_id           /etc/os-release ID (ex: rhel, debian, ubuntu)
+  os_version      /etc/os-release VERSION_ID
+  os_like         /etc/os-release ID_LIKE, list
+  kernel          Kernel release
+  machine         Machine hardware name (ex: x86_64)
+  cpu_count       Number of CPUs
+  memory_total    Bytes of memory, None if unknown
+
+Job spec input keys can default to a fact, with "fact: <name>".  See ApplyInputDefaults().
+"""
+
+
+import os
+import json
+import time
+import socket
+import tempfile
+import threading
+
+import platform
+
+
+# Path to the disk cache of facts.  None or False disables it.  Set from the run spec "facts path".
+FACTS_PATH = os.path.join(os.path.expanduser('~'), '.runman', 'facts.json')
+
+# Seconds the disk cache is good for.  Set from the run spec "facts ttl".
+FACTS_TTL = 3600
+
+# Where the OS describes itself
+OS_RELEASE_PATH = '/etc/os-release'
+MEMINFO_PATH = '/proc/meminfo'
+
+# Facts for this process, once gathered
+FACTS = None
+FACTS_LOCK = threading.Lock()
+
+# Facts set for this process (ex: hostname, from --override-host): name: value.  They replace gathered facts in
+#   GetFacts(), and are never saved to the disk cache.  Set them before the first GetFacts().
+OVERRIDES = {}
+
+
+def ReadOsRelease(path=OS_RELEASE_PATH):
+  """Returns dict, KEY: value from an os-release file.  Empty if there is no file."""
+  os_release = {}
+
+  try:
+    fp = open(path)
+  except IOError:
+    return os_release
+
+  try:
+    for line in fp:
+      line = line.strip()
+      if not line or line.startswith('#') or '=' not in line:
+        continue
+
+      (key, value) = line.split('=', 1)
+      os_release[key] = value.strip('"\'')
+  finally:
+    fp.close()
+
+  return os_release
+
+
+def GetMemoryTotal(path=MEMINFO_PATH):
+  """Returns int, bytes of memory, or None if unknown"""
+  try:
+    fp = open(path)
+  except IOError:
+    return None
+
+  try:
+    for line in fp:
+      if line.startswith('MemTotal:'):
+        # MemTotal:        6147400 kB
+        return int(line.split()[1]) * 1024
+  finally:
+    fp.close()
+
+  return None
+
+
+def GatherFacts():
+  """Returns dict, facts about this host, gathered now"""
+  hostname_full = socket.gethostname()
+  os_release = ReadOsRelease()
+  uname = os.uname()
+
+  facts = {}
+  facts['hostname'] = hostname_full.split('.')[0]
+  facts['hostname_full'] = hostname_full
+  facts['os_id'] = os_release.get('ID', None)
+  facts['os_version'] = os_release.get('VERSION_ID', None)
+  facts['os_like'] = os_release.get('ID_LIKE', '').split()
+  facts['kernel'] = uname[2]
+  facts['machine'] = uname[4]
+  facts['memory_total'] = GetMemoryTotal()
+
+  # Only imported when gathering, most processes get their facts from the disk cache
+  import multiprocessing
+  try:
+    facts['cpu_count'] = multiprocessing.cpu_count()
+  except NotImplementedError:
+    facts['cpu_count'] = None
+
+  # Keep going if we dont know the platform, only running a job needs it
+  try:
+    facts['platform'] = platform.DetectPlatform(os_release)
+  except platform.PlatformNotFound, e:
+    facts['platform'] = None
+    facts['platform_error'] = str(e)
+
+  return facts
+
+
+def LoadFactsFile():
+  """Returns dict, facts from the disk cache, or None if it is missing, expired or for another host"""
+  if not FACTS_PATH:
+    return None
+
+  try:
+    fp = open(FACTS_PATH)
+  except IOError:
+    return None
+
+  try:
+    try:
+      (gathered, facts) = json.load(fp)
+    except Exception:
+      return None
+  finally:
+    fp.close()
+
+  if time.time() - gathered > FACTS_TTL or facts.get('hostname_full', None) != socket.gethostname():
+    return None
+
+  return facts
+
+
+def SaveFactsFile(facts):
+  """Save facts to the disk cache.  Failures only cost us gathering them again."""
+  if not FACTS_PATH:
+    return
+
+  try:
+    facts_dir = os.path.dirname(FACTS_PATH)
+    if not os.path.isdir(facts_dir):
+      os.makedirs(facts_dir, 0700)
+
+    # Write and rename, so other processes never read a partial file
+    (fd, temp_path) = tempfile.mkstemp(dir=facts_dir, prefix='.facts_')
+    fp = os.fdopen(fd, 'w')
+    try:
+      json.dump((time.time(), facts), fp)
+    finally:
+      fp.close()
+
+    os.rename(temp_path, FACTS_PATH)
+
+  except (IOError, OSError):
+    pass
+
+
+def GetFacts():
+  """Returns dict, facts about this host.  Gathered once, cached in memory and on disk.
+
+  NOTE: The facts are shared between callers.  Do not modify them, copy them first.
+  """
+  global FACTS
+
+  FACTS_LOCK.acquire()
+  try:
+    if FACTS == None:
+      facts = LoadFactsFile()
+      if facts == None:
+        facts = GatherFacts()
+        SaveFactsFile(facts)
+
+      if OVERRIDES:
+        facts = dict(facts)
+        facts.update(OVERRIDES)
+
+      FACTS = facts
+
+    return FACTS
+  finally:
+    FACTS_LOCK.release()
+
+
+def ApplyInputDefaults(job_spec, input_data):
+  """Returns dict, input_data with any input keys the job spec defaults from facts ("fact: <name>") added if missing"""
+  defaults = {}
+  for (key, input_validation) in (job_spec.get('input', None) or {}).items():
+    if key not in input_data and input_validation and input_validation.get('fact', None):
+      fact = GetFacts().get(input_validation['fact'], None)
+      if fact != None:
+        defaults[key] = fact
+
+  if not defaults:
+    return input_data
+
+  defaults.update(input_data)
+  return defaults
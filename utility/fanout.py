@@ -0,0 +1,471 @@
+"""
+Fan-out: Run a job on many hosts, through a transport
+
+Each host runs the job with its own runman (the run spec "fanout command"), so it uses its own platform, facts and job
+specs.  The input data is collected and validated once, here, and sent to every host on the command's STDIN as JSON.
+Input keys that default to host facts ("fact: <name>") are not defaulted here, so each host uses its own facts.  The
+command writes its result as JSON, which we collect per host.
+
+Hosts run with bounded parallelism (--concurrency, or the run spec "fanout concurrency").  With rolling batches
+(--rolling <size>), each batch of hosts finishes before the next one starts.  With an abort threshold
+(--max-failures <count|percent>), no more hosts are started once more hosts than that have failed; hosts already
+running finish, and the rest are skipped.
+
+Transports start the process for a host:
+  ssh     ssh <host> <command>, in batch mode (no password prompts).  Extra arguments from "fanout ssh options".
+  local   /bin/sh -c <command> on this machine, as if it were the host (--override-host).  For testing.
+
+Hosts (--hosts) are comma separated:
+  web1.example.com            A host
+  web[01-20].example.com      A range of hosts, zero padding is kept
+  @hosts.txt                  Hosts in a file, one per line.  Blank lines and # comments are ignored.
+  web*                        Hosts in the run spec "hosts" matching the glob pattern
+"""
+
+
+import re
+import json
+import time
+import Queue
+import decimal
+import pipes
+import fnmatch
+import threading
+import subprocess
+
+from log import log
+from error import Error
+
+import run
+import plan
+import pool
+
+
+# Hosts to run on at once, if neither the command options nor the run spec "fanout concurrency" say
+FANOUT_CONCURRENCY = 10
+
+# Transport, if the command options and run spec "fanout transport" dont say
+FANOUT_TRANSPORT = 'ssh'
+
+# Command each host runs the job with, if the run spec doesnt specify "fanout command".  Values are shell quoted.
+#   host: the host, run_spec: the run spec path on the host ("fanout run spec", default ours), job: the job key
+FANOUT_COMMAND = 'runman -n -f json -i - --override-host %(host)s %(run_spec)s run %(job)s'
+
+# Seconds a host may take, if the run spec doesnt specify "fanout timeout"
+FANOUT_TIMEOUT = 3600.0
+
+# SSH: seconds to connect
+SSH_CONNECT_TIMEOUT = 10
+
+# Bytes of each host's STDERR kept in its result
+STDERR_TAIL = 4096
+
+# Host ranges: web[01-20]
+HOST_RANGE_REGEX = re.compile(r'\[(\d+)-(\d+)\]')
+
+
+class FanoutError(Exception):
+  """Fan-out could not be set up: bad hosts, transport or options"""
+
+
+class Transport(object):
+  """Runs a command for a host, with text on its STDIN.  Transports differ in the process they start for the host."""
+
+  def __init__(self, run_spec):
+    self.run_spec = run_spec
+
+
+  def GetArgs(self, host, command):
+    """Returns list of strings, the process arguments to run command for host"""
+    raise NotImplementedError()
+
+
+  def GetError(self, exit_code, stderr):
+    """Returns string, why the command failed, from its exit code and STDERR"""
+    # runman Error() writes "ERROR: ...", use the last
+    lines = [line for line in stderr.splitlines() if line.strip()]
+    errors = [line for line in lines if line.startswith('ERROR: ')]
+    if errors:
+      return errors[-1][len('ERROR: '):]
+    elif lines:
+      return lines[-1]
+    else:
+      return 'Exit code: %s' % exit_code
+
+
+  def Run(self, host, command, input_text=None, timeout=None):
+    """Returns (exit_code, stdout, stderr, timed_out).  Blocks until the command finishes, or is killed at timeout."""
+    process = subprocess.Popen(self.GetArgs(host, command), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, close_fds=True)
+
+    timed_out = []
+    def Kill():
+      timed_out.append(True)
+      try:
+        process.kill()
+      except OSError:
+        pass
+
+    timer = None
+    if timeout:
+      timer = threading.Timer(timeout, Kill)
+      timer.daemon = True
+      timer.start()
+
+    try:
+      (stdout, stderr) = process.communicate(input_text)
+    finally:
+      if timer:
+        timer.cancel()
+        timer.join()
+
+    return (process.returncode, stdout, stderr, bool(timed_out))
+
+
+class LocalTransport(Transport):
+  """Runs the command on this machine.  With --override-host in the command, it runs as if it were the host."""
+
+  def GetArgs(self, host, command):
+    return ['/bin/sh', '-c', command]
+
+
+class SshTransport(Transport):
+  """Runs the command on the host over SSH"""
+
+  def GetArgs(self, host, command):
+    args = ['ssh', '-o', 'BatchMode=yes', '-o', 'ConnectTimeout=%s' % SSH_CONNECT_TIMEOUT]
+    args += [str(arg) for arg in self.run_spec.get('fanout ssh options', None) or []]
+    args += [host, command]
+    return args
+
+
+  def GetError(self, exit_code, stderr):
+    # ssh exits 255 for its own errors, the command never ran
+    if exit_code == 255:
+      return 'SSH failed: %s' % (stderr.strip().splitlines() or ['Exit code 255'])[-1]
+
+    return Transport.GetError(self, exit_code, stderr)
+
+
+# Transports by name.  Add a Transport subclass here to make it available.
+TRANSPORTS = {
+  'local':LocalTransport,
+  'ssh':SshTransport,
+}
+
+
+def GetTransport(run_spec, command_options):
+  """Returns Transport, from the command options "transport", or the run spec "fanout transport" """
+  name = command_options.get('transport', None) or run_spec.get('fanout transport', None) or FANOUT_TRANSPORT
+
+  if name not in TRANSPORTS:
+    raise FanoutError('Unknown transport "%s", transports: %s' % (name, ', '.join(sorted(TRANSPORTS))))
+
+  return TRANSPORTS[name](run_spec)
+
+
+def GetConcurrency(run_spec, command_options):
+  """Returns int, hosts to run on at once"""
+  if command_options.get('concurrency', None):
+    return int(command_options['concurrency'])
+
+  return int(run_spec.get('fanout concurrency', FANOUT_CONCURRENCY))
+
+
+def ExpandHosts(hosts_text, inventory=None):
+  """Returns list of strings, the hosts in hosts_text, in order, without duplicates.  See the module docs for the syntax.
+
+  Args:
+    hosts_text: string, comma separated hosts, ranges, @files and glob patterns
+    inventory: list of strings (optional), hosts that glob patterns match (the run spec "hosts")
+  """
+  hosts = []
+  for item in hosts_text.split(','):
+    item = item.strip()
+    if not item:
+      continue
+
+    # File of hosts
+    if item.startswith('@'):
+      try:
+        lines = open(item[1:]).read().splitlines()
+      except IOError, e:
+        raise FanoutError('Could not read hosts file: %s: %s' % (item[1:], e))
+
+      lines = [line.split('#', 1)[0].strip() for line in lines]
+      hosts += ExpandHosts(','.join([line for line in lines if line]), inventory)
+
+    # Glob pattern, against the inventory
+    elif [character for character in '*?' if character in item]:
+      matched = fnmatch.filter(inventory or [], item)
+      if not matched:
+        raise FanoutError('Host pattern matched no hosts in the run spec "hosts": %s' % item)
+      hosts += matched
+
+    # Range, possibly more than one
+    elif HOST_RANGE_REGEX.search(item):
+      hosts += ExpandHostRange(item)
+
+    else:
+      hosts.append(item)
+
+  # Each host once, first mention wins
+  seen = set()
+  unique_hosts = []
+  for host in hosts:
+    if host not in seen:
+      seen.add(host)
+      unique_hosts.append(host)
+
+  return unique_hosts
+
+
+def ExpandHostRange(item):
+  """Returns list of strings, hosts of the first range in item, and any ranges after it.  web[01-03] -> web01, web02, web03"""
+  match = HOST_RANGE_REGEX.search(item)
+  if not match:
+    return [item]
+
+  (start_text, end_text) = match.groups()
+  (start, end) = (int(start_text), int(end_text))
+  if start > end:
+    raise FanoutError('Host range ends before it starts: %s' % item)
+
+  # Zero padded if the start is
+  width = len(start_text) if start_text.startswith('0') else 0
+
+  hosts = []
+  for number in range(start, end + 1):
+    hosts += ExpandHostRange(item[:match.start()] + str(number).zfill(width) + item[match.end():])
+
+  return hosts
+
+
+def GetMaxFailures(max_failures, host_count):
+  """Returns int, the most hosts that may fail before we abort, or None for no limit
+
+  Args:
+    max_failures: string, int, or None.  "<count>", or "<percent>%" of host_count.
+  """
+  if max_failures == None or max_failures == '':
+    return None
+
+  try:
+    if str(max_failures).endswith('%'):
+      return int(host_count * float(str(max_failures)[:-1]) / 100)
+    else:
+      return int(max_failures)
+
+  except ValueError:
+    raise FanoutError('Max failures must be a count, or a percent of hosts: %s' % max_failures)
+
+
+def GetCommand(run_spec, command_options, job_spec_key, host):
+  """Returns string, the command host runs the job with"""
+  remote_run_spec = run_spec.get('fanout run spec', None) or command_options.get('run_spec_path', None)
+  if not remote_run_spec:
+    raise FanoutError('No run spec path for hosts to run with, set the run spec "fanout run spec"')
+
+  values = {'host':host, 'run_spec':remote_run_spec, 'job':job_spec_key}
+  quoted = dict([(key, pipes.quote(str(value))) for (key, value) in values.items()])
+
+  return (run_spec.get('fanout command', None) or FANOUT_COMMAND) % quoted
+
+
+def RetrieveInputData(run_spec, command_options, command_args):
+  """Returns dict, the job's input data, collected and validated once for every host.  Call before writing output,
+  as it may prompt for input.  Input keys that default to host facts are left out, unless given.
+  """
+  if len(command_args) < 1:
+    Error('Missing job spec name to run', command_options)
+
+  job_spec_key = command_args[0]
+  if job_spec_key not in run_spec['jobs']:
+    Error('Missing job spec key in run spec: %s' % job_spec_key, command_options)
+
+  job_spec_path = run_spec['jobs'][job_spec_key]
+  try:
+    job_plan = plan.GetPlan(job_spec_path)
+  except Exception, e:
+    Error('Failed to load job spec: %s: %s' % (job_spec_path, e), command_options)
+
+  return run.RetrieveInputData(run_spec, job_plan.job_spec, job_spec_path, command_options, command_args,
+                               validator=job_plan.validator, apply_facts=False)
+
+
+def EncodeInputValue(value):
+  """Returns JSON encodable value, for validated input values JSON cannot encode.  Decimals are sent as their text,
+  so no precision is lost, and each host validates them back to Decimals.
+  """
+  if isinstance(value, decimal.Decimal):
+    return str(value)
+
+  raise TypeError('%r is not JSON serializable' % value)
+
+
+def RunHost(transport, host, command, input_text, timeout):
+  """Returns dict, the result of running the job on host: host, success, exit_code, started, finished, duration, and
+  result (the host's run result data) if it wrote one, or error
+  """
+  result = {'host':host, 'started':time.time()}
+
+  try:
+    (exit_code, stdout, stderr, timed_out) = transport.Run(host, command, input_text, timeout)
+  except OSError, e:
+    (exit_code, stdout, stderr, timed_out) = (None, '', '', False)
+    result['error'] = 'Transport failed to start: %s' % e
+
+  result['finished'] = time.time()
+  result['duration'] = result['finished'] - result['started']
+  result['exit_code'] = exit_code
+
+  # runman writes {"result": run result data}
+  try:
+    output = json.loads(stdout)
+    if isinstance(output, dict) and isinstance(output.get('result', None), dict):
+      result['result'] = output['result']
+  except ValueError:
+    pass
+
+  if timed_out:
+    result['error'] = 'Timed out after %s seconds' % timeout
+  elif exit_code != 0 and 'error' not in result:
+    result['error'] = transport.GetError(exit_code, stderr)
+  elif exit_code == 0 and 'result' not in result:
+    result['error'] = 'Host did not write a run result'
+
+  if stderr and 'error' in result:
+    result['stderr'] = stderr[-STDERR_TAIL:]
+
+  result['success'] = 'error' not in result and result['result'].get('success', None) == True
+
+  return result
+
+
+def RunFanout(run_spec, command_options, command_args, input_data, result_function):
+  """Run a job on every host in command_options "hosts".  Returns dict, summary of the fan-out.
+
+  Args:
+    input_data: dict, validated input data for the job (see RetrieveInputData())
+    result_function: function(host, dict), called with each host's result as it finishes, one call at a time (see RunHost())
+  """
+  job_spec_key = command_args[0]
+
+  try:
+    hosts = ExpandHosts(command_options['hosts'], run_spec.get('hosts', None))
+    transport = GetTransport(run_spec, command_options)
+    max_failures = GetMaxFailures(command_options.get('max_failures', None), len(hosts))
+    commands = dict([(host, GetCommand(run_spec, command_options, job_spec_key, host)) for host in hosts])
+  except FanoutError, e:
+    Error('Fan-out: %s' % e, command_options)
+
+  if not hosts:
+    Error('Fan-out: No hosts in: %s' % command_options['hosts'], command_options)
+
+  concurrency = GetConcurrency(run_spec, command_options)
+  batch_size = int(command_options.get('rolling', None) or len(hosts))
+  timeout = float(run_spec.get('fanout timeout', None) or FANOUT_TIMEOUT)
+  input_text = json.dumps(input_data, default=EncodeInputValue)
+
+  batches = [hosts[index:index + batch_size] for index in range(0, len(hosts), batch_size)]
+
+  summary = {'hosts':len(hosts), 'batches':len(batches), 'succeeded':0, 'failed':0, 'skipped':[], 'aborted':False,
+             'started':time.time()}
+
+  log('Fan-out: %s: %s host(s), %s batch(es), concurrency %s, max failures %s, transport %s' %
+      (job_spec_key, len(hosts), len(batches), concurrency, max_failures, transport.__class__.__name__))
+
+  started_hosts = set()
+  finished_queue = Queue.Queue()
+  worker_pool = pool.WorkerPool(min(concurrency, batch_size), name='fanout')
+  try:
+    for (batch_index, batch) in enumerate(batches):
+      if len(batches) > 1:
+        log('Fan-out: batch %s of %s: %s host(s)' % (batch_index + 1, len(batches), len(batch)))
+
+      pending = list(batch)
+      running = 0
+
+      while pending or running:
+        # Start hosts while we have workers, unless we have aborted
+        while pending and running < concurrency and not summary['aborted']:
+          host = pending.pop(0)
+          started_hosts.add(host)
+          running += 1
+          worker_pool.Submit(RunHost, (transport, host, commands[host], input_text, timeout),
+                             callback=lambda result, error, host=host: finished_queue.put((host, result, error)))
+
+        if not running:
+          break
+
+        (host, result, error) = finished_queue.get()
+        running -= 1
+
+        if error != None:
+          result = {'host':host, 'success':False, 'error':'Fan-out failed: %s: %s' % (type(error).__name__, error)}
+
+        if result['success']:
+          summary['succeeded'] += 1
+        else:
+          summary['failed'] += 1
+          log('Fan-out: host failed: %s: %s' % (host, result.get('error', 'Run failed')))
+
+          if max_failures != None and summary['failed'] > max_failures and not summary['aborted']:
+            log('Fan-out: more than %s host(s) failed, aborting' % max_failures, level='error')
+            summary['aborted'] = True
+
+        result_function(host, result)
+
+      if summary['aborted']:
+        break
+
+  finally:
+    worker_pool.Stop()
+
+  # Everything we never started
+  summary['skipped'] = [host for host in hosts if host not in started_hosts]
+
+  summary['finished'] = time.time()
+  summary['duration'] = summary['finished'] - summary['started']
+  summary['success'] = summary['failed'] == 0 and not summary['skipped']
+
+  log('Fan-out finished: %s: %s host(s), %s succeeded, %s failed, %s skipped' %
+      (job_spec_key, len(hosts), summary['succeeded'], summary['failed'], len(summary['skipped'])))
+
+  return summary
+
+
+def IterateFanout(run_spec, command_options, command_args, input_data, summary):
+  """Yields (host, result) as each host finishes, running the fan-out in a thread.  See RunFanout().
+
+  Args:
+    summary: dict, updated with the fan-out summary when it is finished
+  """
+  results = Queue.Queue()
+  finished = []
+
+  def Fanout():
+    #NOTE(g): Catching BaseException, because Error() uses sys.exit(), which we re-raise in the caller's thread
+    try:
+      summary.update(RunFanout(run_spec, command_options, command_args, input_data,
+                               lambda host, result: results.put((host, result))))
+    except BaseException, e:
+      finished.append(e)
+    finally:
+      results.put(None)
+
+  thread = threading.Thread(target=Fanout, name='fanout-run')
+  thread.daemon = True
+  thread.start()
+
+  while True:
+    host_result = results.get()
+    if host_result == None:
+      break
+
+    yield host_result
+
+  thread.join()
+
+  if finished:
+    raise finished[0]
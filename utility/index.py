@@ -0,0 +1,271 @@
+"""
+Index: Searchable index of the run spec's job specs, kept on disk in SQLite
+
+The index has each job's key, name, component, platforms, input keys, notify and authorization lists, and the digest
+of its spec.  It is updated incrementally: a job spec is only loaded again when its file changes (mtime, size, inode),
+and jobs no longer in the run spec are removed.
+
+Searches answer "which jobs support this platform / need this input" without loading any job specs.
+"""
+
+
+import os
+import json
+import time
+import sqlite3
+
+import specs
+import digest
+
+
+# Index database path, if the run spec doesnt specify "index path"
+INDEX_PATH = os.path.join(os.path.expanduser('~'), '.runman', 'index.sqlite')
+
+# Change this if the schema changes, the index is rebuilt
+SCHEMA_VERSION = 1
+
+# Seconds to wait for another process writing the index
+LOCK_TIMEOUT = 30.0
+
+SCHEMA = [
+  'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+  '''CREATE TABLE IF NOT EXISTS jobs (job_key TEXT PRIMARY KEY, path TEXT, identity TEXT, digest TEXT, name TEXT,
+                                      component TEXT, indexed REAL, error TEXT)''',
+  'CREATE TABLE IF NOT EXISTS job_platforms (job_key TEXT, platform TEXT)',
+  'CREATE TABLE IF NOT EXISTS job_inputs (job_key TEXT, input_key TEXT, type TEXT)',
+  'CREATE TABLE IF NOT EXISTS job_notify (job_key TEXT, event TEXT, address TEXT)',
+  'CREATE TABLE IF NOT EXISTS job_authorization (job_key TEXT, access TEXT, user TEXT)',
+  'CREATE INDEX IF NOT EXISTS job_platforms_platform ON job_platforms (platform, job_key)',
+  'CREATE INDEX IF NOT EXISTS job_inputs_input_key ON job_inputs (input_key, job_key)',
+  'CREATE INDEX IF NOT EXISTS job_notify_job_key ON job_notify (job_key)',
+  'CREATE INDEX IF NOT EXISTS job_authorization_job_key ON job_authorization (job_key)',
+]
+
+# Tables with rows for each job, cleared when a job is indexed again
+JOB_TABLES = ['jobs', 'job_platforms', 'job_inputs', 'job_notify', 'job_authorization']
+
+
+class IndexNotAvailable(Exception):
+  """The index could not be used"""
+
+
+def GetIndexPath(run_spec):
+  """Returns string, the index path for this run spec"""
+  return run_spec.get('index path', None) or INDEX_PATH
+
+
+class Index(object):
+  """The job spec index database"""
+
+  def __init__(self, path=INDEX_PATH):
+    self.path = path
+
+    index_dir = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(index_dir):
+      os.makedirs(index_dir, 0700)
+
+    try:
+      self.db = sqlite3.connect(path, timeout=LOCK_TIMEOUT)
+    except sqlite3.Error, e:
+      raise IndexNotAvailable('Could not open index: %s: %s' % (path, e))
+
+    self.db.row_factory = sqlite3.Row
+    self.CreateSchema()
+
+
+  def Close(self):
+    self.db.close()
+
+
+  def CreateSchema(self):
+    """Create the tables, rebuilding them if they are from another schema version"""
+    for statement in SCHEMA:
+      self.db.execute(statement)
+
+    row = self.db.execute("SELECT value FROM meta WHERE key = 'schema_version'").fetchone()
+    if row == None or int(row['value']) != SCHEMA_VERSION:
+      for table in JOB_TABLES + ['meta']:
+        self.db.execute('DROP TABLE IF EXISTS %s' % table)
+
+      for statement in SCHEMA:
+        self.db.execute(statement)
+
+      self.db.execute("INSERT INTO meta (key, value) VALUES ('schema_version', ?)", (str(SCHEMA_VERSION),))
+
+    self.db.commit()
+
+
+  def Update(self, run_spec):
+    """Index the run spec's jobs whose spec files changed, and remove jobs no longer in it.  Returns dict, counts."""
+    counts = {'added':0, 'updated':0, 'removed':0, 'unchanged':0, 'errors':0}
+
+    indexed = {}
+    for row in self.db.execute('SELECT job_key, path, identity FROM jobs'):
+      indexed[row['job_key']] = (row['path'], row['identity'])
+
+    # Find what changed, by file identity
+    changed = {}
+    for (job_key, job_path) in run_spec['jobs'].items():
+      try:
+        identity = json.dumps(list(specs.GetIdentity(os.path.abspath(job_path))))
+      except OSError:
+        identity = None
+
+      if identity != None and indexed.get(job_key, None) == (job_path, identity):
+        counts['unchanged'] += 1
+      else:
+        changed[job_key] = (job_path, identity)
+
+    removed = [job_key for job_key in indexed if job_key not in run_spec['jobs']]
+
+    if not changed and not removed:
+      return counts
+
+    # Load everything that changed at once
+    loaded = specs.LoadMany([job_path for (job_path, identity) in changed.values() if identity != None])
+
+    try:
+      for job_key in removed:
+        self.DeleteJob(job_key)
+        counts['removed'] += 1
+
+      for (job_key, (job_path, identity)) in changed.items():
+        if job_key in indexed:
+          counts['updated'] += 1
+        else:
+          counts['added'] += 1
+
+        if identity == None:
+          (job_spec, error) = (None, 'Job spec file not found: %s' % job_path)
+        else:
+          (job_spec, error) = loaded[job_path]
+
+        if error:
+          counts['errors'] += 1
+
+        self.IndexJob(job_key, job_path, identity, job_spec, error)
+
+      self.db.commit()
+
+    except:
+      self.db.rollback()
+      raise
+
+    return counts
+
+
+  def DeleteJob(self, job_key):
+    for table in JOB_TABLES:
+      self.db.execute('DELETE FROM %s WHERE job_key = ?' % table, (job_key,))
+
+
+  def IndexJob(self, job_key, job_path, identity, job_spec, error=None):
+    """Replace the index rows of a job.  Jobs that could not be loaded are indexed with their error."""
+    self.DeleteJob(job_key)
+
+    if error or type(job_spec) != dict:
+      self.db.execute('INSERT INTO jobs (job_key, path, identity, indexed, error) VALUES (?, ?, ?, ?, ?)',
+                      (job_key, job_path, identity, time.time(), error or 'Job spec is not a mapping'))
+      return
+
+    data = job_spec.get('data', None) or {}
+    self.db.execute('INSERT INTO jobs (job_key, path, identity, digest, name, component, indexed) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (job_key, job_path, identity, digest.CanonicalDigest(job_spec), data.get('name', None),
+                     data.get('component', None), time.time()))
+
+    for platform in (job_spec.get('run', None) or {}):
+      self.db.execute('INSERT INTO job_platforms (job_key, platform) VALUES (?, ?)', (job_key, platform))
+
+    for (input_key, input_validation) in (job_spec.get('input', None) or {}).items():
+      self.db.execute('INSERT INTO job_inputs (job_key, input_key, type) VALUES (?, ?, ?)',
+                      (job_key, input_key, (input_validation or {}).get('type', None)))
+
+    for (event, addresses) in (job_spec.get('notify', None) or {}).items():
+      for address in addresses or []:
+        self.db.execute('INSERT INTO job_notify (job_key, event, address) VALUES (?, ?, ?)', (job_key, event, address))
+
+    for (access, users) in (job_spec.get('authorization', None) or {}).items():
+      for user in users or []:
+        self.db.execute('INSERT INTO job_authorization (job_key, access, user) VALUES (?, ?, ?)', (job_key, access, user))
+
+
+  def Search(self, platform=None, input_key=None, component=None, text=None):
+    """Returns list of dicts, jobs matching every given term: job_key, name, component, path, platforms, error
+
+    Args:
+      platform: string (optional), jobs that can run on this platform
+      input_key: string (optional), jobs that take this input key
+      component: string (optional), jobs for this component
+      text: string (optional), jobs with this text in their job key, name or component
+    """
+    sql = 'SELECT jobs.* FROM jobs'
+    where = []
+    args = []
+
+    if platform != None:
+      sql += ' JOIN job_platforms ON job_platforms.job_key = jobs.job_key AND job_platforms.platform = ?'
+      args.append(platform)
+
+    if input_key != None:
+      sql += ' JOIN job_inputs ON job_inputs.job_key = jobs.job_key AND job_inputs.input_key = ?'
+      args.append(input_key)
+
+    if component != None:
+      where.append('jobs.component = ?')
+      args.append(component)
+
+    if text != None:
+      where.append('(jobs.job_key LIKE ? OR jobs.name LIKE ? OR jobs.component LIKE ?)')
+      args += ['%%%s%%' % text] * 3
+
+    if where:
+      sql += ' WHERE ' + ' AND '.join(where)
+
+    sql += ' ORDER BY jobs.job_key'
+
+    results = []
+    for row in self.db.execute(sql, args):
+      result = {'job_key':row['job_key'], 'name':row['name'], 'component':row['component'], 'path':row['path']}
+      result['platforms'] = self.GetValues('SELECT platform FROM job_platforms WHERE job_key = ? ORDER BY platform', row['job_key'])
+      if row['error']:
+        result['error'] = row['error']
+
+      results.append(result)
+
+    return results
+
+
+  def Describe(self, job_key):
+    """Returns dict, everything indexed about a job, or None if it is not in the index"""
+    row = self.db.execute('SELECT * FROM jobs WHERE job_key = ?', (job_key,)).fetchone()
+    if row == None:
+      return None
+
+    job = dict([(key, row[key]) for key in row.keys()])
+    job['platforms'] = self.GetValues('SELECT platform FROM job_platforms WHERE job_key = ? ORDER BY platform', job_key)
+
+    job['input'] = {}
+    for input_row in self.db.execute('SELECT input_key, type FROM job_inputs WHERE job_key = ?', (job_key,)):
+      job['input'][input_row['input_key']] = input_row['type']
+
+    job['notify'] = {}
+    for notify_row in self.db.execute('SELECT event, address FROM job_notify WHERE job_key = ?', (job_key,)):
+      job['notify'].setdefault(notify_row['event'], []).append(notify_row['address'])
+
+    job['authorization'] = {}
+    for access_row in self.db.execute('SELECT access, user FROM job_authorization WHERE job_key = ?', (job_key,)):
+      job['authorization'].setdefault(access_row['access'], []).append(access_row['user'])
+
+    return job
+
+
+  def GetValues(self, sql, job_key):
+    """Returns list, the first column of each row of a query on a job key"""
+    return [row[0] for row in self.db.execute(sql, (job_key,))]
+
+
+def GetIndex(run_spec):
+  """Returns Index, for the run spec, updated for any job specs that changed"""
+  index = Index(GetIndexPath(run_spec))
+  index.Update(run_spec)
+  return index
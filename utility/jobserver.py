@@ -0,0 +1,441 @@
+"""
+Job Server: Local stand-in for the websource job server, for testing clients without external services
+
+Serves the websource endpoints over HTTP/1.1 keep-alive:
+  /job_get      POST hostname, limit, wait.  Returns {"jobs": "<JSON list of job requests>", "long_poll": true}
+                If wait is given, the request is held open until there are jobs for the host, or wait seconds pass.
+  /job_report   POST id, data.  Records the report.  Or POST reports: JSON list of {"id", "data"}, for batched reports.
+  /job_progress POST id, data.  Records the progress report.
+
+Counts connections and requests, so connection reuse by clients can be checked.  Records when each job was queued,
+handed out and reported, for pickup and report latency (see GetStats()).
+
+For load testing, requests can be delayed (latency) and failed (failure rate, HTTP 503), and the queue can be filled
+with synthetic jobs for a run spec's jobs (see MakeSyntheticJobs()).
+
+Usage: python jobserver.py [--port <port>] [--run-spec <path> --synthetic <count> [--input <json>]] [--latency <seconds>]
+                           [--failure-rate <fraction>] [--reports <path>] [jobs.json]
+  jobs.json is a JSON list of job requests to serve.
+  --synthetic queues count jobs, cycling through the run spec's jobs, with input data from --input.
+  --reports appends every report received to path, as JSON lines: {"id", "data", "time"}
+"""
+
+
+import sys
+import json
+import time
+import zlib
+import gzip
+import random
+import getopt
+import urlparse
+import StringIO
+import threading
+import SocketServer
+import BaseHTTPServer
+
+from log import log
+
+import specs
+import digest
+
+
+# Default port to serve on
+JOB_SERVER_PORT = 8780
+
+# Longest we will hold a long-poll job_get request, whatever the client asks for
+MAX_LONG_POLL_WAIT = 300.0
+
+# Latency percentiles in GetStats()
+STATS_PERCENTILES = [50, 90, 99]
+
+
+class JobServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """Job server with an in memory job queue and report log"""
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, address=('localhost', JOB_SERVER_PORT), jobs=None, latency=0.0, failure_rate=0.0, reports_path=None,
+               idle_timeout=None):
+    """
+    Args:
+      jobs: list of dicts (optional), job requests to queue
+      latency: float, seconds to delay every request
+      failure_rate: float, fraction of requests (0.0 - 1.0) answered with an HTTP 503 error, instead of handled
+      reports_path: string (optional), append every report received to this file, as JSON lines
+      idle_timeout: float (optional), seconds to keep an idle connection open, as real servers limit keep-alive.
+        Default keeps it until the client closes it.
+    """
+    BaseHTTPServer.HTTPServer.__init__(self, address, JobServerRequestHandler)
+
+    self.latency = latency
+    self.failure_rate = failure_rate
+    self.idle_timeout = idle_timeout
+
+    # Queued job requests, and reports and progress reports received: (id, data)
+    self.jobs = []
+    self.reports = []
+    self.progress = []
+
+    # Times jobs were queued, handed out, and first reported: job id: time
+    self.queued_times = {}
+    self.picked_times = {}
+    self.reported_times = {}
+
+    # Counts: connections accepted, and still open, requests handled, requests failed on purpose
+    self.connections = 0
+    self.open_connections = 0
+    self.requests = 0
+    self.failures = 0
+
+    self.reports_file = None
+    if reports_path:
+      self.reports_file = open(reports_path, 'a')
+
+    #NOTE(g): A condition, so long-poll requests can wait for jobs to be added
+    self.lock = threading.Condition()
+
+    for job_request in jobs or []:
+      self.AddJob(job_request)
+
+
+  def GetUrl(self, endpoint):
+    """Returns string, URL for an endpoint (job_get, job_report) on this server"""
+    return 'http://%s:%s/%s' % (self.server_address[0], self.server_address[1], endpoint)
+
+
+  def GetWebsource(self):
+    """Returns dict, websource spec for clients of this server"""
+    return {'job_get':{'url':self.GetUrl('job_get')}, 'job_report':{'url':self.GetUrl('job_report')},
+            'job_progress':{'url':self.GetUrl('job_progress')}}
+
+
+  def AddJob(self, job_request):
+    """Queue a job request"""
+    self.lock.acquire()
+    try:
+      self.jobs.append(job_request)
+      self.queued_times[job_request['id']] = time.time()
+      self.lock.notify_all()
+    finally:
+      self.lock.release()
+
+
+  def GetJobs(self, hostname, limit=None, wait=None):
+    """Returns list of job requests for hostname, removing them from the queue.
+
+    If wait, hold on until there are jobs for hostname, or wait seconds pass.
+    """
+    self.lock.acquire()
+    try:
+      deadline = time.time() + min(wait or 0.0, MAX_LONG_POLL_WAIT)
+      while True:
+        jobs = []
+        for job_request in list(self.jobs):
+          if limit != None and len(jobs) >= limit:
+            break
+
+          # Jobs without a hostname go to anyone
+          if job_request.get('hostname', None) in (None, hostname):
+            jobs.append(job_request)
+            self.jobs.remove(job_request)
+            self.picked_times[job_request['id']] = time.time()
+
+        if jobs or time.time() >= deadline:
+          return jobs
+
+        self.lock.wait(deadline - time.time())
+    finally:
+      self.lock.release()
+
+
+  def Report(self, job_id, data):
+    """Record a job report"""
+    self.lock.acquire()
+    try:
+      now = time.time()
+      self.reports.append((job_id, data))
+      self.reported_times.setdefault(job_id, now)
+
+      if self.reports_file:
+        self.reports_file.write(json.dumps({'id':job_id, 'data':data, 'time':now}) + '\n')
+        self.reports_file.flush()
+    finally:
+      self.lock.release()
+
+
+  def GetStats(self):
+    """Returns dict, counts and latencies so far:
+      queued, picked, reported, pending: jobs
+      connections, requests, failures: counts
+      pickup_latency: seconds from queued to handed out.  report_latency: seconds from handed out to reported.
+        Each is a dict: count, mean, max, and p<N> for STATS_PERCENTILES.
+    """
+    self.lock.acquire()
+    try:
+      pickup = [self.picked_times[job_id] - self.queued_times[job_id] for job_id in self.picked_times if job_id in self.queued_times]
+      report = [self.reported_times[job_id] - self.picked_times[job_id] for job_id in self.reported_times if job_id in self.picked_times]
+
+      stats = {
+        'queued':len(self.queued_times),
+        'picked':len(self.picked_times),
+        'reported':len(self.reported_times),
+        'pending':len(self.jobs),
+        'connections':self.connections,
+        'requests':self.requests,
+        'failures':self.failures,
+        'pickup_latency':GetLatencyStats(pickup),
+        'report_latency':GetLatencyStats(report),
+      }
+
+      return stats
+    finally:
+      self.lock.release()
+
+
+  def server_close(self):
+    BaseHTTPServer.HTTPServer.server_close(self)
+
+    if self.reports_file:
+      self.reports_file.close()
+      self.reports_file = None
+
+
+class JobServerRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Handle requests on one connection.  HTTP/1.1, so the connection is kept alive for more requests."""
+  protocol_version = 'HTTP/1.1'
+
+  def setup(self):
+    # Close the connection once it is idle this long: waiting for the next request times out
+    self.timeout = self.server.idle_timeout
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    self.server.lock.acquire()
+    try:
+      self.server.connections += 1
+      self.server.open_connections += 1
+    finally:
+      self.server.lock.release()
+
+
+  def finish(self):
+    try:
+      BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+    finally:
+      self.server.lock.acquire()
+      try:
+        self.server.open_connections -= 1
+      finally:
+        self.server.lock.release()
+
+
+  def log_message(self, format, *args):
+    """Quiet, clients log enough"""
+    pass
+
+
+  def GetArgs(self):
+    """Returns dict, the request args: urlencoded body (possibly gzip compressed) and query string"""
+    args = dict(urlparse.parse_qsl(urlparse.urlsplit(self.path).query))
+
+    length = int(self.headers.getheader('Content-Length', 0))
+    if length:
+      body = self.rfile.read(length)
+      if self.headers.getheader('Content-Encoding', '') == 'gzip':
+        body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+      args.update(dict(urlparse.parse_qsl(body)))
+
+    return args
+
+
+  def SendJson(self, data, status=200):
+    """Send data as a JSON response, gzip compressed if the client accepts it"""
+    body = json.dumps(data)
+    gzip_body = 'gzip' in self.headers.getheader('Accept-Encoding', '')
+    if gzip_body:
+      buffer = StringIO.StringIO()
+      gzip_file = gzip.GzipFile(fileobj=buffer, mode='wb')
+      gzip_file.write(body)
+      gzip_file.close()
+      body = buffer.getvalue()
+
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    if gzip_body:
+      self.send_header('Content-Encoding', 'gzip')
+    self.end_headers()
+    self.wfile.write(body)
+
+
+  def do_GET(self):
+    self.HandleRequest()
+
+
+  def do_POST(self):
+    self.HandleRequest()
+
+
+  def HandleRequest(self):
+    # Slow or failing server, for load testing
+    if self.server.latency:
+      time.sleep(self.server.latency)
+
+    failed = self.server.failure_rate and random.random() < self.server.failure_rate
+
+    self.server.lock.acquire()
+    try:
+      self.server.requests += 1
+      if failed:
+        self.server.failures += 1
+    finally:
+      self.server.lock.release()
+
+    #NOTE(g): Fail before handling the request, so nothing it asked for happens.  The body is still read, so the
+    #   connection stays usable for the client's next request.
+    if failed:
+      self.GetArgs()
+      self.SendJson({'error':'Synthetic failure'}, status=503)
+      return
+
+    endpoint = urlparse.urlsplit(self.path).path.strip('/')
+    args = self.GetArgs()
+
+    if endpoint == 'job_get':
+      limit = args.get('limit', None)
+      if limit != None:
+        limit = int(limit)
+      wait = args.get('wait', None)
+      if wait != None:
+        wait = float(wait)
+      jobs = self.server.GetJobs(args.get('hostname', None), limit, wait)
+
+      #NOTE(g): The jobs are a JSON string inside the JSON response, as the client expects
+      self.SendJson({'jobs':json.dumps(jobs), 'long_poll':wait != None})
+
+    elif endpoint == 'job_report':
+      # Batched reports
+      if 'reports' in args:
+        for report in json.loads(args['reports']):
+          self.server.Report(report['id'], report['data'])
+      else:
+        self.server.Report(args.get('id', None), args.get('data', None))
+
+      self.SendJson({'success':True})
+
+    elif endpoint == 'job_progress':
+      self.server.lock.acquire()
+      try:
+        self.server.progress.append((args.get('id', None), args.get('data', None)))
+      finally:
+        self.server.lock.release()
+
+      self.SendJson({'success':True})
+
+    else:
+      self.SendJson({'error':'Unknown endpoint: %s' % endpoint}, status=404)
+
+
+def MakeJobRequest(job_id, job_key, job_spec_path, input_data, hostname=None):
+  """Returns dict, a job request as the server would send it, with the server's digest of the job spec"""
+  job_request = {
+    'id':job_id,
+    'job_key':job_key,
+    'input_data_json':json.dumps(input_data),
+    'job_data_server_md5_digest':digest.CanonicalDigest(specs.Load(job_spec_path)),
+  }
+
+  if hostname:
+    job_request['hostname'] = hostname
+
+  return job_request
+
+
+def MakeSyntheticJobs(run_spec, count, input_data=None, job_keys=None, prefix='synthetic'):
+  """Returns list of dicts, count job requests cycling through the run spec's jobs.  Each job spec is digested once.
+
+  Args:
+    input_data: dict (optional), input data for every job
+    job_keys: list of strings (optional), run spec job keys to use.  Default is all of them.
+    prefix: string, job ids are "<prefix>-<number>"
+  """
+  if not job_keys:
+    job_keys = sorted(run_spec['jobs'])
+
+  templates = {}
+  for job_key in job_keys:
+    templates[job_key] = MakeJobRequest(None, job_key, run_spec['jobs'][job_key], input_data or {})
+
+  jobs = []
+  for number in range(count):
+    job_request = dict(templates[job_keys[number % len(job_keys)]])
+    job_request['id'] = '%s-%s' % (prefix, number)
+    jobs.append(job_request)
+
+  return jobs
+
+
+def GetLatencyStats(latencies):
+  """Returns dict, count, mean, max, and p<N> for STATS_PERCENTILES, of a list of seconds.  Empty lists give None values."""
+  latencies = sorted(latencies)
+
+  stats = {'count':len(latencies), 'mean':None, 'max':None}
+  for percentile in STATS_PERCENTILES:
+    stats['p%s' % percentile] = None
+
+  if latencies:
+    stats['mean'] = sum(latencies) / len(latencies)
+    stats['max'] = latencies[-1]
+    for percentile in STATS_PERCENTILES:
+      stats['p%s' % percentile] = latencies[min(len(latencies) - 1, len(latencies) * percentile / 100)]
+
+  return stats
+
+
+def Main(args):
+  long_options = ['port=', 'run-spec=', 'synthetic=', 'input=', 'latency=', 'failure-rate=', 'reports=']
+  (options, args) = getopt.getopt(args, 'p:', long_options)
+
+  port = JOB_SERVER_PORT
+  run_spec_path = None
+  synthetic = 0
+  input_data = {}
+  latency = 0.0
+  failure_rate = 0.0
+  reports_path = None
+  for (option, value) in options:
+    if option in ('-p', '--port'):
+      port = int(value)
+    elif option == '--run-spec':
+      run_spec_path = value
+    elif option == '--synthetic':
+      synthetic = int(value)
+    elif option == '--input':
+      input_data = json.loads(value)
+    elif option == '--latency':
+      latency = float(value)
+    elif option == '--failure-rate':
+      failure_rate = float(value)
+    elif option == '--reports':
+      reports_path = value
+
+  jobs = []
+  if args:
+    jobs = json.load(open(args[0]))
+
+  if synthetic:
+    if not run_spec_path:
+      raise Exception('--synthetic needs the --run-spec the clients run')
+
+    jobs += MakeSyntheticJobs(specs.LoadRunSpec(run_spec_path), synthetic, input_data)
+
+  server = JobServer(('', port), jobs, latency, failure_rate, reports_path)
+  log('Job server listening: %s (%s jobs queued, latency: %s, failure rate: %s)' % (port, len(jobs), latency, failure_rate))
+
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    log('Job server stats: %s' % json.dumps(server.GetStats(), sort_keys=True))
+
+
+if __name__ == '__main__':
+  Main(sys.argv[1:])
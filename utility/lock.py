@@ -0,0 +1,370 @@
+"""
+Locks: Acquire the "acquire locks" of a run item, so jobs can safely run concurrently
+
+Backends:
+  local: fcntl lock files in a directory.  Only protects against other jobs on this host.
+  shared: TCP lock server (LockServer), so many hosts can share locks.
+
+Locks are exclusive, or shared ("shared: true"): any number of shared holders, or one exclusive holder.  Lock items
+of a run item that format to the same key are held as one lock.
+
+Both backends release locks automatically if the process holding them dies: the lock file descriptor or the
+server connection is closed by the OS.
+"""
+
+
+import os
+import re
+import time
+import fcntl
+import socket
+import hashlib
+import tempfile
+import threading
+import SocketServer
+
+from log import log
+
+
+# Seconds between attempts when waiting on a local lock with a timeout
+LOCK_POLL_INTERVAL = 0.1
+
+# Default directory for local lock files
+LOCK_PATH = os.path.join(tempfile.gettempdir(), 'runman_locks')
+
+# Default shared lock server port
+LOCK_SERVER_PORT = 7788
+
+# LockServer holder count of a lock held exclusively
+EXCLUSIVE = -1
+
+# Backends, by their run spec configuration, so every job shares them
+BACKENDS = {}
+BACKENDS_LOCK = threading.Lock()
+
+
+class LockUnavailable(Exception):
+  """A lock could not be acquired: it is held elsewhere and we would not wait, or waiting timed out"""
+
+
+class LockBackend(object):
+  """Interface for lock backends.  Acquire returns a handle, which is given back to Release."""
+
+  def Acquire(self, key, blocking=True, timeout=None, shared=False):
+    """Returns a handle for the held lock, or raises LockUnavailable.
+
+    Args:
+      key: string, lock key
+      blocking: boolean, if False fail immediately if the lock is held elsewhere
+      timeout: float (optional), seconds to wait if blocking.  None waits forever.
+      shared: boolean, if True hold the lock with other shared holders, else hold it alone
+    """
+    raise NotImplementedError()
+
+  def Release(self, handle):
+    """Release a lock handle from Acquire"""
+    raise NotImplementedError()
+
+
+class LocalLockBackend(LockBackend):
+  """Lock files in a local directory, locked with fcntl.flock()"""
+
+  def __init__(self, path=LOCK_PATH):
+    self.path = path
+
+    if not os.path.isdir(self.path):
+      try:
+        os.makedirs(self.path)
+      except OSError:
+        # Another process may have made it first
+        if not os.path.isdir(self.path):
+          raise
+
+
+  def GetLockPath(self, key):
+    """Returns string, path to the lock file for this key.  Readable prefix, digest for uniqueness."""
+    readable = re.sub('[^A-Za-z0-9_.-]+', '_', key)[:64]
+    return os.path.join(self.path, '%s.%s.lock' % (readable, hashlib.md5(key).hexdigest()))
+
+
+  def Acquire(self, key, blocking=True, timeout=None, shared=False):
+    fp = open(self.GetLockPath(key), 'a')
+
+    if shared:
+      operation = fcntl.LOCK_SH
+    else:
+      operation = fcntl.LOCK_EX
+
+    try:
+      # Wait forever
+      if blocking and timeout == None:
+        fcntl.flock(fp.fileno(), operation)
+        return fp
+
+      # Try until our deadline.  Not blocking just has no time to wait.
+      deadline = time.time()
+      if blocking:
+        deadline += timeout
+
+      while True:
+        try:
+          fcntl.flock(fp.fileno(), operation | fcntl.LOCK_NB)
+          return fp
+
+        except IOError, e:
+          if time.time() >= deadline:
+            raise LockUnavailable('Lock unavailable: %s' % key)
+
+          time.sleep(LOCK_POLL_INTERVAL)
+
+    except:
+      fp.close()
+      raise
+
+
+  def Release(self, handle):
+    fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+    handle.close()
+
+
+class SharedLockBackend(LockBackend):
+  """Locks held on a LockServer.  Each held lock keeps its own connection, closing it releases the lock."""
+
+  def __init__(self, host='localhost', port=LOCK_SERVER_PORT):
+    self.host = host
+    self.port = port
+
+
+  def Acquire(self, key, blocking=True, timeout=None, shared=False):
+    # Server protocol timeout: 0 is do not wait, -1 is wait forever
+    if not blocking:
+      server_timeout = 0
+    elif timeout == None:
+      server_timeout = -1
+    else:
+      server_timeout = timeout
+
+    try:
+      connection = socket.create_connection((self.host, self.port))
+    except socket.error, e:
+      raise LockUnavailable('Lock server unavailable: %s:%s: %s' % (self.host, self.port, e))
+
+    try:
+      if shared:
+        command = 'SHARE'
+      else:
+        command = 'ACQUIRE'
+
+      connection.sendall('%s %s %s\n' % (command, server_timeout, key.replace('\n', ' ')))
+      reply = connection.makefile('r').readline().strip()
+
+      if reply != 'OK':
+        raise LockUnavailable('Lock unavailable: %s: %s' % (key, reply))
+
+      return connection
+
+    except socket.error, e:
+      connection.close()
+      raise LockUnavailable('Lock server failed: %s:%s: %s' % (self.host, self.port, e))
+
+    except:
+      connection.close()
+      raise
+
+
+  def Release(self, handle):
+    try:
+      # Wait for the server to release it, so it is available to the next Acquire() as soon as we return
+      handle.sendall('RELEASE\n')
+      handle.makefile('r').readline()
+    finally:
+      handle.close()
+
+
+class LockServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+  """Shared lock server.  A lock is held for as long as the connection that acquired it is open.
+
+  Protocol, one line each:
+    client: ACQUIRE <timeout> <key>       (timeout: 0 do not wait, -1 wait forever, else seconds)
+        or: SHARE <timeout> <key>         (held with other SHARE holders)
+    server: OK | UNAVAILABLE
+    client: RELEASE                       (or just disconnect)
+    server: RELEASED
+  """
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, address=('localhost', LOCK_SERVER_PORT)):
+    SocketServer.TCPServer.__init__(self, address, LockRequestHandler)
+
+    # Held lock keys: count of shared holders, or EXCLUSIVE.  A condition to wait on them being released.
+    self.held = {}
+    self.condition = threading.Condition()
+
+
+  def IsAvailable(self, key, shared):
+    """Returns boolean, True if the lock can be acquired now.  Call with the condition held."""
+    holders = self.held.get(key, None)
+    if holders == None:
+      return True
+
+    return shared and holders != EXCLUSIVE
+
+
+class LockRequestHandler(SocketServer.StreamRequestHandler):
+  """Handle one lock connection for the LockServer"""
+
+  def handle(self):
+    line = self.rfile.readline().strip()
+    parts = line.split(' ', 2)
+    if len(parts) != 3 or parts[0] not in ('ACQUIRE', 'SHARE'):
+      self.wfile.write('ERROR bad request\n')
+      return
+
+    shared = parts[0] == 'SHARE'
+    key = parts[2]
+    timeout = float(parts[1])
+
+    server = self.server
+    server.condition.acquire()
+    try:
+      deadline = time.time() + timeout
+      while not server.IsAvailable(key, shared):
+        if timeout < 0:
+          server.condition.wait()
+        elif deadline > time.time():
+          server.condition.wait(deadline - time.time())
+        else:
+          break
+
+      # Still held elsewhere, we didnt get it
+      if not server.IsAvailable(key, shared):
+        self.wfile.write('UNAVAILABLE\n')
+        return
+
+      if shared:
+        server.held[key] = server.held.get(key, 0) + 1
+      else:
+        server.held[key] = EXCLUSIVE
+
+    finally:
+      server.condition.release()
+
+    released = False
+    try:
+      self.wfile.write('OK\n')
+      self.wfile.flush()
+
+      # Hold the lock until RELEASE or the connection is closed
+      released = self.rfile.readline().strip() == 'RELEASE'
+
+    finally:
+      server.condition.acquire()
+      try:
+        if shared and server.held[key] > 1:
+          server.held[key] -= 1
+        else:
+          del server.held[key]
+        server.condition.notify_all()
+      finally:
+        server.condition.release()
+
+    if released:
+      try:
+        self.wfile.write('RELEASED\n')
+      except socket.error:
+        # They didnt wait to hear it
+        pass
+
+
+def GetBackend(run_spec):
+  """Returns LockBackend, from the run spec "locks" block.  Defaults to local lock files."""
+  lock_spec = run_spec.get('locks', None) or {}
+  backend_type = lock_spec.get('backend', 'local')
+
+  if backend_type == 'local':
+    backend_key = (backend_type, lock_spec.get('path', None) or LOCK_PATH)
+  elif backend_type == 'shared':
+    backend_key = (backend_type, lock_spec.get('host', 'localhost'), int(lock_spec.get('port', LOCK_SERVER_PORT)))
+  else:
+    raise Exception('Unknown lock backend: %s' % backend_type)
+
+  BACKENDS_LOCK.acquire()
+  try:
+    if backend_key not in BACKENDS:
+      if backend_type == 'local':
+        BACKENDS[backend_key] = LocalLockBackend(backend_key[1])
+      else:
+        BACKENDS[backend_key] = SharedLockBackend(backend_key[1], backend_key[2])
+
+    return BACKENDS[backend_key]
+
+  finally:
+    BACKENDS_LOCK.release()
+
+
+def GetLockRequests(run_item, input_data):
+  """Returns list of (key, blocking, timeout, shared), the run item "acquire locks" with their keys formatted, sorted by
+  key, so concurrent jobs always acquire in the same order (no deadlocks).
+
+  Items with the same key are merged, as we cannot hold a lock twice: it is shared only if they all are, we dont wait
+  if any of them would not, and the shortest timeout wins.  Raises LockUnavailable if a key cannot be formatted.
+  """
+  requests = {}
+  for lock_item in run_item.get('acquire locks', None) or []:
+    try:
+      key = str(lock_item['key']) % input_data
+    except (KeyError, TypeError, ValueError), e:
+      raise LockUnavailable('Lock key cannot be formatted with the input data: %s: %s: %s' %
+                            (lock_item.get('key', None), type(e).__name__, e))
+
+    blocking = not lock_item.get('fail if lock unavailable', False)
+    timeout = lock_item.get('lock timeout', None)
+    if timeout != None:
+      timeout = float(timeout)
+    shared = bool(lock_item.get('shared', False))
+
+    if key in requests:
+      (_, merged_blocking, merged_timeout, merged_shared) = requests[key]
+      blocking = blocking and merged_blocking
+      timeout = min([value for value in (timeout, merged_timeout) if value != None] or [None])
+      shared = shared and merged_shared
+
+    requests[key] = (key, blocking, timeout, shared)
+
+  return [requests[key] for key in sorted(requests)]
+
+
+def AcquireLocks(run_spec, run_item, input_data):
+  """Acquire all the run item "acquire locks".  Returns list of (backend, key, handle), give to ReleaseLocks().
+
+  Raises LockUnavailable if any lock cannot be acquired, after releasing the locks we already got.
+  """
+  lock_requests = GetLockRequests(run_item, input_data)
+  if not lock_requests:
+    return []
+
+  backend = GetBackend(run_spec)
+
+  held = []
+  try:
+    for (key, blocking, timeout, shared) in lock_requests:
+      log('Acquiring lock: %s (wait: %s, timeout: %s, shared: %s)' % (key, blocking, timeout, shared))
+      handle = backend.Acquire(key, blocking=blocking, timeout=timeout, shared=shared)
+      held.append((backend, key, handle))
+
+  except:
+    ReleaseLocks(held)
+    raise
+
+  return held
+
+
+def ReleaseLocks(held):
+  """Release locks from AcquireLocks()"""
+  for (backend, key, handle) in reversed(held):
+    try:
+      backend.Release(handle)
+      log('Released lock: %s' % key)
+    except Exception, e:
+      log('Failed to release lock: %s: %s' % (key, e))
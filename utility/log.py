@@ -1,29 +1,229 @@
 """
 Logging
+
+Log lines go to STDERR, so we can template to STDOUT by default (no output path, easier testing).
+
+Lines are queued and written by a background thread in batches, so logging never blocks on STDERR.  At exit the thread
+is stopped and anything still queued is written, and lines logged after that are written right away.  Queued lines are
+also written before Error() reports a failure.  A bounded history of recent lines is kept in memory.
+
+Levels: debug, info, warning, error.  Debug lines are only written in verbose mode (RUN_OPTIONS "verbose").
+RUN_OPTIONS "log_format" of "json" writes JSON lines: {"time":epoch, "level":level, "message":text}
 """
 
-import time
+import os
 import sys
+import json
+import time
+import atexit
+import threading
+import collections
 
 
 # Run options, may specify logging level or log output targets, etc
 RUN_OPTIONS = {}
 
-# Store all of our logged lines in memory
-LOGGED = []
+# Log levels, and the least level written unless verbose
+LEVELS = {'debug':10, 'info':20, 'warning':30, 'error':40}
+LEVEL_DEFAULT = 'info'
+LEVEL_VERBOSE = 'debug'
+
+# Most recent logged lines kept in memory: (time, level, text).  Long lines are cut to LOGGED_TEXT_MAX characters.
+LOGGED_MAX = 10000
+LOGGED_TEXT_MAX = 4096
+LOGGED = collections.deque(maxlen=LOGGED_MAX)
+
+# Writer thread: seconds between flushes, and most lines queued before we drop lines instead of growing
+FLUSH_INTERVAL = 0.1
+QUEUE_MAX = 100000
+
+
+class LogWriter(object):
+  """Background writer: batches queued lines into one write and flush"""
+
+  def __init__(self, output=None):
+    # None writes to whatever sys.stderr is at the time
+    self.output = output
+    self.queue = collections.deque()
+    self.dropped = 0
+    self.condition = threading.Condition()
+
+    # Timestamp text is only formatted once a second: (second, text)
+    self.timestamp = (None, None)
+
+    self.pid = None
+    self.thread = None
+    self.stopped = False
+
+
+  def Start(self):
+    """Start the writer thread, again if we have forked since it started.  Must hold the condition."""
+    if self.pid == os.getpid() and self.thread.is_alive():
+      return
+
+    self.pid = os.getpid()
+    self.thread = threading.Thread(target=self._Run, name='log-writer')
+    self.thread.daemon = True
+    self.thread.start()
+
+
+  def Write(self, current_time, level, text):
+    """Queue a line to write"""
+    self.condition.acquire()
+    try:
+      # Stopped, there is no writer thread: write it now
+      if self.stopped:
+        self.queue.append((current_time, level, text))
+        self.Flush()
+        return
+
+      self.Start()
+
+      if len(self.queue) >= QUEUE_MAX:
+        self.dropped += 1
+        return
+
+      self.queue.append((current_time, level, text))
+
+      # Wake the writer for the first line, it collects the rest of the batch while it waits out the interval
+      if len(self.queue) == 1:
+        self.condition.notify()
+    finally:
+      self.condition.release()
+
+
+  def GetTimestamp(self, current_time):
+    """Returns string, formatted local time, cached for the second"""
+    second = int(current_time)
+    if self.timestamp[0] != second:
+      self.timestamp = (second, '[%d-%02d-%02d %02d:%02d:%02d] ' % time.localtime(second)[:6])
+
+    return self.timestamp[1]
+
+
+  def Format(self, current_time, level, text):
+    """Returns string, the line as we write it"""
+    if RUN_OPTIONS.get('log_format', None) == 'json':
+      return json.dumps({'time':current_time, 'level':level, 'message':text}) + '\n'
+
+    elif level in ('warning', 'error'):
+      return '%s%s: %s\n' % (self.GetTimestamp(current_time), level.upper(), text)
+
+    else:
+      return '%s%s\n' % (self.GetTimestamp(current_time), text)
 
 
-def log(text, options=RUN_OPTIONS):
-  """Send log messages to STDERR, so we can template to STDOUT by default (no output path, easier testing)"""
-  global LOGGED
-  
+  def FormatSafe(self, current_time, level, text):
+    """Returns string, the line as we write it.  If it cannot be formatted (ex: JSON of text that is not UTF-8), the
+    text is decoded with replacement characters, or failing that its repr, so one bad line never costs the batch.
+    """
+    try:
+      return self.Format(current_time, level, text)
+    except Exception:
+      pass
+
+    try:
+      return self.Format(current_time, level, str(text).decode('utf-8', 'replace').encode('utf-8'))
+    except Exception:
+      return self.Format(current_time, level, repr(text))
+
+
+  def Flush(self):
+    """Write everything queued.  Called from the writer thread, at exit and before errors."""
+    self.condition.acquire()
+    try:
+      lines = list(self.queue)
+      self.queue.clear()
+
+      dropped = self.dropped
+      self.dropped = 0
+
+      #NOTE(g): Formatting and writing while holding the condition keeps lines in order between flushing threads
+      if dropped:
+        lines.append((time.time(), 'warning', 'Log writer fell behind, dropped %s line(s)' % dropped))
+
+      if lines:
+        data = ''.join([self.FormatSafe(*line) for line in lines])
+
+        # Nowhere to write, ex: STDERR was closed
+        try:
+          output = self.output or sys.stderr
+          output.write(data)
+          output.flush()
+        except (IOError, ValueError):
+          pass
+    finally:
+      self.condition.release()
+
+
+  def Stop(self):
+    """Stop the writer thread, and write everything queued.  Called at exit, before the interpreter shuts down."""
+    self.condition.acquire()
+    try:
+      self.stopped = True
+      self.condition.notify_all()
+      thread = self.thread
+    finally:
+      self.condition.release()
+
+    #NOTE(g): A daemon thread still running while the interpreter shuts down fails on its torn down modules, so wait
+    #   for it.  After a fork the thread is the parent's, and does not exist here.
+    if thread and self.pid == os.getpid() and thread is not threading.current_thread():
+      thread.join()
+
+    self.Flush()
+
+
+  def _Run(self):
+    """Writer thread: wait for lines, give the batch the interval to collect, write it.  Returns once stopped."""
+    while True:
+      self.condition.acquire()
+      try:
+        while not self.queue and not self.stopped:
+          self.condition.wait()
+
+        if self.stopped:
+          return
+      finally:
+        self.condition.release()
+
+      time.sleep(FLUSH_INTERVAL)
+      self.Flush()
+
+
+WRITER = LogWriter()
+
+# Whatever is still queued is written when we exit
+atexit.register(WRITER.Stop)
+
+
+def IsLogged(level, options=None):
+  """Returns boolean, True if lines of this level are written with these options"""
+  if options == None:
+    options = RUN_OPTIONS
+
+  if options.get('verbose', False):
+    least_level = LEVEL_VERBOSE
+  else:
+    least_level = LEVEL_DEFAULT
+
+  return LEVELS.get(level, LEVELS[LEVEL_DEFAULT]) >= LEVELS[least_level]
+
+
+def log(text, options=None, level='info'):
+  """Log a line, at level: debug, info, warning, error"""
+  if not IsLogged(level, options):
+    return
+
   current_time = time.time()
-  local_time = time.localtime(current_time)
-  timestamp = '[%d-%02d-%02d %02d:%02d:%02d] ' % local_time[:6]
-  
-  # Save the log text to our global storage variable
-  LOGGED.append((current_time, text))
-  
-  sys.stderr.write(timestamp + str(text) + '\n')
-  sys.stderr.flush()
+  text = str(text)
+
+  # Save the log text to our bounded history
+  LOGGED.append((current_time, level, text[:LOGGED_TEXT_MAX]))
+
+  WRITER.Write(current_time, level, text)
+
 
+def Flush():
+  """Write any queued log lines now"""
+  WRITER.Flush()
@@ -0,0 +1,371 @@
+"""
+Metrics: Timing spans for the phases of a job, and counters, gauges and histograms for long running processes
+
+Spans time the phases of a job (loading its spec, retrieving input, each run item, spawning and draining its process,
+testing it) as a tree: a span started while another is open in the same thread is nested in it.  Run items run in
+worker threads, so they are started with their job's span as the parent.  Run() puts the tree in the result data as
+"timing": {"name", "id" (if any), "started", "duration", "spans": [nested spans]}
+
+Every finished span is also observed in the runman_span_seconds histogram, by span name, so a long running client has
+totals for where its time goes.
+
+Metrics are kept for the process, and exported in the Prometheus text format: served over HTTP (StartServer()), or
+written to a file every interval (StartFileWriter()), for the node exporter textfile collector.
+"""
+
+
+import os
+import time
+import bisect
+import tempfile
+import threading
+
+from log import log
+
+
+# Histogram buckets for durations, in seconds
+DURATION_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0]
+
+# Seconds between writes of the metrics file, if the run spec doesnt specify "metrics interval"
+FILE_INTERVAL = 15.0
+
+# Content type of the Prometheus text format
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+# Metrics of this process, by name
+METRICS = {}
+METRICS_LOCK = threading.Lock()
+
+# Open spans of each thread, innermost last
+SPAN_STACKS = threading.local()
+
+
+class Metric(object):
+  """A named metric, with a value for each set of labels"""
+  metric_type = None
+
+  def __init__(self, name, help_text):
+    self.name = name
+    self.help_text = help_text
+    self.lock = threading.Lock()
+
+    # Labels key (sorted tuple of (label, value)): value
+    self.values = {}
+
+
+  def GetSamples(self):
+    """Returns list of (name, labels key, value), the lines of this metric in the text format.  0 if nothing yet."""
+    self.lock.acquire()
+    try:
+      if not self.values:
+        return [(self.name, (), 0)]
+
+      return [(self.name, labels_key, value) for (labels_key, value) in sorted(self.values.items())]
+    finally:
+      self.lock.release()
+
+
+class Counter(Metric):
+  """Only goes up: things that happened"""
+  metric_type = 'counter'
+
+  def Increment(self, labels=None, amount=1):
+    labels_key = GetLabelsKey(labels)
+
+    self.lock.acquire()
+    try:
+      self.values[labels_key] = self.values.get(labels_key, 0) + amount
+    finally:
+      self.lock.release()
+
+
+class Gauge(Metric):
+  """Goes up and down: how things are now"""
+  metric_type = 'gauge'
+
+  def Set(self, value, labels=None):
+    labels_key = GetLabelsKey(labels)
+
+    self.lock.acquire()
+    try:
+      self.values[labels_key] = value
+    finally:
+      self.lock.release()
+
+
+  def Increment(self, labels=None, amount=1):
+    labels_key = GetLabelsKey(labels)
+
+    self.lock.acquire()
+    try:
+      self.values[labels_key] = self.values.get(labels_key, 0) + amount
+    finally:
+      self.lock.release()
+
+
+class Histogram(Metric):
+  """Counts of observed values in buckets, with their sum and count"""
+  metric_type = 'histogram'
+
+  def __init__(self, name, help_text, buckets=DURATION_BUCKETS):
+    Metric.__init__(self, name, help_text)
+    self.buckets = sorted(buckets)
+
+
+  def Observe(self, value, labels=None):
+    labels_key = GetLabelsKey(labels)
+
+    self.lock.acquire()
+    try:
+      # [count in each bucket (not cumulative) and over the last, sum, count]
+      observed = self.values.get(labels_key, None)
+      if observed == None:
+        observed = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        self.values[labels_key] = observed
+
+      observed[0][bisect.bisect_left(self.buckets, value)] += 1
+      observed[1] += value
+      observed[2] += 1
+    finally:
+      self.lock.release()
+
+
+  def GetSamples(self):
+    samples = []
+
+    self.lock.acquire()
+    try:
+      for (labels_key, (bucket_counts, total, count)) in sorted(self.values.items()):
+        cumulative = 0
+        for (bucket, bucket_count) in zip(self.buckets + ['+Inf'], bucket_counts):
+          cumulative += bucket_count
+          samples.append(('%s_bucket' % self.name, labels_key + (('le', FormatValue(bucket)),), cumulative))
+
+        samples.append(('%s_sum' % self.name, labels_key, total))
+        samples.append(('%s_count' % self.name, labels_key, count))
+    finally:
+      self.lock.release()
+
+    return samples
+
+
+def GetLabelsKey(labels):
+  """Returns tuple, sorted (label, value) pairs of a labels dict"""
+  if not labels:
+    return ()
+
+  return tuple(sorted([(key, str(value)) for (key, value) in labels.items()]))
+
+
+def GetMetric(metric_class, name, help_text, *args):
+  """Returns Metric, the metric of this name, created if we dont have it yet"""
+  METRICS_LOCK.acquire()
+  try:
+    metric = METRICS.get(name, None)
+    if metric == None:
+      metric = metric_class(name, help_text, *args)
+      METRICS[name] = metric
+
+    elif not isinstance(metric, metric_class):
+      raise Exception('Metric is a %s, not a %s: %s' % (metric.metric_type, metric_class.metric_type, name))
+
+    return metric
+  finally:
+    METRICS_LOCK.release()
+
+
+def GetCounter(name, help_text):
+  return GetMetric(Counter, name, help_text)
+
+
+def GetGauge(name, help_text):
+  return GetMetric(Gauge, name, help_text)
+
+
+def GetHistogram(name, help_text, buckets=DURATION_BUCKETS):
+  return GetMetric(Histogram, name, help_text, buckets)
+
+
+def FormatValue(value):
+  """Returns string, a sample value or bucket bound as the text format has it"""
+  if value == '+Inf':
+    return value
+  elif type(value) in (int, long):
+    return str(value)
+  else:
+    return repr(float(value))
+
+
+def FormatLabelValue(value):
+  return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def FormatPrometheus():
+  """Returns string, every metric in the Prometheus text format"""
+  METRICS_LOCK.acquire()
+  try:
+    metrics = sorted(METRICS.items())
+  finally:
+    METRICS_LOCK.release()
+
+  lines = []
+  for (name, metric) in metrics:
+    lines.append('# HELP %s %s' % (name, metric.help_text))
+    lines.append('# TYPE %s %s' % (name, metric.metric_type))
+
+    for (sample_name, labels_key, value) in metric.GetSamples():
+      if labels_key:
+        labels = ','.join(['%s="%s"' % (key, FormatLabelValue(label_value)) for (key, label_value) in labels_key])
+        lines.append('%s{%s} %s' % (sample_name, labels, FormatValue(value)))
+      else:
+        lines.append('%s %s' % (sample_name, FormatValue(value)))
+
+  return '\n'.join(lines) + '\n'
+
+
+# Every span's duration, by span name
+SPAN_SECONDS = GetHistogram('runman_span_seconds', 'Seconds spent in each phase of running jobs, by span name')
+
+
+class Span(object):
+  """A timed phase, with the spans nested in it"""
+  __slots__ = ('name', 'id', 'started', 'duration', 'spans')
+
+  def __init__(self, name, span_id=None):
+    self.name = name
+    self.id = span_id
+    self.started = time.time()
+
+    # Seconds, once finished
+    self.duration = None
+
+    self.spans = []
+
+
+  def Finish(self):
+    """Finish the span.  Spans still open inside it in this thread are closed, without a duration."""
+    if self.duration != None:
+      return
+
+    self.duration = time.time() - self.started
+
+    stack = GetSpanStack()
+    if self in stack:
+      del stack[stack.index(self):]
+
+    SPAN_SECONDS.Observe(self.duration, {'span':self.name})
+
+
+  def GetData(self):
+    """Returns dict, this span and its nested spans: name, id (if any), started, duration, spans (if any)"""
+    data = {'name':self.name, 'started':self.started, 'duration':self.duration}
+    if self.id != None:
+      data['id'] = self.id
+
+    #NOTE(g): Copied, as other threads may still be adding spans
+    spans = list(self.spans)
+    if spans:
+      data['spans'] = [span.GetData() for span in spans]
+
+    return data
+
+
+def GetSpanStack():
+  """Returns list, the open spans of this thread, innermost last"""
+  stack = getattr(SPAN_STACKS, 'stack', None)
+  if stack == None:
+    stack = []
+    SPAN_STACKS.stack = stack
+
+  return stack
+
+
+def StartSpan(name, parent=None, span_id=None):
+  """Returns Span, started now, nested in parent.  Call Finish() on it when the phase is over, in a finally block.
+
+  Args:
+    name: string, the phase.  Keep the names few, they are histogram labels.
+    parent: Span (optional), default is the innermost open span of this thread, if any
+    span_id: string (optional), what this span is of, ex: a run item id
+  """
+  stack = GetSpanStack()
+  if parent == None and stack:
+    parent = stack[-1]
+
+  span = Span(name, span_id)
+
+  #NOTE(g): list.append() is atomic, so threads can add to the same parent
+  if parent != None:
+    parent.spans.append(span)
+
+  stack.append(span)
+
+  return span
+
+
+def StartServer(port, host='localhost'):
+  """Returns HTTPServer, serving the metrics (any path) in the Prometheus text format from a background thread"""
+  # Only the client serves metrics, so dont make every command import these
+  import SocketServer
+  import BaseHTTPServer
+
+  class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+      body = FormatPrometheus()
+      self.send_response(200)
+      self.send_header('Content-Type', CONTENT_TYPE)
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+      """Quiet, scrapes would fill our log"""
+      pass
+
+  class MetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+  server = MetricsServer((host, port), MetricsRequestHandler)
+
+  thread = threading.Thread(target=server.serve_forever, name='metrics-server')
+  thread.daemon = True
+  thread.start()
+
+  return server
+
+
+def WriteFile(path):
+  """Write the metrics to path, in the Prometheus text format.  Written and renamed, so readers never see part of it."""
+  metrics_dir = os.path.dirname(os.path.abspath(path))
+  if not os.path.isdir(metrics_dir):
+    os.makedirs(metrics_dir, 0700)
+
+  (fd, temp_path) = tempfile.mkstemp(dir=metrics_dir, prefix='.metrics_')
+  fp = os.fdopen(fd, 'w')
+  try:
+    fp.write(FormatPrometheus())
+  finally:
+    fp.close()
+
+  os.chmod(temp_path, 0644)
+  os.rename(temp_path, path)
+
+
+def StartFileWriter(path, interval=FILE_INTERVAL):
+  """Returns Thread, writing the metrics to path every interval seconds"""
+  def Writer():
+    while True:
+      try:
+        WriteFile(path)
+      except (IOError, OSError), e:
+        log('Failed to write metrics file: %s: %s' % (path, e), level='warning')
+
+      time.sleep(interval)
+
+  thread = threading.Thread(target=Writer, name='metrics-writer')
+  thread.daemon = True
+  thread.start()
+
+  return thread
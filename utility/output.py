@@ -0,0 +1,198 @@
+"""
+Output: Format command results, writing them as they are generated
+
+A command result is a dict.  Values that are Streams are generated while they are written, so output starts with the
+first record instead of after the last, and the whole result never has to be in memory at once.  Streams are written
+first, then the other values, so values that are filled in while the streams are generated (errors, summaries) are
+complete when written.
+
+Formats:
+  json      One JSON document.  Streams are written item by item inside it.
+  jsonl     JSON lines: one line for each stream item, {key: item} ({key: {item key: item value}} for mapping
+            streams), then one line with the other values.
+  yaml      One YAML document.  Streams are written item by item inside it.  Uses the C LibYAML dumper if available.
+  pprint    Python pretty print, for people.  Stream items are printed one at a time.
+"""
+
+
+import sys
+import json
+import pprint
+
+
+# Output formats we support
+OUTPUT_FORMATS = ['json', 'jsonl', 'yaml', 'pprint']
+
+# YAML dumper class, set on first use, as importing PyYAML is slow
+YAML_DUMPER = None
+
+
+class Stream(object):
+  """A result value generated as it is written: items of a list, or (key, value) pairs of a mapping"""
+
+  def __init__(self, iterable, mapping=False):
+    self.iterable = iterable
+    self.mapping = mapping
+
+
+  def __iter__(self):
+    return iter(self.iterable)
+
+
+def GetYamlDumper():
+  """Returns the YAML dumper class: the C LibYAML dumper if PyYAML was built with it, it is many times faster"""
+  global YAML_DUMPER
+
+  if YAML_DUMPER == None:
+    import yaml
+
+    try:
+      YAML_DUMPER = yaml.CDumper
+    except AttributeError:
+      YAML_DUMPER = yaml.Dumper
+
+  return YAML_DUMPER
+
+
+def DumpYaml(data):
+  """Returns string, data as YAML"""
+  import yaml
+  return yaml.dump(data, Dumper=GetYamlDumper())
+
+
+def Indent(text, indent='  '):
+  """Returns string, every line of text indented.  Blank lines are left blank, they may be inside a YAML scalar."""
+  lines = []
+  for line in text.splitlines(True):
+    if line.strip():
+      lines.append(indent + line)
+    else:
+      lines.append(line)
+
+  return ''.join(lines)
+
+
+class OutputWriter(object):
+  """Writes command results in an output format"""
+
+  def __init__(self, output_format, output=None):
+    if output_format not in OUTPUT_FORMATS:
+      raise Exception('Unknown output format "%s", supported formats: %s' % (output_format, ', '.join(OUTPUT_FORMATS)))
+
+    self.output_format = output_format
+
+    # None writes to whatever sys.stdout is at the time
+    self.output = output
+
+
+  def Write(self, result):
+    """Write a result dict.  Stream values are written first, as they are generated."""
+    streams = [(key, value) for (key, value) in result.items() if isinstance(value, Stream)]
+    streams.sort()
+
+    if self.output_format == 'json':
+      self.WriteJson(result, streams)
+    elif self.output_format == 'jsonl':
+      self.WriteJsonLines(result, streams)
+    elif self.output_format == 'yaml':
+      self.WriteYaml(result, streams)
+    elif self.output_format == 'pprint':
+      self.WritePprint(result, streams)
+
+
+  def Emit(self, text):
+    """Write text now, so whoever reads our output gets it as soon as we have it"""
+    output = self.output or sys.stdout
+    output.write(text)
+    output.flush()
+
+
+  def GetValues(self, result):
+    """Returns dict, the result values that are not streams.  Only call once the streams are written."""
+    return dict([(key, value) for (key, value) in result.items() if not isinstance(value, Stream)])
+
+
+  def WriteJson(self, result, streams):
+    self.Emit('{')
+
+    separator = ''
+    for (key, stream) in streams:
+      if stream.mapping:
+        (start, end) = ('{', '}')
+      else:
+        (start, end) = ('[', ']')
+
+      self.Emit('%s%s: %s' % (separator, json.dumps(key), start))
+
+      item_separator = ''
+      for item in stream:
+        if stream.mapping:
+          self.Emit('%s%s: %s' % (item_separator, json.dumps(item[0]), json.dumps(item[1])))
+        else:
+          self.Emit(item_separator + json.dumps(item))
+        item_separator = ', '
+
+      self.Emit(end)
+      separator = ', '
+
+    # The rest of the values, without the braces
+    values = self.GetValues(result)
+    if values:
+      self.Emit(separator + json.dumps(values)[1:-1])
+
+    self.Emit('}\n')
+
+
+  def WriteJsonLines(self, result, streams):
+    for (key, stream) in streams:
+      for item in stream:
+        if stream.mapping:
+          self.Emit(json.dumps({key:{item[0]:item[1]}}) + '\n')
+        else:
+          self.Emit(json.dumps({key:item}) + '\n')
+
+    values = self.GetValues(result)
+    if values:
+      self.Emit(json.dumps(values) + '\n')
+
+
+  def WriteYaml(self, result, streams):
+    for (key, stream) in streams:
+      written = False
+      for item in stream:
+        # Key goes out with the first item, so an empty stream can be written as an empty value
+        if not written:
+          self.Emit('%s:\n' % key)
+          written = True
+
+        if stream.mapping:
+          self.Emit(Indent(DumpYaml({item[0]:item[1]})))
+        else:
+          self.Emit(Indent(DumpYaml([item])))
+
+      if not written:
+        self.Emit(DumpYaml({key:{} if stream.mapping else []}))
+
+    values = self.GetValues(result)
+    if values:
+      self.Emit(DumpYaml(values))
+
+
+  def WritePprint(self, result, streams):
+    for (key, stream) in streams:
+      self.Emit('%r:\n' % key)
+
+      for item in stream:
+        if stream.mapping:
+          self.Emit(Indent(pprint.pformat({item[0]:item[1]}) + '\n'))
+        else:
+          self.Emit(Indent(pprint.pformat(item) + '\n'))
+
+    values = self.GetValues(result)
+    if values or not streams:
+      self.Emit(pprint.pformat(values) + '\n')
+
+
+def Write(result, output_format, output=None):
+  """Write a command result in output_format.  See OutputWriter."""
+  OutputWriter(output_format, output).Write(result)
@@ -0,0 +1,181 @@
+"""
+Plan: Compile a job spec once into an execution plan, reused for every run of the job
+
+The plan has everything a run needs that does not depend on the input data: the input validator, command templates
+and the input keys they reference, test functions resolved to callables, regexes compiled, log templates parsed, and
+the run item graph for each platform.  Plans are cached per job spec file version.
+
+NOTE: Plans are shared between runs and threads.  They must not be modified.
+"""
+
+
+import os
+import re
+import operator
+import threading
+
+import specs
+import watch
+import rungraph
+import validate
+
+
+# Python string formatting keys in a template, with any conversion: %(key)s, %(key)d, %(key).1f
+TEMPLATE_KEY_REGEX = re.compile('%\((.*?)\)')
+
+# Test functions: name: function(value, test value).  Regex functions get their test value compiled.
+TEST_FUNCTIONS = {
+  '==':operator.eq,
+  'equals':operator.eq,
+  '!=':operator.ne,
+  'not equals':operator.ne,
+  'notequals':operator.ne,
+  'in':lambda value, test_value: value in test_value,
+  'not in':lambda value, test_value: value not in test_value,
+  'notin':lambda value, test_value: value not in test_value,
+  '>':operator.gt,
+  '<':operator.lt,
+  '>=':operator.ge,
+  '<=':operator.le,
+  'regex':lambda value, pattern: pattern.search(str(value)) != None,
+  'not regex':lambda value, pattern: pattern.search(str(value)) == None,
+  '!regex':lambda value, pattern: pattern.search(str(value)) == None,
+}
+REGEX_TEST_FUNCTIONS = ('regex', 'not regex', '!regex')
+
+# Compiled plans: absolute job spec path: JobPlan
+PLANS = {}
+PLANS_LOCK = threading.Lock()
+
+
+class Template(object):
+  """Python string format template, with the keys it references parsed out once"""
+  __slots__ = ('text', 'keys', 'keys_only')
+
+  def __init__(self, text, keys_only=False):
+    """
+    Args:
+      keys_only: boolean, only format the template if it references keys, so text like "date +%Y" is left as is
+        (commands).  Otherwise it is always formatted, and "%%" is a "%" (log messages).
+    """
+    self.text = text
+    self.keys = tuple(TEMPLATE_KEY_REGEX.findall(text))
+    self.keys_only = keys_only
+
+  def Format(self, data):
+    """Returns string, the template formatted with data"""
+    if self.keys or not self.keys_only:
+      return self.text % data
+    else:
+      return self.text
+
+
+class TestPlan(object):
+  """A compiled run item test"""
+  __slots__ = ('index', 'test_case', 'when', 'key', 'function_name', 'function', 'value', 'stream', 'critical', 'warning',
+               'log_success', 'log_failure')
+
+  def __init__(self, index, test_case):
+    self.index = index
+    self.test_case = test_case
+    self.when = test_case.get('when', None)
+    self.key = test_case.get('key', None)
+    self.function_name = test_case.get('function', None)
+
+    # Unknown functions have no callable, and always fail
+    self.function = TEST_FUNCTIONS.get(self.function_name, None)
+
+    if self.function_name in REGEX_TEST_FUNCTIONS:
+      self.value = re.compile(str(test_case['value']))
+    else:
+      self.value = test_case.get('value', None)
+
+    # Evaluated on output as it streams in (watch module)
+    self.stream = watch.IsStreamTest(test_case)
+
+    self.critical = test_case.get('critical', False)
+    self.warning = test_case.get('warning', False)
+
+    self.log_success = None
+    if test_case.get('log success', None):
+      self.log_success = Template(test_case['log success'])
+
+    self.log_failure = None
+    if test_case.get('log failure', None):
+      self.log_failure = Template(test_case['log failure'])
+
+
+class RunItemPlan(object):
+  """A compiled run item"""
+  __slots__ = ('item_id', 'run_item', 'command', 'tests', 'watches')
+
+  def __init__(self, item_id, run_item):
+    self.item_id = item_id
+    self.run_item = run_item
+    self.command = Template(run_item['execute'], keys_only=True)
+    self.tests = tuple([TestPlan(index, test_case) for (index, test_case) in enumerate(run_item.get('tests', None) or [])])
+
+    # Stream tests for the output watcher, sharing the compiled patterns
+    self.watches = tuple([(test_plan.index, test_plan.test_case, test_plan.value) for test_plan in self.tests if test_plan.stream])
+
+
+class PlatformPlan(object):
+  """The compiled run items of one platform, as a run graph: list of (item_id, RunItemPlan, depends_on)"""
+  __slots__ = ('platform', 'graph', 'graph_error')
+
+  def __init__(self, platform, run_items):
+    self.platform = platform
+
+    # Invalid graphs are only an error if we try to run this platform
+    self.graph = None
+    self.graph_error = None
+    try:
+      graph = rungraph.BuildRunGraph(run_items)
+      self.graph = tuple([(item_id, RunItemPlan(item_id, run_item), depends_on) for (item_id, run_item, depends_on) in graph])
+    except rungraph.RunGraphError, e:
+      self.graph_error = str(e)
+
+
+class JobPlan(object):
+  """A compiled job spec"""
+  __slots__ = ('job_spec_path', 'identity', 'job_spec', 'validator', 'platforms')
+
+  def __init__(self, job_spec_path, identity, job_spec):
+    self.job_spec_path = job_spec_path
+    self.identity = identity
+    self.job_spec = job_spec
+    self.validator = validate.Validator(job_spec, job_spec_path)
+
+    self.platforms = {}
+    for (platform, run_items) in job_spec['run'].items():
+      self.platforms[platform] = PlatformPlan(platform, run_items or [])
+
+
+def CompileRunItem(run_item, item_id=None):
+  """Returns RunItemPlan, for a run item that is not part of a cached job plan"""
+  return RunItemPlan(item_id, run_item)
+
+
+def GetPlan(job_spec_path):
+  """Returns JobPlan for the job spec, compiled once per spec file version.  Raises errors from loading the spec."""
+  path = os.path.abspath(job_spec_path)
+  (identity, job_spec) = specs.LoadWithIdentity(path)
+
+  PLANS_LOCK.acquire()
+  try:
+    job_plan = PLANS.get(path, None)
+  finally:
+    PLANS_LOCK.release()
+
+  if job_plan and job_plan.identity == identity:
+    return job_plan
+
+  job_plan = JobPlan(job_spec_path, identity, job_spec)
+
+  PLANS_LOCK.acquire()
+  try:
+    PLANS[path] = job_plan
+  finally:
+    PLANS_LOCK.release()
+
+  return job_plan
@@ -1,45 +1,71 @@
 """
 RunMan Platform: Determine OS platform (ex: linux_redhat, linux_debian, solaris)
 
-This is used to determine which execution block is used for a given job.  All platforms have files in 
+This is used to determine which execution block is used for a given job.  All platforms have files in
 different places and some other formatting issues, so their execution and success tests must be customized.
 
 This can be as detailed as necessary to separate running environments.
+
+The platform and hostname are host facts (see facts.py), so they are only determined once, and cached.
 """
 
 
+import os
 import sys
-import commands
+
+import facts
+
+
+# /etc/os-release IDs, and ID_LIKE entries, for each platform.  Other Linux distributions are "linux_<ID>".
+LINUX_PLATFORMS = {
+  'linux_redhat':('rhel', 'centos', 'fedora', 'rocky', 'almalinux', 'ol', 'amzn'),
+  'linux_debian':('debian', 'ubuntu'),
+}
 
 
 class PlatformNotFound(Exception):
   """No platform was able to be determined"""
 
 
-def GetPlatform():
-  """Returns a string, which is used to specify what to run for a given job"""
-  # Gather platform details
-  details = {}
-  details['python_platform'] = sys.platform
-  details['python_version'] = sys.version
-  
-  # Linux - Red Hat
-  if details['python_platform'] in ['linux2',] and 'Red Hat' in details['python_version']:
-    platform = 'linux_redhat'
-  
+def DetectPlatform(os_release):
+  """Returns a string, the platform, from sys.platform and os_release (dict from /etc/os-release, may be empty)"""
+  # Linux: by distribution, then by what it is like
+  if sys.platform.startswith('linux'):
+    os_id = os_release.get('ID', None)
+    os_like = os_release.get('ID_LIKE', '').split()
+
+    for os_name in [os_id] + os_like:
+      for (platform, os_ids) in LINUX_PLATFORMS.items():
+        if os_name in os_ids:
+          return platform
+
+    if os_id:
+      return 'linux_%s' % os_id
+
+    # Older distributions without os-release
+    if os.path.exists('/etc/redhat-release'):
+      return 'linux_redhat'
+    elif os.path.exists('/etc/debian_version'):
+      return 'linux_debian'
+
   # Solaris
-  elif details['python_platform'] in ['sunos5',]:
-    platform = 'solaris'
+  elif sys.platform in ['sunos5',]:
+    return 'solaris'
 
   # Failure to find a platform
-  else:  
-    raise PlatformNotFound('System Details: %s' % details)
-  
-  return platform
+  raise PlatformNotFound('System Details: %s' % {'python_platform':sys.platform, 'os_release':os_release})
 
 
-def GetHostname():
-  """Returns a string, the fully qualified domain name (FQDN) of this local host."""
-  (status, output) = commands.getstatusoutput('/bin/hostname')
-  return output.split('.')[0]
+def GetPlatform():
+  """Returns a string, which is used to specify what to run for a given job"""
+  host_facts = facts.GetFacts()
 
+  if not host_facts['platform']:
+    raise PlatformNotFound(host_facts.get('platform_error', None))
+
+  return host_facts['platform']
+
+
+def GetHostname():
+  """Returns a string, the short hostname of this local host."""
+  return facts.GetFacts()['hostname']
@@ -0,0 +1,125 @@
+"""
+Worker Pool: Run work items in a fixed number of threads
+
+Work is mostly waiting on subprocesses and the network, so threads give us the parallelism we need.
+"""
+
+
+import Queue
+import threading
+import time
+import traceback
+
+from log import log
+
+
+class WorkerPool(object):
+  """Fixed size pool of worker threads.  Results are handed to a callback as each work item finishes."""
+
+  def __init__(self, size, name='worker'):
+    self.size = max(1, int(size))
+    self.name = name
+    self.queue = Queue.Queue()
+
+    # Work items submitted and not yet finished.  The condition is notified whenever one finishes.
+    self.busy = 0
+    self.condition = threading.Condition()
+
+    self.threads = []
+    for count in range(self.size):
+      thread = threading.Thread(target=self._Worker, name='%s-%s' % (name, count))
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+
+
+  def Submit(self, function, args=(), kwargs=None, callback=None):
+    """Queue function(*args, **kwargs) to run.  callback(result, error) is called in the worker thread when finished."""
+    self.condition.acquire()
+    try:
+      self.busy += 1
+    finally:
+      self.condition.release()
+
+    self.queue.put((function, args, kwargs or {}, callback))
+
+
+  def Free(self):
+    """Returns int, number of workers not busy and without queued work"""
+    return max(0, self.size - self.busy)
+
+
+  def WaitForFree(self, timeout=None):
+    """Wait until a worker is free, or timeout seconds pass.  Returns int, number of free workers."""
+    self.condition.acquire()
+    try:
+      if self.Free() == 0:
+        self.condition.wait(timeout)
+      return self.Free()
+    finally:
+      self.condition.release()
+
+
+  def Join(self, timeout=None):
+    """Wait until all submitted work is finished, or timeout seconds pass.  Returns boolean, True if all finished."""
+    self.condition.acquire()
+    try:
+      deadline = None
+      if timeout != None:
+        deadline = time.time() + timeout
+
+      while self.busy > 0:
+        if deadline == None:
+          self.condition.wait()
+        elif deadline > time.time():
+          self.condition.wait(deadline - time.time())
+        else:
+          break
+
+      return self.busy == 0
+    finally:
+      self.condition.release()
+
+
+  def Stop(self):
+    """Finish all submitted work, then stop the worker threads"""
+    for thread in self.threads:
+      self.queue.put(None)
+
+    for thread in self.threads:
+      thread.join()
+
+    self.threads = []
+
+
+  def _Worker(self):
+    """Worker thread: run work items until we get a None"""
+    while True:
+      work = self.queue.get()
+      if work == None:
+        break
+
+      (function, args, kwargs, callback) = work
+      result = None
+      error = None
+
+      #NOTE(g): Catching BaseException, because Error() uses sys.exit() and that should fail this work item, not the thread
+      try:
+        result = function(*args, **kwargs)
+      except BaseException, e:
+        error = e
+        log('%s: Work item failed: %s\n%s' % (threading.current_thread().name, e, traceback.format_exc()))
+
+      try:
+        if callback:
+          callback(result, error)
+      except Exception, e:
+        log('%s: Work item callback failed: %s\n%s' % (threading.current_thread().name, e, traceback.format_exc()))
+
+      # Finished, let anyone waiting on a free worker know
+      self.condition.acquire()
+      try:
+        self.busy -= 1
+        self.condition.notify_all()
+      finally:
+        self.condition.release()
@@ -0,0 +1,174 @@
+"""
+Progress: Report on a job while it runs, so the server can tell a long running job from a stuck one
+
+Output from running run items is coalesced: only the most recent output of each stream is kept between sends.
+Progress is sent at most every "interval" seconds while there is new output, and a heartbeat is sent every
+"heartbeat" seconds even when there is none.
+
+Sent to the websource job_progress.  POST: id, data (JSON):
+  {"job last reported": timestamp, "duration": seconds, "run_items": {item_id: {"running":bool, "duration":seconds,
+   "stdout":recent output, "stderr":recent output, "exit_code":int}}}
+
+Progress is best effort: failed sends are logged and dropped, the next send has the latest state anyway.
+"""
+
+
+import json
+import time
+import threading
+
+from log import log
+
+import capture
+import transport
+
+
+# Defaults, if the job_progress websource doesnt specify them
+PROGRESS_INTERVAL = 5.0
+HEARTBEAT_INTERVAL = 60.0
+
+# Most recent bytes of each stream to keep between sends
+PROGRESS_OUTPUT_MAX = 16384
+
+
+class ProgressReporter(object):
+  """Progress for one job instance, sent from a background thread"""
+
+  def __init__(self, websource, job_id):
+    self.websource = websource
+    self.job_id = job_id
+
+    self.interval = websource.get('interval', None) or PROGRESS_INTERVAL
+    self.heartbeat = websource.get('heartbeat', None) or HEARTBEAT_INTERVAL
+    self.output_max = websource.get('output max', None) or PROGRESS_OUTPUT_MAX
+
+    self.started = time.time()
+    self.last_sent = self.started
+
+    # Run items: item_id: {"started":time, "running":bool, ...}.  Output since the last send: (item_id, stream): StreamCapture
+    self.items = {}
+    self.output = {}
+    self.changed = False
+
+    self.running = True
+    self.condition = threading.Condition()
+
+    self.thread = threading.Thread(target=self._Run, name='progress-%s' % job_id)
+    self.thread.daemon = True
+    self.thread.start()
+
+
+  def Changed(self):
+    """Something new to send.  Wake the progress thread, once, so it sleeps until the interval instead of the heartbeat.
+
+    Must hold the condition.
+    """
+    if not self.changed:
+      self.changed = True
+      self.condition.notify_all()
+
+
+  def ItemStarted(self, item_id):
+    self.condition.acquire()
+    try:
+      self.items[item_id] = {'started':time.time(), 'running':True}
+      self.Changed()
+    finally:
+      self.condition.release()
+
+
+  def ItemFinished(self, item_id, run_result):
+    self.condition.acquire()
+    try:
+      self.items[item_id]['running'] = False
+      self.items[item_id]['exit_code'] = run_result.get('exit_code', None)
+      self.items[item_id]['duration'] = run_result.get('duration', None)
+      self.Changed()
+    finally:
+      self.condition.release()
+
+
+  def GetListener(self, item_id):
+    """Returns function(name, data), a capture listener for this run item's output"""
+    def Listener(name, data):
+      self.Output(item_id, name, data)
+
+    return Listener
+
+
+  def Output(self, item_id, stream, data):
+    """Output from a run item.  Only the most recent output_max bytes are kept until the next send."""
+    self.condition.acquire()
+    try:
+      key = (item_id, stream)
+      if key not in self.output:
+        self.output[key] = capture.StreamCapture(stream, head_size=0, tail_size=self.output_max)
+
+      self.output[key].Write(data)
+      self.Changed()
+    finally:
+      self.condition.release()
+
+
+  def Stop(self):
+    """Stop reporting progress.  The final result is reported separately."""
+    self.condition.acquire()
+    try:
+      self.running = False
+      self.condition.notify_all()
+    finally:
+      self.condition.release()
+
+    self.thread.join()
+
+
+  def GetProgressData(self):
+    """Returns dict, progress data to send, and clears the output we have collected.  Must hold the condition."""
+    now = time.time()
+    run_items = {}
+
+    for (item_id, item) in self.items.items():
+      item_data = {'running':item['running']}
+      if item['running']:
+        item_data['duration'] = now - item['started']
+      else:
+        item_data['duration'] = item['duration']
+        item_data['exit_code'] = item['exit_code']
+
+      run_items[item_id] = item_data
+
+    for ((item_id, stream), stream_capture) in self.output.items():
+      run_items.setdefault(item_id, {})[stream] = stream_capture.GetText()
+
+    self.output = {}
+    self.changed = False
+
+    return {'job last reported':now, 'duration':now - self.started, 'run_items':run_items}
+
+
+  def _Run(self):
+    """Progress thread: send coalesced progress, rate limited, with heartbeats"""
+    while True:
+      self.condition.acquire()
+      try:
+        if not self.running:
+          break
+
+        # Send when there is something new and we are past the interval, or when the heartbeat is due
+        since_sent = time.time() - self.last_sent
+        if not (self.changed and since_sent >= self.interval) and since_sent < self.heartbeat:
+          if self.changed:
+            self.condition.wait(self.interval - since_sent)
+          else:
+            self.condition.wait(self.heartbeat - since_sent)
+          continue
+
+        progress_data = self.GetProgressData()
+        self.last_sent = time.time()
+      finally:
+        self.condition.release()
+
+      try:
+        transport.TRANSPORT.Request(self.websource, {'id':self.job_id, 'data':json.dumps(progress_data)})
+      except Exception, e:
+        log('Progress report failed: %s: %s' % (self.job_id, e))
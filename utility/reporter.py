@@ -0,0 +1,316 @@
+"""
+Reporter: Report job results to the websource job_report, off the job execution path
+
+Reports are appended to a spool file and sent by a background thread, in batches.  Failed sends are retried with
+exponential backoff.  Reports still in the spool when we stop (or crash) are sent when the next Reporter starts.
+
+Reports the server rejects with an HTTP client error (4xx, except 408 and 429) will never be accepted, so they are not
+retried: they are logged, moved to the dead letter file, and acknowledged.
+
+Spool files, in the spool directory:
+  reports.jsonl   One JSON report per line: {"sequence":N, "id":job_id, "data":json_string}
+  reports.ack     Sequence numbers that were sent successfully (or dead lettered), one per line
+  reports.dead    Reports the server rejected, one JSON report per line, with the "error"
+
+When everything in the spool has been sent, both files are truncated.  While reports are still pending, the spool is
+compacted (rewritten with only the pending reports) once SPOOL_COMPACT_ACKED reports have been acknowledged.
+"""
+
+
+import os
+import json
+import time
+import fcntl
+import threading
+import collections
+
+from log import log
+
+import transport
+
+
+# Most reports to send in one request
+REPORT_BATCH_SIZE = 50
+
+# Seconds to wait before the first retry after a failed send, doubled each retry up to the maximum
+RETRY_DELAY = 1.0
+RETRY_DELAY_MAX = 60.0
+
+# Compact the spool after this many acknowledged reports, if they are at least half of it
+SPOOL_COMPACT_ACKED = 1000
+
+# HTTP client errors that may succeed if retried: request timeout, too many requests
+RETRY_STATUSES = (408, 429)
+
+# Default spool directory, if the run spec doesnt specify "report spool path"
+SPOOL_PATH = os.path.join(os.path.expanduser('~'), '.runman', 'reports')
+
+
+class ReporterError(Exception):
+  """The reporter cannot use its spool"""
+
+
+def IsRejected(error):
+  """Returns boolean, True if the server rejected the request (HTTP 4xx), so sending it again cannot succeed"""
+  status = getattr(error, 'status', None)
+  return status != None and 400 <= status < 500 and status not in RETRY_STATUSES
+
+
+class Reporter(object):
+  """Spooled, batching, retrying reporter for one job_report websource"""
+
+  def __init__(self, websource, spool_path=SPOOL_PATH, batch_size=REPORT_BATCH_SIZE):
+    """
+    Args:
+      websource: dict, the job_report websource.  If it has "batch: true", reports are sent batched as a JSON list
+        in "reports", otherwise one request per report with "id" and "data".
+      spool_path: string, directory for the spool files
+      batch_size: int, most reports per request
+    """
+    self.websource = websource
+    self.spool_path = spool_path
+    self.batch_size = batch_size
+
+    if not os.path.isdir(spool_path):
+      os.makedirs(spool_path, 0700)
+
+    self.spool_file_path = os.path.join(spool_path, 'reports.jsonl')
+    self.ack_file_path = os.path.join(spool_path, 'reports.ack')
+    self.dead_file_path = os.path.join(spool_path, 'reports.dead')
+
+    # Only one reporter may use a spool, or reports would be sent twice
+    self.spool_file = self.OpenSpoolFile(self.spool_file_path)
+    self.ack_file = open(self.ack_file_path, 'a+')
+
+    # Pending reports: (sequence, job_id, data)
+    self.pending = collections.deque()
+    self.sequence = 0
+
+    # Reports acknowledged since the spool was last compacted
+    self.acked = 0
+
+    self.running = True
+    self.condition = threading.Condition()
+
+    self.Replay()
+
+    self.thread = threading.Thread(target=self._Run, name='reporter')
+    self.thread.daemon = True
+    self.thread.start()
+
+
+  def OpenSpoolFile(self, path):
+    """Returns file, path opened for appending and locked.  Raises ReporterError if another process has it locked."""
+    spool_file = open(path, 'a+')
+    try:
+      fcntl.flock(spool_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+      spool_file.close()
+      raise ReporterError('Report spool is in use by another process: %s' % path)
+
+    return spool_file
+
+
+  def Replay(self):
+    """Load reports from the spool that were never acknowledged, to send them again"""
+    self.spool_file.seek(0)
+    self.ack_file.seek(0)
+
+    acked = set()
+    for line in self.ack_file:
+      if line.strip():
+        acked.add(int(line))
+    self.acked = len(acked)
+
+    for line in self.spool_file:
+      # A partial last line, from a crash while writing
+      try:
+        report = json.loads(line)
+      except ValueError:
+        continue
+
+      self.sequence = max(self.sequence, report['sequence'])
+      if report['sequence'] not in acked:
+        self.pending.append((report['sequence'], report['id'], report['data']))
+
+    if self.pending:
+      log('Reporter: replaying %s unsent report(s) from spool: %s' % (len(self.pending), self.spool_file_path))
+
+
+  def Report(self, job_id, data):
+    """Spool a report to be sent.  Returns immediately.
+
+    Args:
+      job_id: job request id
+      data: string, JSON result data
+    """
+    self.condition.acquire()
+    try:
+      self.sequence += 1
+      self.spool_file.write(json.dumps({'sequence':self.sequence, 'id':job_id, 'data':data}) + '\n')
+      self.spool_file.flush()
+
+      self.pending.append((self.sequence, job_id, data))
+      self.condition.notify_all()
+    finally:
+      self.condition.release()
+
+
+  def Pending(self):
+    """Returns int, reports not yet sent"""
+    return len(self.pending)
+
+
+  def Stop(self, timeout=10.0):
+    """Stop, after trying to send pending reports for up to timeout seconds.  Unsent reports stay in the spool."""
+    deadline = time.time() + timeout
+
+    self.condition.acquire()
+    try:
+      while self.pending and time.time() < deadline:
+        self.condition.wait(deadline - time.time())
+
+      self.running = False
+      self.condition.notify_all()
+    finally:
+      self.condition.release()
+
+    self.thread.join()
+
+    if self.pending:
+      log('Reporter: %s report(s) left in spool for next start: %s' % (len(self.pending), self.spool_file_path))
+
+    self.ack_file.close()
+    self.spool_file.close()
+
+
+  def Send(self, batch):
+    """Send a batch of (sequence, job_id, data).  Raises transport.TransportError on failure."""
+    if self.websource.get('batch', False):
+      reports = [{'id':job_id, 'data':data} for (sequence, job_id, data) in batch]
+      transport.TRANSPORT.Request(self.websource, {'reports':json.dumps(reports)})
+
+    else:
+      for (sequence, job_id, data) in batch:
+        try:
+          transport.TRANSPORT.Request(self.websource, {'id':job_id, 'data':data})
+        except transport.TransportError, e:
+          if not IsRejected(e):
+            raise
+
+          self.DeadLetter([(sequence, job_id, data)], e)
+          continue
+
+        # Acknowledge each as it goes, so a failure part way doesnt send them twice
+        self.Acknowledge([(sequence, job_id, data)])
+
+
+  def DeadLetter(self, batch, error):
+    """Move a batch the server rejected to the dead letter file, and acknowledge it, so it is not sent again"""
+    log('Reporter: server rejected %s report(s), moved to %s: %s' % (len(batch), self.dead_file_path, error), level='error')
+
+    fp = open(self.dead_file_path, 'a')
+    try:
+      for (sequence, job_id, data) in batch:
+        fp.write(json.dumps({'sequence':sequence, 'id':job_id, 'data':data, 'error':str(error)}) + '\n')
+    finally:
+      fp.close()
+
+    self.Acknowledge(batch)
+
+
+  def Acknowledge(self, batch):
+    """Mark a sent batch as acknowledged, and compact the spool if enough of it has been sent"""
+    self.condition.acquire()
+    try:
+      sequences = set([item[0] for item in batch])
+      unacked = [item for item in self.pending if item[0] in sequences]
+      if not unacked:
+        return
+
+      self.ack_file.write(''.join(['%s\n' % item[0] for item in unacked]))
+      self.ack_file.flush()
+
+      for item in unacked:
+        self.pending.remove(item)
+      self.acked += len(unacked)
+
+      # Everything sent: start the spool over
+      if not self.pending:
+        self.spool_file.truncate(0)
+        self.ack_file.truncate(0)
+        self.acked = 0
+
+      elif self.acked >= SPOOL_COMPACT_ACKED and self.acked >= len(self.pending):
+        self.Compact()
+
+      self.condition.notify_all()
+    finally:
+      self.condition.release()
+
+
+  def Compact(self):
+    """Rewrite the spool with only the pending reports, and clear the acknowledgements.  Call with the condition held.
+
+    The new spool is written to a temp file and renamed over the old one, so a crash leaves one or the other whole.
+    """
+    temp_path = self.spool_file_path + '.tmp'
+    fp = open(temp_path, 'w')
+    try:
+      for (sequence, job_id, data) in self.pending:
+        fp.write(json.dumps({'sequence':sequence, 'id':job_id, 'data':data}) + '\n')
+      fp.flush()
+      os.fsync(fp.fileno())
+    finally:
+      fp.close()
+
+    #NOTE(g): Lock the new spool before it replaces the old one, so no other process can take it over in between
+    spool_file = self.OpenSpoolFile(temp_path)
+    os.rename(temp_path, self.spool_file_path)
+    self.spool_file.close()
+    self.spool_file = spool_file
+
+    # Acknowledged sequences are no longer in the spool
+    self.ack_file.truncate(0)
+    self.acked = 0
+
+
+  def _Run(self):
+    """Reporter thread: send pending reports in batches, retrying failures"""
+    retry_delay = RETRY_DELAY
+
+    while True:
+      self.condition.acquire()
+      try:
+        while self.running and not self.pending:
+          self.condition.wait()
+
+        if not self.running:
+          break
+
+        batch = list(self.pending)[:self.batch_size]
+      finally:
+        self.condition.release()
+
+      try:
+        self.Send(batch)
+        self.Acknowledge(batch)
+        retry_delay = RETRY_DELAY
+
+      except Exception, e:
+        # The server will never accept this batch
+        if IsRejected(e):
+          self.DeadLetter(batch, e)
+          continue
+
+        log('Reporter: failed to send %s report(s), retrying in %s seconds: %s' % (len(batch), retry_delay, e))
+
+        # Wait before retrying, unless we are told to stop
+        self.condition.acquire()
+        try:
+          if self.running:
+            self.condition.wait(retry_delay)
+        finally:
+          self.condition.release()
+
+        retry_delay = min(RETRY_DELAY_MAX, retry_delay * 2)
@@ -3,25 +3,51 @@ Run a Job
 """
 
 
-import yaml
+import os
 import json
-import decimal
-import re
 import sys
 import time
-import commands
 import subprocess
 
 from log import log
 from error import Error
 
+import capture
+import specs
+import lock
+import rungraph
+import watch
+import plan
+import validate
+import facts
+import metrics
+
 
 class InputNotCollectable(Exception):
   """Cannot collect all required input from available collection methods and inputs"""
  
 
-def Run(run_spec, command_options, command_args, input_data=None):
-  """Run a job"""
+def Run(run_spec, command_options, command_args, input_data=None, progress=None):
+  """Run a job.  The result data has the timing of each phase of the job as "timing" (see metrics.py).
+  
+  Args:
+    progress: ProgressReporter (optional), receives run item status and output while the job runs
+  """
+  job_span = metrics.StartSpan('job')
+  try:
+    result_data = RunJob(run_spec, command_options, command_args, input_data, progress, job_span)
+  finally:
+    job_span.Finish()
+  
+  result_data['timing'] = job_span.GetData()
+  
+  log('Run Result Data: %s' % result_data, level='debug')
+  
+  return result_data
+
+
+def RunJob(run_spec, command_options, command_args, input_data, progress, job_span):
+  """Run a job, for Run().  Run items are timed in spans nested in job_span."""
   # Get the job spec name
   if len(command_args) < 1:
     Error('Missing job spec name to run', command_options)
@@ -36,26 +62,32 @@ def Run(run_spec, command_options, command_args, input_data=None):
     Error('Missing job spec key in run spec: %s' % job_spec_key, command_options)
 
   
-  # Load the job spec
+  # Load the job spec, compiled into an execution plan.  The plan is reused until the job spec file changes.
+  load_span = metrics.StartSpan('load_spec')
   try:
-    job_spec = yaml.load(open(job_spec_path))
+    job_plan = plan.GetPlan(job_spec_path)
   
   except Exception, e:
     Error('Failed to load job spec: %s: %s' % (job_spec_path, e), command_options)
   
+  load_span.Finish()
+  
+  job_spec = job_plan.job_spec
   
   
   # Fail if the platform is not in this job spec
-  if command_options['platform'] not in job_spec['run']:
+  if command_options['platform'] not in job_plan.platforms:
     Error('This platform is not supported by this job, no run commands available: %s' % command_options['platform'], command_options)
   
   
   # Initiate run procedures
   if not input_data:
     log('Retrieving input data manually')
-    input_data = RetrieveInputData(run_spec, job_spec, job_spec_path, command_options, command_args)
+    input_span = metrics.StartSpan('retrieve_input')
+    input_data = RetrieveInputData(run_spec, job_spec, job_spec_path, command_options, command_args, validator=job_plan.validator)
+    input_span.Finish()
   
-  log('Input Data: %s' % input_data)
+  log('Input Data: %s' % input_data, level='debug')
   
   # Run it...
   log('Running job: %s' % job_spec['data']['name'])
@@ -63,14 +95,36 @@ def Run(run_spec, command_options, command_args, input_data=None):
   
   # Get the run items for our current platform
   result_data = {'started':time.time(), 'run_results':[], 'success':None}
-  platform_run_items = job_spec['run'][command_options['platform']]
+  platform_plan = job_plan.platforms[command_options['platform']]
   
-  # Run each platform run item
-  for run_item in platform_run_items:
-    run_result = RunItem(run_spec, job_spec, job_spec_path, run_item, input_data, command_options, command_args)
+  # The run item graph was built with the plan.  Without ids, dependencies or parallel groups this runs them in sequence.
+  if platform_plan.graph_error:
+    Error('Invalid run items in job spec: %s: %s' % (job_spec_path, platform_plan.graph_error), command_options)
+  
+  # Run and test a single run item.  Called from the run graph workers, timed in a span of the job's.
+  def RunAndTestItem(item_id, item_plan):
+    item_span = metrics.StartSpan('run_item', parent=job_span, span_id=item_id)
+    try:
+      return RunAndTestItemPlan(item_id, item_plan)
+    finally:
+      item_span.Finish()
+  
+  def RunAndTestItemPlan(item_id, item_plan):
+    run_item = item_plan.run_item
+    run_result = RunItem(run_spec, job_spec, job_spec_path, run_item, input_data, command_options, command_args,
+                         item_id=item_id, progress=progress, item_plan=item_plan)
+    run_result['id'] = item_id
+    
+    # If we couldnt get our locks, the run item never ran, so there is nothing to test.  It failed.
+    if 'lock_error' in run_result:
+      run_test_results = [{'success':False, 'critical':True, 'log':run_result['lock_error']}]
     
-    # Test this data.  If this fails we will abort and exit the program, not continuing on below.
-    run_test_results = TestRunResult(run_spec, job_spec, job_spec_path, run_item, input_data, run_result, result_data, command_options, command_args)
+    # Test this data.  Failures stop anything depending on this run item from running.
+    else:
+      test_span = metrics.StartSpan('test')
+      run_test_results = TestRunResult(run_spec, job_spec, job_spec_path, run_item, input_data, run_result, result_data, command_options, command_args,
+                                       item_plan=item_plan)
+      test_span.Finish()
     run_result['test_results'] = run_test_results
     
     # Test overall success of this run item
@@ -80,13 +134,14 @@ def Run(run_spec, command_options, command_args, input_data=None):
         run_result['success'] = False
         break
     
-    # Track all the run results for our overall job
-    result_data['run_results'].append(run_result)
-    
-    # Stop running any more run items if we failed the last one.  We need all of them to be successful to keep going.
     if run_result['success'] == False:
-      log('Failed run test, aborting any more run items...')
-      break
+      log('Failed run test: %s' % item_id)
+    
+    return run_result
+  
+  # Run every run item we can.  We need all of them to be successful, so a failure skips anything downstream of it.
+  concurrency = run_spec.get('run item concurrency', rungraph.RUN_ITEM_CONCURRENCY)
+  (result_data['run_results'], result_data['skipped_run_items']) = rungraph.ExecuteRunGraph(platform_plan.graph, RunAndTestItem, concurrency)
   
   # Wrap everything up
   result_data['finished'] = time.time()
@@ -99,14 +154,16 @@ def Run(run_spec, command_options, command_args, input_data=None):
       all_success = False
       break
   
+  # Any run items skipped means the job didnt run completely
+  if result_data['skipped_run_items']:
+    all_success = False
+  
   # If we were not always successful, then we are not successful
   if not all_success:
     result_data['success'] = False
   else:
     result_data['success'] = True
   
-  log('Run Result Data: %s' % result_data)
-  
   # Report the results
   #ReportResult()...
   pass
@@ -116,10 +173,19 @@ def Run(run_spec, command_options, command_args, input_data=None):
 
 
 
-def RetrieveInputData(runspec, job_spec, job_spec_path, command_options, command_args):
-  """Returns the input_data, with all required data, or throws a InputNotCollectable exception if it cannot be collected"""
+def RetrieveInputData(runspec, job_spec, job_spec_path, command_options, command_args, validator=None, apply_facts=True):
+  """Returns the input_data, with all required data, or throws a InputNotCollectable exception if it cannot be collected
+  
+  Args:
+    validator: validate.Validator (optional), compiled from the job spec input.  Compiled now if not given.
+    apply_facts: boolean, default input keys from this host's facts ("fact: <name>").  If False, input keys with fact
+      defaults that were not given are left out, for the host that runs the job to default from its own facts.
+  """
   log('Retrieving Input Data')
   
+  if validator == None:
+    validator = validate.Validator(job_spec, job_spec_path)
+  
   # Start with no input fields
   input_data = {}
   
@@ -131,8 +197,16 @@ def RetrieveInputData(runspec, job_spec, job_spec_path, command_options, command
   
   # Load any input from file, if specified
   if command_options['input_path']:
+    # JSON from STDIN, as fan-out sends it to each host
+    if command_options['input_path'] == '-':
+      try:
+        input_data.update(json.load(sys.stdin))
+      
+      except Exception, e:
+        Error('Failed to load input from STDIN: %s' % e, command_options)
+    
     # JSON
-    if command_options['input_path'].endswith('.json'):
+    elif command_options['input_path'].endswith('.json'):
       # Attempt to load the specified input path
       try:
         input_data_loaded = json.load(open(command_options['input_path']))
@@ -145,7 +219,7 @@ def RetrieveInputData(runspec, job_spec, job_spec_path, command_options, command
     elif command_options['input_path'].endswith('.yaml'):
       # Attempt to load the specified input path
       try:
-        input_data_loaded = yaml.load(open(command_options['input_path']))
+        input_data_loaded = specs.ParseYaml(command_options['input_path'])
         input_data.update(input_data_loaded)
       
       except Exception, e:
@@ -156,6 +230,11 @@ def RetrieveInputData(runspec, job_spec, job_spec_path, command_options, command
       Error('Unknown input file data type (suffic unknown, acceptable: .yaml, .json): %s' % command_options['input_path'], command_options)
 
   
+  # Input keys that default to host facts, if we still dont have them
+  if apply_facts:
+    input_data = facts.ApplyInputDefaults(job_spec, input_data)
+  
+  
   # Collect and validate input fields
   validated_input = {}
   missing_input = []
@@ -164,17 +243,24 @@ def RetrieveInputData(runspec, job_spec, job_spec_path, command_options, command
   # Validate Input from input path and determine input we still do not have, which needs to be collected
   #NOTE(g): Note this is done before collection (which needs to be validated as well) to reduce wasted time/effort if it's going
   #   to fail on this input, better to do it before making the user input the collected data interactively.
+  validate_span = metrics.StartSpan('validate_input')
   for (key, value) in job_spec['input'].items():
     # If we have this key in input data, validate
     if key in input_data:
       # Get the validated and processed input.
       #NOTE(g): Any errors abort the run, so no error checking is necessary.
-      validated_input[key] = ValidateInput(job_spec, job_spec_path, key, input_data[key], command_options)
+      validated_input[key] = ValidateInput(job_spec, job_spec_path, key, input_data[key], command_options, validator=validator)
+    
+    # Left for the host that runs the job, to default from its facts
+    elif not apply_facts and value and value.get('fact', None):
+      continue
     
     # Else, add to our missing input to collect interactively
     else:
       missing_input.append(key)
   
+  validate_span.Finish()
+  
   # If we have validated input, log about it
   if validated_input:
     log('Validated input file data: %s item(s).  Collecting %s item(s) interactively.' % (len(validated_input), len(missing_input)))
@@ -195,7 +281,7 @@ def RetrieveInputData(runspec, job_spec, job_spec_path, command_options, command
     for (collected_key, collected_value) in collected_input.items():
       # Get the validated and processed input.
       #NOTE(g): Any errors abort the run, so no error checking is necessary.
-      validated_input[collected_key] = ValidateInput(job_spec, job_spec_path, collected_key, collected_value, command_options)
+      validated_input[collected_key] = ValidateInput(job_spec, job_spec_path, collected_key, collected_value, command_options, validator=validator)
       
       # Remove the collected key from missing input, not missing any more
       missing_input.remove(collected_key)
@@ -210,67 +296,20 @@ def RetrieveInputData(runspec, job_spec, job_spec_path, command_options, command
   return validated_input
 
 
-def ValidateInput(job_spec, job_spec_path, key, value, command_options):
-  """If successful, returns the processed value that passes validation.  If unsuccessful the run terminates with Error()."""
-  # Get validation information
-  input_validation = job_spec['input'][key]
-  
-  # There must be a type to validate on, any error aborts
-  if 'type' not in input_validation:
-    Error('Invalid input validation spec in job_spec: %s: Input "%s": No type was specified for validation' % (job_spec_path, key), command_options)
-  
-  # Text validation
-  if input_validation['type'] == 'text':
-    validated_value = str(value)
-    
-    # Minimum length: optional validation
-    if 'min length' in input_validation and len(validated_value) < input_validation['min']:
-      Error('Input Validation: Value is less than minimum (job_spec_path="%s", input_key="%s"): %s (min size = %s)' % (job_spec_path, key, len(validated_value), input_validation['min']), command_options)
-    
-    # Minimum length: optional validation
-    if 'max length' in input_validation and len(validated_value) < input_validation['max']:
-      Error('Input Validation: Value is more than maximum (job_spec_path="%s", input_key="%s"): %s (max size = %s)' % (job_spec_path, key, len(validated_value), input_validation['max']), command_options)
-    
-    # Regex Match Validation: optional validation
-    if 'regex validate' in input_validation and not re.findall(input_validation['regex validate'], validated_value):
-      Error('Input Validation: Regex match not found (job_spec_path="%s", input_key="%s"): %s (regex = "%s")' % (job_spec_path, key, validated_value, input_validation['regex validate']), command_options)
-    
-
-  # Integer
-  elif input_validation['type'] in ['integer', 'int']:
-    # Coerce to integer, or fail
-    try:
-      validated_value = int(value)
-    except Exception, e:
-      Error('Input Validation: Value is not an Integer (job_spec_path="%s", input_key="%s"): %s' % (job_spec_path, key, value), command_options)
-    
-    # Minimum value: optional validation
-    if 'min' in input_validation and validated_value < input_validation['min']:
-      Error('Input Validation: Value is less than minimum (job_spec_path="%s", input_key="%s"): %s < %s (min)' % (job_spec_path, key, validated_value, input_validation['min']), command_options)
-    
-    # Minimum value: optional validation
-    if 'max' in input_validation and validated_value < input_validation['max']:
-      Error('Input Validation: Value is more than maximum (job_spec_path="%s", input_key="%s"): %s > %s (max)' % (job_spec_path, key, validated_value, input_validation['max']), command_options)
-      
-
-  # Decimal
-  elif input_validation['type'] == 'decimal':
-    validated_value = decimal.Decimal(value)
-    
-    # Minimum value: optional validation
-    if 'min' in input_validation and validated_value < input_validation['min']:
-      Error('Input Validation: Value is less than minimum (job_spec_path="%s", input_key="%s"): %s < %s (min)' % (job_spec_path, key, value, input_validation['min']), command_options)
-    
-    # Minimum value: optional validation
-    if 'max' in input_validation and validated_value < input_validation['max']:
-      Error('Input Validation: Value is more than maximum (job_spec_path="%s", input_key="%s"): %s > %s (max)' % (job_spec_path, key, value, input_validation['max']), command_options)
+def ValidateInput(job_spec, job_spec_path, key, value, command_options, validator=None):
+  """If successful, returns the processed value that passes validation.  If unsuccessful the run terminates with Error().
   
-  # Unknown - fail
-  else:
-    Error('Unknown input validation type (job_spec_path="%s", input_key="%s"): %s' % (job_spec_path, key, input_validation['type']), command_options)
+  Args:
+    validator: validate.Validator (optional), compiled from the job spec input.  Compiled now if not given.
+  """
+  if validator == None:
+    validator = validate.Validator(job_spec, job_spec_path)
   
-
-  return validated_value
+  try:
+    return validator.Validate(key, value)
+  
+  except validate.ValidationError, e:
+    Error('Input Validation: %s (job_spec_path="%s")' % (e, job_spec_path), command_options)
   
 
 def CollectInput(job_spec, job_spec_path, missing_input, command_options):
@@ -331,119 +370,174 @@ def CollectInput(job_spec, job_spec_path, missing_input, command_options):
   return collected_data
 
 
-def RunItem(run_spec, job_spec, job_spec_path, run_item, input_data, command_options, command_args):
-  """Run a job platform run item."""
-  log('Run Item: %s' % run_item)
+def RunItem(run_spec, job_spec, job_spec_path, run_item, input_data, command_options, command_args, item_id=None, progress=None,
+            item_plan=None):
+  """Run a job platform run item.
+  
+  Args:
+    item_id: string (optional), id of this run item in the run graph
+    progress: ProgressReporter (optional), receives this run item's status and output while it runs
+    item_plan: RunItemPlan (optional), the compiled run item.  Compiled now if not given.
+  """
+  log('Run Item: %s' % run_item, level='debug')
+  
+  if item_plan == None:
+    item_plan = plan.CompileRunItem(run_item, item_id)
   
   # Start
   result = {'started':time.time()}
   
-  # Execute
-  command = run_item['execute']
+  # Every input key the command references must be in our input data
+  missing_keys = [key for key in item_plan.command.keys if key not in input_data]
+  if missing_keys:
+    Error('Run item command references input keys missing from input data: %s: %s' % (', '.join(missing_keys), item_plan.command.text), command_options)
   
-  # If we have python string formatting to do with our data, do it
-  if re.findall('%\(.*?\)s', command):
-    command = command % input_data
+  # Execute, with our input data formatted into the command
+  command = item_plan.command.Format(input_data)
   
   log('Run Command: %s' % command)
   result['command'] = command
   
-  #TODO(g): Get a distinct data stream for STDOUT and STDERR, also need to poll these so I can report on long running jobs.
-  #   This just gets us working.
+  # Acquire all our locks before we start.  If we cant get them, this run item fails without running.
+  lock_span = metrics.StartSpan('lock')
+  try:
+    held_locks = lock.AcquireLocks(run_spec, run_item, input_data)
+    lock_span.Finish()
+  
+  except lock.LockUnavailable, e:
+    lock_span.Finish()
+    log('Run Item lock failure: %s' % e)
+    result['lock_error'] = str(e)
+    result['finished'] = time.time()
+    result['duration'] = result['finished'] - result['started']
+    return result
+  
   #(status, output) = commands.getstatusoutput(command)
-  (status, output, output_error) = RunShell(command)
+  try:
+    stdout_capture = capture.CreateCapture('stdout', run_item, run_spec.get('spool path', None))
+    stderr_capture = capture.CreateCapture('stderr', run_item, run_spec.get('spool path', None))
+    
+    # Report on long running items: output as it arrives goes to our progress reporter too
+    if progress:
+      progress.ItemStarted(item_id)
+      stdout_capture.AddListener(progress.GetListener(item_id))
+      stderr_capture.AddListener(progress.GetListener(item_id))
+    
+    # Evaluate "during" tests on the output as it arrives, so a critical failure can stop the process early
+    process_callback = None
+    watcher = watch.OutputWatcher(item_plan.watches)
+    if watcher.HasWatches():
+      stdout_capture.AddListener(watcher.Output)
+      stderr_capture.AddListener(watcher.Output)
+      process_callback = watcher.SetProcess
+    
+    (status, output, output_error) = RunShell(command, stdout_capture, stderr_capture, process_callback)
+  
+  finally:
+    lock.ReleaseLocks(held_locks)
   
   # Finish
   result['finished'] = time.time()
   result['duration'] = result['finished'] - result['started']
   result['exit_code'] = status
   
-  #TODO(g): Separate STDOUT and STDERR, so we can operate on them differently.  For now, just make them the same to get things going...
   result['stdout'] = output
   result['stderr'] = output_error
   
+  # Output stream details: full sizes, whether the middle was dropped from memory, and where the full stream was spooled
+  for stream_capture in (stdout_capture, stderr_capture):
+    result['%s_size' % stream_capture.name] = stream_capture.size
+    result['%s_truncated' % stream_capture.name] = stream_capture.IsTruncated()
+    if stream_capture.spool_path:
+      result['%s_spool' % stream_capture.name] = stream_capture.spool_path
+  
+  # Stream test results, and if we killed the process for a critical failure
+  if watcher.HasWatches():
+    result['during_matches'] = watcher.GetMatches()
+    if watcher.aborted:
+      result['aborted'] = watcher.aborted
+  
+  if progress:
+    progress.ItemFinished(item_id, result)
+  
   return result
 
 
-def TestRunResult(run_spec, job_spec, job_spec_path, run_item, input_data, run_result, result_data, command_options, command_args):
-  """Test the run_result for the run_item.  Abort, report and exit if we fail any of the tests."""
-  log('Test Run Result: %s' % run_result)
+def TestRunResult(run_spec, job_spec, job_spec_path, run_item, input_data, run_result, result_data, command_options, command_args,
+                  item_plan=None):
+  """Test the run_result for the run_item.  Abort, report and exit if we fail any of the tests.
+  
+  Args:
+    item_plan: RunItemPlan (optional), the compiled run item, with its test functions and patterns.  Compiled now if not given.
+  """
+  log('Test Run Result: %s' % run_result, level='debug')
+  
+  if item_plan == None:
+    item_plan = plan.CompileRunItem(run_item)
   
   # List of dicts, with test result information (critical, warning, success)
   test_results = []
   
-  for test_case in run_item['tests']:
+  for test_plan in item_plan.tests:
+    # Stream tests were evaluated on the output as it arrived.  Once finished, we have their first matches.
+    if test_plan.stream:
+      if 'finished' not in run_result:
+        continue
+      
+      value = run_result.get('during_matches', {}).get(test_plan.index, None)
+    
     # Skip test case if this when doesnt match
-    if 'finished' in run_result and test_case['when'] != 'finished':
+    elif 'finished' in run_result and test_plan.when != 'finished':
       continue
-    elif 'finished' not in run_result and test_case['when'] != 'during':
+    elif 'finished' not in run_result and test_plan.when != 'during':
       continue
-
+    
     # Ensure we have the test case field key we want to test, or fail
-    if test_case['key'] not in run_result:
-      Error('Missing test case key in run result: %s: %s' % (test_case['key'], run_result), command_options)
+    elif test_plan.key not in run_result:
+      Error('Missing test case key in run result: %s: %s' % (test_plan.key, run_result), command_options)
     
     # Get the value we are to operation on
-    value = run_result[test_case['key']]
+    else:
+      value = run_result[test_plan.key]
     
     # Create our test_result dict, and just append it to our list of test results now
     test_result = {}
     test_results.append(test_result)
     
-    # Test with specified function
-    if test_case['function'] in ['==', 'equals']:
-      # If pass
-      if value == test_case['value']:
-        test_result['success'] = True
-      
-      # If fail
-      else:
-        test_result['success'] = False
-    
-    
-    # Not Equals
-    elif test_case['function'] in ['!=', 'not equals']:
-      # If pass
-      if value != test_case['value']:
-        test_result['success'] = True
-      
-      # If fail
-      else:
-        test_result['success'] = False
+    # Stream test: success depends on if it matched
+    if test_plan.stream:
+      test_result['success'] = watch.IsStreamTestSuccess(test_plan.test_case, value)
     
+    # Test with specified function, resolved when the plan was compiled
+    elif test_plan.function:
+      test_result['success'] = bool(test_plan.function(value, test_plan.value))
     
-    # RegEx
-    elif test_case['function'] in ['regex']:
-      regex_result = re.findall(str(test_case['value']), str(value))
-      # If pass
-      if regex_result:
-        test_result['success'] = True
-      
-      # If fail
-      else:
-        test_result['success'] = False
+    # Unknown function, we cant say it passed
+    else:
+      log('Unknown test function: %s' % test_plan.function_name)
+      test_result['success'] = False
     
     
     # ---- Test Cases are Finished ----
     
     # If we had a failure
     if not test_result['success']:
-      if test_case.get('log failure', None):
-        log_message = test_case['log failure'] % run_result
+      if test_plan.log_failure:
+        log_message = test_plan.log_failure.Format(run_result)
         test_result['log'] = log_message
         log('Result Test Failure: %s' % log_message)
       
-      if test_case['critical']:
+      if test_plan.critical:
         test_result['critical'] = True
         break
       
-      if test_case['warning']:
+      if test_plan.warning:
         test_result['warning'] = True
     
     # Else, we had a success
     else:
-      if test_case.get('log success', None):
-        log_message = test_case['log success'] % run_result
+      if test_plan.log_success:
+        log_message = test_plan.log_success.Format(run_result)
         test_result['log'] = log_message
         log('Result Test Failure: %s' % log_message)
       
@@ -451,25 +545,44 @@ def TestRunResult(run_spec, job_spec, job_spec_path, run_item, input_data, run_r
   return test_results
   
 
-def RunShell(command):
+def RunShell(command, stdout_capture=None, stderr_capture=None, process_callback=None):
   """Run the command on the local machine.  Blocks until complete.
   
+  stdout and stderr are drained concurrently while the command runs, so large output cannot fill a pipe and hang us.
+  
   Args:
     command: string, command to execute
+    stdout_capture: StreamCapture (optional), receives stdout.  Default keeps the capture module head/tail sizes.
+    stderr_capture: StreamCapture (optional), receives stderr.  Default keeps the capture module head/tail sizes.
+    process_callback: function(Popen) (optional), called once the command is started.  The command is started in its
+      own process group, so everything it runs can be killed together with os.killpg().
   """
-  output_error = '' #Later, how to handle reading the timing stream between the two?  It's lost...
+  if stdout_capture == None:
+    stdout_capture = capture.StreamCapture('stdout')
+  if stderr_capture == None:
+    stderr_capture = capture.StreamCapture('stderr')
 
   # Subprocess is beautiful and finally makes this a pleasant experience!
   #   Imagine, OUTPUT, ERRORS and EXIT CODE!!!  Not exclusively choosing two!
   #   Newbs be rejoice in your ignorance.
+  preexec_function = None
+  if process_callback:
+    preexec_function = os.setsid
+  
+  spawn_span = metrics.StartSpan('spawn')
   pipe = subprocess.Popen(command, stdout=subprocess.PIPE,
-                          stderr=subprocess.PIPE, shell=True)
-  status = pipe.wait()
-  output = pipe.stdout.read()
-  output_error = pipe.stderr.read()
-  
-  # Close the pipes
-  pipe.stderr.close()
-  pipe.stdout.close()
+                          stderr=subprocess.PIPE, shell=True, preexec_fn=preexec_function)
+  spawn_span.Finish()
+  
+  if process_callback:
+    process_callback(pipe)
+  
+  # Drain both pipes until the process closes them, then get the exit code
+  drain_span = metrics.StartSpan('drain')
+  status = capture.DrainProcess(pipe, stdout_capture, stderr_capture)
+  drain_span.Finish()
+  
+  output = stdout_capture.GetText()
+  output_error = stderr_capture.GetText()
 
   return (status, output, output_error)
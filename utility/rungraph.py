@@ -0,0 +1,184 @@
+"""
+Run Graph: Execute a job's run items as a dependency graph, running independent items concurrently
+
+Run item keys:
+  id: string, name of this run item for "depends on".  Defaults to its position in the list ("#0", "#1", ...)
+  depends on: id, or list of ids, that must succeed before this item runs
+  parallel group: name.  Consecutive run items with the same parallel group run concurrently.
+
+Run items without "depends on" depend on the items before them (the previous item, or all of the previous parallel
+group), so a plain list runs in sequence, as it always has.
+"""
+
+
+import Queue
+
+from log import log
+from pool import WorkerPool
+
+
+# Run items to run at once, if the run spec doesnt specify "run item concurrency"
+RUN_ITEM_CONCURRENCY = 4
+
+
+class RunGraphError(Exception):
+  """The run items do not form a valid graph: duplicate or unknown ids, or a dependency cycle"""
+
+
+def GetRunItemId(run_item, index):
+  """Returns string, the id of this run item"""
+  if run_item.get('id', None) != None:
+    return str(run_item['id'])
+  else:
+    return '#%s' % index
+
+
+def BuildRunGraph(run_items):
+  """Returns list of (item_id, run_item, depends_on), in run item order.  Raises RunGraphError if invalid."""
+  graph = []
+  item_ids = set()
+
+  # Items in the previous stage: the previous item, or all of the previous parallel group
+  previous_stage = []
+  current_stage = []
+  current_group = None
+
+  for (index, run_item) in enumerate(run_items):
+    item_id = GetRunItemId(run_item, index)
+    if item_id in item_ids:
+      raise RunGraphError('Duplicate run item id: %s' % item_id)
+    item_ids.add(item_id)
+
+    # Start a new stage, unless we are continuing the current parallel group
+    group = run_item.get('parallel group', None)
+    if group == None or group != current_group:
+      previous_stage = current_stage
+      current_stage = []
+    current_group = group
+    current_stage.append(item_id)
+
+    # Explicit dependencies, or the previous stage
+    if run_item.get('depends on', None) != None:
+      depends_on = run_item['depends on']
+      if type(depends_on) not in (list, tuple):
+        depends_on = [depends_on]
+      depends_on = [str(depend_id) for depend_id in depends_on]
+    else:
+      depends_on = list(previous_stage)
+
+    graph.append((item_id, run_item, depends_on))
+
+  # All dependencies must exist
+  for (item_id, run_item, depends_on) in graph:
+    for depend_id in depends_on:
+      if depend_id not in item_ids:
+        raise RunGraphError('Run item "%s" depends on unknown run item: %s' % (item_id, depend_id))
+
+  # No cycles: repeatedly remove items whose dependencies have all been removed
+  remaining = dict([(item_id, set(depends_on)) for (item_id, run_item, depends_on) in graph])
+  while remaining:
+    ready = [item_id for (item_id, depends_on) in remaining.items() if not (depends_on & set(remaining))]
+    if not ready:
+      raise RunGraphError('Run item dependency cycle between: %s' % ', '.join(sorted(remaining)))
+
+    for item_id in ready:
+      del remaining[item_id]
+
+  return graph
+
+
+def IsCriticalFailure(run_result):
+  """Returns boolean, True if a critical test failed for this run result"""
+  for test_result in run_result.get('test_results', []):
+    if not test_result.get('success', False) and test_result.get('critical', False):
+      return True
+
+  return False
+
+
+def ExecuteRunGraph(graph, run_function, concurrency=RUN_ITEM_CONCURRENCY):
+  """Run every item of the graph whose dependencies succeeded, concurrently where the graph allows.
+
+  A failed item skips everything downstream of it.  A critical failure stops starting any more items.
+  Exceptions (including Error() exits) from run_function are raised here, once running items have finished.
+
+  Args:
+    graph: list, from BuildRunGraph()
+    run_function: function(item_id, run_item), returns run_result dict with a "success" key
+    concurrency: int, maximum run items to run at once
+
+  Returns: (run_results, skipped_ids).  run_results is a list of run_result dicts in run item order.
+  """
+  depends = dict([(item_id, depends_on) for (item_id, run_item, depends_on) in graph])
+  order = [item_id for (item_id, run_item, depends_on) in graph]
+
+  results = {}
+  failed = set()
+  skipped = set()
+  running = set()
+  aborted = False
+  raised = None
+
+  concurrency = max(int(concurrency or 1), 1)
+
+  finished_queue = Queue.Queue()
+  pool = WorkerPool(min(concurrency, len(graph)) or 1, name='run_item')
+
+  try:
+    while True:
+      # Start what is ready, unless we are stopping.  Only as many as can run now: queued items would still start after
+      #   a critical failure.
+      if not aborted and raised == None:
+        for (item_id, run_item, depends_on) in graph:
+          if len(running) >= concurrency:
+            break
+
+          if item_id in results or item_id in running or item_id in skipped:
+            continue
+
+          # Anything downstream of a failure is skipped
+          if [depend_id for depend_id in depends_on if depend_id in failed or depend_id in skipped]:
+            log('Skipping run item, dependency failed: %s' % item_id)
+            skipped.add(item_id)
+            continue
+
+          # Ready when all dependencies have finished
+          if [depend_id for depend_id in depends_on if depend_id not in results]:
+            continue
+
+          running.add(item_id)
+          pool.Submit(run_function, (item_id, run_item),
+                      callback=lambda result, error, item_id=item_id: finished_queue.put((item_id, result, error)))
+
+      # Nothing running, so nothing more will become ready
+      if not running:
+        break
+
+      # Wait for a run item to finish
+      (item_id, run_result, error) = finished_queue.get()
+      running.discard(item_id)
+
+      if error != None:
+        if raised == None:
+          raised = error
+        continue
+
+      results[item_id] = run_result
+
+      if not run_result['success']:
+        failed.add(item_id)
+
+        if IsCriticalFailure(run_result):
+          log('Critical failure in run item, aborting any more run items: %s' % item_id)
+          aborted = True
+
+  finally:
+    pool.Stop()
+
+  if raised != None:
+    raise raised
+
+  # Anything that never ran was skipped
+  skipped_ids = [item_id for item_id in order if item_id not in results]
+
+  return ([results[item_id] for item_id in order if item_id in results], skipped_ids)
@@ -0,0 +1,220 @@
+"""
+Scheduler: Hold job instances until they can run, and dispatch them the moment they can
+
+A job instance can run when its "start at" time has passed, and all of its "job dependencies" have completed
+successfully.  If a dependency fails, or they have not all completed within the dependency timeout (the job request
+"dependency timeout", or the scheduler's), the job instance fails without running.
+"""
+
+
+import time
+import heapq
+import threading
+import collections
+
+from log import log
+
+
+# Completed job ids to remember, for dependencies of job instances we have not seen yet
+COMPLETED_HISTORY = 10000
+
+# Seconds a job instance waits for its dependencies to complete, from its start time, before it fails
+DEPENDENCY_TIMEOUT = 3600.0
+
+# Formats we accept for "start at" text, if it isnt a timestamp
+START_AT_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d']
+
+
+def GetStartAt(job_request):
+  """Returns float, timestamp this job instance may start at.  0 if it can start now."""
+  start_at = job_request.get('start_at', job_request.get('start at', None))
+  if start_at in (None, ''):
+    return 0.0
+
+  try:
+    return float(start_at)
+  except (TypeError, ValueError):
+    pass
+
+  for start_at_format in START_AT_FORMATS:
+    try:
+      return time.mktime(time.strptime(str(start_at), start_at_format))
+    except ValueError:
+      pass
+
+  raise ValueError('Unknown "start at" time format: %s' % start_at)
+
+
+def GetDependencyTimeout(job_request, default=DEPENDENCY_TIMEOUT):
+  """Returns float, seconds this job instance waits for its dependencies.  Raises ValueError if it is not a number."""
+  timeout = job_request.get('dependency_timeout', job_request.get('dependency timeout', None))
+  if timeout in (None, ''):
+    return float(default)
+
+  return float(timeout)
+
+
+def GetDependencies(job_request):
+  """Returns list of strings, job ids this job instance depends on"""
+  dependencies = job_request.get('job_dependencies', job_request.get('job dependencies', None)) or []
+  if type(dependencies) not in (list, tuple):
+    dependencies = [dependencies]
+
+  return [str(depend_id) for depend_id in dependencies]
+
+
+class Scheduler(object):
+  """Dispatches job instances when runnable.  Call Complete() as each job instance finishes."""
+
+  def __init__(self, dispatch_function, fail_function, dependency_timeout=DEPENDENCY_TIMEOUT):
+    """
+    Args:
+      dispatch_function: function(job_request), called when a job instance can run
+      fail_function: function(job_request, reason), called when a job instance can never run (dependency failed, or
+        did not complete in time)
+      dependency_timeout: float, seconds job instances wait for their dependencies, unless their job request says
+    """
+    self.dispatch_function = dispatch_function
+    self.fail_function = fail_function
+    self.dependency_timeout = dependency_timeout
+
+    # Heap of (start_at, sequence, job_request, dependency timeout), for job instances waiting on their start time
+    self.heap = []
+    self.sequence = 0
+
+    # Job instances waiting on dependencies, by job id: (job_request, time to give up waiting)
+    self.waiting = {}
+
+    # Completed job ids: success boolean
+    self.completed = collections.OrderedDict()
+
+    self.running = True
+    self.condition = threading.Condition()
+
+    self.thread = threading.Thread(target=self._Run, name='scheduler')
+    self.thread.daemon = True
+    self.thread.start()
+
+
+  def Add(self, job_request):
+    """Schedule a job instance.  Raises ValueError if its "start at" or "dependency timeout" is not valid."""
+    start_at = GetStartAt(job_request)
+    dependency_timeout = GetDependencyTimeout(job_request, self.dependency_timeout)
+
+    self.condition.acquire()
+    try:
+      self.sequence += 1
+      heapq.heappush(self.heap, (start_at, self.sequence, job_request, dependency_timeout))
+      self.condition.notify_all()
+    finally:
+      self.condition.release()
+
+
+  def Complete(self, job_id, success):
+    """A job instance finished.  Anything waiting on it can now be dispatched (or failed)."""
+    self.condition.acquire()
+    try:
+      self.completed[str(job_id)] = bool(success)
+      while len(self.completed) > COMPLETED_HISTORY:
+        self.completed.popitem(last=False)
+
+      self.condition.notify_all()
+    finally:
+      self.condition.release()
+
+
+  def Pending(self):
+    """Returns int, job instances scheduled but not yet dispatched"""
+    self.condition.acquire()
+    try:
+      return len(self.heap) + len(self.waiting)
+    finally:
+      self.condition.release()
+
+
+  def Stop(self):
+    """Stop dispatching.  Anything not yet dispatched is dropped, the server will give it to us again."""
+    self.condition.acquire()
+    try:
+      self.running = False
+      self.condition.notify_all()
+    finally:
+      self.condition.release()
+
+    self.thread.join()
+
+
+  def _GetReady(self):
+    """Returns (ready, failed) lists of job instances.  Must hold the condition."""
+    ready = []
+    failed = []
+
+    # Start times that have passed: move them to waiting on their dependencies
+    now = time.time()
+    while self.heap and self.heap[0][0] <= now:
+      (start_at, sequence, job_request, dependency_timeout) = heapq.heappop(self.heap)
+      self.waiting[job_request['id']] = (job_request, now + dependency_timeout)
+
+    # Check dependencies of everything waiting
+    for (job_id, (job_request, give_up_at)) in self.waiting.items():
+      dependencies = GetDependencies(job_request)
+
+      failed_dependencies = [depend_id for depend_id in dependencies if self.completed.get(depend_id, None) == False]
+      incomplete_dependencies = [depend_id for depend_id in dependencies if depend_id not in self.completed]
+      if failed_dependencies:
+        del self.waiting[job_id]
+        failed.append((job_request, 'Job dependencies failed: %s' % ', '.join([str(item) for item in failed_dependencies])))
+
+      elif not incomplete_dependencies:
+        del self.waiting[job_id]
+        ready.append(job_request)
+
+      # Lost, never sent to us, or completed somewhere we wont hear of
+      elif give_up_at <= now:
+        del self.waiting[job_id]
+        failed.append((job_request, 'Job dependencies did not complete within %s seconds: %s' %
+                       (GetDependencyTimeout(job_request, self.dependency_timeout), ', '.join(incomplete_dependencies))))
+
+    return (ready, failed)
+
+
+  def _Run(self):
+    """Scheduler thread: dispatch job instances as they become runnable"""
+    while True:
+      self.condition.acquire()
+      try:
+        if not self.running:
+          break
+
+        (ready, failed) = self._GetReady()
+
+        # Nothing to do: sleep until the next start time or dependency timeout, or until something is added or completed
+        if not ready and not failed:
+          wake_times = [give_up_at for (job_request, give_up_at) in self.waiting.values()]
+          if self.heap:
+            wake_times.append(self.heap[0][0])
+
+          if wake_times:
+            self.condition.wait(max(0.0, min(wake_times) - time.time()))
+          else:
+            self.condition.wait()
+          continue
+
+      finally:
+        self.condition.release()
+
+      # Call out without holding our condition, they may call back into us
+      for (job_request, reason) in failed:
+        log('Scheduler: job instance cannot run: %s: %s' % (job_request['id'], reason))
+        try:
+          self.fail_function(job_request, reason)
+        except Exception, e:
+          log('Scheduler: failed to fail job instance: %s: %s' % (job_request['id'], e))
+        self.Complete(job_request['id'], False)
+
+      for job_request in ready:
+        log('Scheduler: dispatching job instance: %s' % job_request['id'])
+        try:
+          self.dispatch_function(job_request)
+        except Exception, e:
+          log('Scheduler: failed to dispatch job instance: %s: %s' % (job_request['id'], e))
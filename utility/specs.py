@@ -0,0 +1,327 @@
+"""
+Specs: Load YAML spec files (run specs, job specs, websources) through a cache
+
+Parsed specs are kept in memory keyed by their path, and checked against the file's mtime and size on each load.
+A compiled (pickled) copy is also kept on disk, so new processes do not have to parse the YAML again.
+
+Many specs can be loaded at once with LoadMany() or IterateMany(), in parallel processes that share the compiled disk cache.  When
+only the "data" block (name, component) is needed, LoadHeader() parses just that block of the file.
+
+NOTE: Loaded specs are shared between callers.  Do not modify them, copy them first.
+"""
+
+
+import os
+import cPickle
+import hashlib
+import tempfile
+import threading
+
+
+# YAML loader class, set on first parse.  PyYAML is only imported when we have to parse, as importing it is slow and
+#   compiled specs do not need it.
+YAML_LOADER = None
+
+# Directory for compiled spec files.  None or False disables the disk cache.  Set from the run spec "cache path" by
+#   LoadRunSpec().
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.runman', 'cache')
+
+# Change this if the compiled format changes, so old cache files are ignored
+CACHE_VERSION = 1
+
+# LoadMany(): load in parallel processes when there are at least this many specs.  Processes default to the CPU count.
+PARALLEL_MIN = 32
+PARALLEL_PROCESSES = None
+
+# LoadHeader(): top level key of the header block, and the suffix of the cache key for compiled headers
+HEADER_KEY = 'data'
+HEADER_CACHE_SUFFIX = '#header'
+
+# In memory cache: absolute path: (identity, data)
+CACHE = {}
+CACHE_LOCK = threading.Lock()
+
+
+def GetIdentity(path):
+  """Returns tuple, identifies this version of the file: (mtime, size, inode)"""
+  stat = os.stat(path)
+  return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+
+def GetYamlLoader():
+  """Returns the YAML loader class: the C LibYAML loader if PyYAML was built with it, it is many times faster"""
+  global YAML_LOADER
+
+  if YAML_LOADER == None:
+    import yaml
+
+    try:
+      YAML_LOADER = yaml.CLoader
+    except AttributeError:
+      YAML_LOADER = yaml.Loader
+
+  return YAML_LOADER
+
+
+def ParseYaml(path):
+  """Returns data, parsed from the YAML file at path.  No caching."""
+  import yaml
+
+  loader = GetYamlLoader()
+  fp = open(path)
+  try:
+    return yaml.load(fp, Loader=loader)
+  finally:
+    fp.close()
+
+
+def ParseYamlHeader(path, key=HEADER_KEY):
+  """Returns data, the top level key block of the YAML file at path, parsed on its own.
+
+  Returns None if the block is not in the file, or cannot be parsed on its own (ex: it uses an anchor from elsewhere).
+  """
+  import yaml
+
+  lines = []
+  fp = open(path)
+  try:
+    for line in fp:
+      # The block ends at the next top level line that is not blank or a comment
+      if lines:
+        if line.strip() and line[0] not in ' \t#':
+          break
+        lines.append(line)
+
+      elif line.startswith(key + ':'):
+        lines.append(line)
+  finally:
+    fp.close()
+
+  if not lines:
+    return None
+
+  try:
+    parsed = yaml.load(''.join(lines), Loader=GetYamlLoader())
+  except yaml.YAMLError:
+    return None
+
+  if type(parsed) != dict or key not in parsed:
+    return None
+
+  return parsed[key]
+
+
+def GetCacheFilePath(path):
+  """Returns string, path to the compiled cache file for this absolute spec path"""
+  return os.path.join(CACHE_PATH, '%s.cache' % hashlib.md5(path).hexdigest())
+
+
+def LoadCacheFile(path, identity):
+  """Returns data from the compiled cache file, or None if it is missing or out of date"""
+  if not CACHE_PATH:
+    return None
+
+  try:
+    fp = open(GetCacheFilePath(path), 'rb')
+  except IOError:
+    return None
+
+  try:
+    try:
+      (version, cached_path, cached_identity, data) = cPickle.load(fp)
+    except Exception:
+      return None
+  finally:
+    fp.close()
+
+  if version != CACHE_VERSION or cached_path != path or cached_identity != identity:
+    return None
+
+  return data
+
+
+def SaveCacheFile(path, identity, data):
+  """Save data to the compiled cache file.  Failures are ignored, the cache is only an optimization."""
+  if not CACHE_PATH:
+    return
+
+  try:
+    if not os.path.isdir(CACHE_PATH):
+      os.makedirs(CACHE_PATH, 0700)
+
+    # Write to a temp file and rename, so readers never see a partial file
+    (fd, temp_path) = tempfile.mkstemp(prefix='.spec_', dir=CACHE_PATH)
+    fp = os.fdopen(fd, 'wb')
+    try:
+      cPickle.dump((CACHE_VERSION, path, identity, data), fp, cPickle.HIGHEST_PROTOCOL)
+    finally:
+      fp.close()
+
+    os.rename(temp_path, GetCacheFilePath(path))
+
+  except (IOError, OSError, cPickle.PicklingError):
+    pass
+
+
+def LoadWithIdentity(path):
+  """Returns (identity, data): the parsed spec at path, and the identity of the file version it was parsed from."""
+  path = os.path.abspath(path)
+  identity = GetIdentity(path)
+
+  CACHE_LOCK.acquire()
+  try:
+    cached = CACHE.get(path, None)
+  finally:
+    CACHE_LOCK.release()
+
+  if cached and cached[0] == identity:
+    return cached
+
+  # Not in memory, try the compiled cache, then parse it
+  data = LoadCacheFile(path, identity)
+  if data == None:
+    data = ParseYaml(path)
+    SaveCacheFile(path, identity, data)
+
+  CACHE_LOCK.acquire()
+  try:
+    CACHE[path] = (identity, data)
+  finally:
+    CACHE_LOCK.release()
+
+  return (identity, data)
+
+
+def Load(path):
+  """Returns data, the parsed spec at path.  Raises the same errors as opening and parsing the file."""
+  return LoadWithIdentity(path)[1]
+
+
+def LoadRunSpec(path):
+  """Returns data, the run spec at path.  Sets CACHE_PATH from its "cache path", if it has one.
+
+  The run spec says where the disk cache is (or that there is none), so it is parsed, never read from or saved to the
+  disk cache.  It is kept in the memory cache.
+  """
+  global CACHE_PATH
+
+  path = os.path.abspath(path)
+  identity = GetIdentity(path)
+  data = ParseYaml(path)
+
+  if data.get('cache path', None) != None:
+    CACHE_PATH = data['cache path']
+    if CACHE_PATH:
+      CACHE_PATH = os.path.expanduser(CACHE_PATH)
+
+  CACHE_LOCK.acquire()
+  try:
+    CACHE[path] = (identity, data)
+  finally:
+    CACHE_LOCK.release()
+
+  return data
+
+
+def LoadHeader(path):
+  """Returns data, the "data" block of the spec at path.  Only that block is parsed, unless the spec is already cached.
+
+  Raises the same errors as opening and parsing the file.
+  """
+  path = os.path.abspath(path)
+  identity = GetIdentity(path)
+
+  CACHE_LOCK.acquire()
+  try:
+    cached = CACHE.get(path, None)
+  finally:
+    CACHE_LOCK.release()
+
+  if cached and cached[0] == identity:
+    return cached[1].get(HEADER_KEY, None)
+
+  data = LoadCacheFile(path, identity)
+  if data != None:
+    return data.get(HEADER_KEY, None)
+
+  # Headers are compiled to the disk cache on their own, so listing never needs to parse YAML either
+  header = LoadCacheFile(path + HEADER_CACHE_SUFFIX, identity)
+  if header != None:
+    return header
+
+  header = ParseYamlHeader(path)
+  if header != None:
+    SaveCacheFile(path + HEADER_CACHE_SUFFIX, identity, header)
+    return header
+
+  # The block could not be parsed on its own, parse the whole spec
+  return Load(path).get(HEADER_KEY, None)
+
+
+def _LoadWorker(work):
+  """Load one spec for LoadMany().  Returns (path, identity, data, error).  Runs in a pool process."""
+  (path, header) = work
+
+  try:
+    if header:
+      return (path, None, LoadHeader(path), None)
+    else:
+      (identity, data) = LoadWithIdentity(path)
+      return (path, identity, data, None)
+
+  except Exception, e:
+    return (path, None, None, '%s: %s' % (type(e).__name__, e))
+
+
+def IterateMany(paths, header=False, processes=None):
+  """Yields (path, data, error) for every spec in paths, as each is loaded.  Errors are strings, None if it loaded.
+
+  Args:
+    paths: list of strings, spec paths
+    header: boolean, only load the "data" block of each spec (see LoadHeader())
+    processes: int (optional), most processes to load with.  Defaults to PARALLEL_PROCESSES, or the CPU count.
+  """
+  work = [(path, header) for path in sorted(set(paths))]
+
+  if processes == None:
+    processes = PARALLEL_PROCESSES
+  if processes == None:
+    import multiprocessing
+    processes = multiprocessing.cpu_count()
+
+  processes = min(processes, len(work) / max(1, PARALLEL_MIN / 2))
+
+  # Few specs, or one CPU: not worth starting processes
+  if len(work) < PARALLEL_MIN or processes < 2:
+    for item in work:
+      (path, identity, data, error) = _LoadWorker(item)
+      yield (path, data, error)
+    return
+
+  #NOTE(g): Processes, not threads, as parsing is CPU bound.  Workers save what they parse to the disk cache, and we
+  #   keep it in our memory cache, so it is all shared.
+  import multiprocessing
+  pool = multiprocessing.Pool(processes)
+  try:
+    for (path, identity, data, error) in pool.imap(_LoadWorker, work, max(1, len(work) / (processes * 4))):
+      if identity != None:
+        CACHE_LOCK.acquire()
+        try:
+          CACHE[os.path.abspath(path)] = (identity, data)
+        finally:
+          CACHE_LOCK.release()
+
+      yield (path, data, error)
+
+  finally:
+    pool.terminate()
+    pool.join()
+
+
+def LoadMany(paths, header=False, processes=None):
+  """Returns dict, path: (data, error), loading every spec in paths.  See IterateMany()."""
+  loaded = {}
+  for (path, data, error) in IterateMany(paths, header, processes):
+    loaded[path] = (data, error)
+
+  return loaded
@@ -0,0 +1,237 @@
+"""
+Transport: HTTP requests to websources over persistent (keep-alive) connections
+
+Connections are pooled per scheme/host/port and reused between requests.  Response bodies may be gzip compressed,
+and request bodies are gzip compressed if the websource has "compress: true".
+
+Websource keys:
+  url: string, URL to request
+  username, password: string (optional), HTTP Basic authorization
+  timeout: float (optional), seconds for connecting and each read
+  retries: int (optional), retries after a connection failure or server error (5xx).  A retried request may reach the
+    server more than once, if it failed after it was sent.
+  retry delay: float (optional), seconds before the first retry, doubled for each retry after that
+  compress: boolean (optional), gzip the request body.  The server must accept "Content-Encoding: gzip".
+"""
+
+
+import time
+import zlib
+import gzip
+import base64
+import select
+import socket
+import urllib
+import httplib
+import urlparse
+import StringIO
+import threading
+
+from log import log
+
+
+# Defaults, if the websource does not specify them
+TIMEOUT = 30.0
+RETRIES = 2
+RETRY_DELAY = 0.5
+
+# Idle connections to keep per scheme/host/port
+MAX_IDLE_CONNECTIONS = 4
+
+
+class TransportError(Exception):
+  """The request failed, after any retries.  status is the HTTP status code, or None if there was no response."""
+
+  def __init__(self, message, status=None):
+    Exception.__init__(self, message)
+    self.status = status
+
+
+class HttpTransport(object):
+  """Pool of persistent HTTP connections, shared between threads"""
+
+  def __init__(self):
+    # Idle connections, by (scheme, host, port)
+    self.idle = {}
+    self.lock = threading.Lock()
+
+    # Authorization headers, by (username, password)
+    self.auth_headers = {}
+
+    # Counts, for seeing how well connections are reused
+    self.connections_opened = 0
+    self.requests = 0
+
+
+  def GetConnection(self, scheme, host, port, timeout):
+    """Returns (connection, reused): an idle connection for this host, or a new one"""
+    self.lock.acquire()
+    try:
+      idle = self.idle.get((scheme, host, port), None)
+      if idle:
+        return (idle.pop(), True)
+
+      self.connections_opened += 1
+    finally:
+      self.lock.release()
+
+    if scheme == 'https':
+      return (httplib.HTTPSConnection(host, port, timeout=timeout), False)
+    else:
+      return (httplib.HTTPConnection(host, port, timeout=timeout), False)
+
+
+  def IsStale(self, connection):
+    """Returns boolean, True if the server has closed an idle connection.  An idle connection has nothing to read,
+    unless the server closed it (EOF), or sent something we did not ask for.
+    """
+    if not connection.sock:
+      return False
+
+    try:
+      (readable, _, _) = select.select([connection.sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
+      return True
+
+    return bool(readable)
+
+
+  def ReleaseConnection(self, scheme, host, port, connection):
+    """Return a connection to the idle pool, or close it if the pool is full"""
+    self.lock.acquire()
+    try:
+      idle = self.idle.setdefault((scheme, host, port), [])
+      if len(idle) < MAX_IDLE_CONNECTIONS:
+        idle.append(connection)
+        return
+    finally:
+      self.lock.release()
+
+    connection.close()
+
+
+  def Close(self):
+    """Close all idle connections"""
+    self.lock.acquire()
+    try:
+      for connections in self.idle.values():
+        for connection in connections:
+          connection.close()
+      self.idle = {}
+    finally:
+      self.lock.release()
+
+
+  def GetAuthHeader(self, username, password):
+    """Returns string, Basic authorization header value.  Computed once per username/password."""
+    key = (username, password)
+    if key not in self.auth_headers:
+      self.auth_headers[key] = 'Basic %s' % base64.standard_b64encode('%s:%s' % (username, password)).replace('\n', '')
+
+    return self.auth_headers[key]
+
+
+  def Request(self, websource, args=None):
+    """Returns string, the response body for a websource request.  POST if args, else GET.
+
+    Raises TransportError if the request fails after retries.
+    """
+    url = urlparse.urlsplit(websource['url'])
+    scheme = url.scheme or 'http'
+    host = url.hostname
+    port = url.port or {'https':443}.get(scheme, 80)
+    path = url.path or '/'
+    if url.query:
+      path += '?' + url.query
+
+    timeout = websource.get('timeout', None) or TIMEOUT
+    retries = websource.get('retries', None)
+    if retries == None:
+      retries = RETRIES
+    retry_delay = websource.get('retry delay', None) or RETRY_DELAY
+
+    headers = {'Accept-Encoding':'gzip'}
+
+    # If Authorization
+    if websource.get('username', None):
+      headers['Authorization'] = self.GetAuthHeader(websource['username'], websource['password'])
+
+    # If args (POST)
+    body = None
+    if args:
+      method = 'POST'
+      body = urllib.urlencode(args)
+      headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+      if websource.get('compress', False):
+        body = Compress(body)
+        headers['Content-Encoding'] = 'gzip'
+
+    else:
+      method = 'GET'
+
+    attempt = 0
+    while True:
+      (connection, reused) = self.GetConnection(scheme, host, port, timeout)
+
+      #NOTE(g): The server may have closed an idle pooled connection.  Nothing was sent on it, so go again without it.
+      if reused and self.IsStale(connection):
+        connection.close()
+        continue
+
+      attempt += 1
+
+      # Pooled connections may have been opened with a different timeout (long-poll requests wait longer)
+      connection.timeout = timeout
+      if connection.sock:
+        connection.sock.settimeout(timeout)
+
+      try:
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+        data = response.read()
+        self.requests += 1
+
+        # Keep the connection, unless the server is closing it
+        if response.will_close:
+          connection.close()
+        else:
+          self.ReleaseConnection(scheme, host, port, connection)
+
+        if response.getheader('Content-Encoding', '') == 'gzip':
+          data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+        # Success
+        if 200 <= response.status < 300:
+          return data
+
+        error = TransportError('HTTP %s %s: %s' % (response.status, response.reason, websource['url']), response.status)
+
+        # Client errors will not get better by retrying
+        if response.status < 500:
+          raise error
+
+      except (socket.error, httplib.HTTPException), e:
+        #NOTE(g): The request may have reached the server, so this counts as an attempt, even on a pooled connection
+        connection.close()
+        error = TransportError('%s: %s' % (websource['url'], e))
+
+      if attempt > retries:
+        raise error
+
+      delay = retry_delay * (2 ** (attempt - 1))
+      log('Transport retry %s of %s in %s seconds: %s' % (attempt, retries, delay, error))
+      time.sleep(delay)
+
+
+def Compress(data):
+  """Returns string, gzip compressed data"""
+  buffer = StringIO.StringIO()
+  gzip_file = gzip.GzipFile(fileobj=buffer, mode='wb')
+  gzip_file.write(data)
+  gzip_file.close()
+  return buffer.getvalue()
+
+
+# Shared transport for all websource requests in this process
+TRANSPORT = HttpTransport()
@@ -0,0 +1,232 @@
+"""
+Validate: Validate job input data against the job spec "input" block
+
+The input block is compiled once into a Validator: types resolved, regexes compiled, unset (null) limits dropped.
+A Validator checks a single input value, a whole input record, or a file of many records in one pass, reporting the
+errors of each record instead of stopping at the first.  Input keys that default to host facts ("fact: <name>") are
+filled in before a record is validated, as they are when the job runs.
+
+Record files, by suffix:
+  .json     A list of records, or a single record
+  .yaml     A list of records, or a single record
+  .jsonl    One JSON record per line, read as a stream
+"""
+
+
+import re
+import json
+import decimal
+
+import specs
+import plan
+import facts
+
+
+# Input types: name: function(value) to coerce the value to the type
+INPUT_TYPES = {
+  'text':str,
+  'int':int,
+  'integer':int,
+  'decimal':decimal.Decimal,
+}
+
+# Types whose limits are lengths (min length, max length), others are limits on the value (min, max)
+TEXT_TYPES = ('text',)
+
+
+class ValidationError(Exception):
+  """An input value is not valid for the job spec"""
+
+
+class InputValidator(object):
+  """A compiled validator for one input key"""
+  __slots__ = ('key', 'type', 'coerce', 'min', 'max', 'min_length', 'max_length', 'regex', 'spec_error')
+
+  def __init__(self, key, input_validation):
+    self.key = key
+    self.type = input_validation.get('type', None)
+    self.coerce = INPUT_TYPES.get(self.type, None)
+
+    # Limits set to null (None) in the spec are not checked
+    self.min = input_validation.get('min', None)
+    self.max = input_validation.get('max', None)
+    self.min_length = input_validation.get('min length', None)
+    self.max_length = input_validation.get('max length', None)
+
+    # A bad input spec only fails when that key is validated
+    self.spec_error = None
+
+    self.regex = None
+    if input_validation.get('regex validate', None) != None:
+      try:
+        self.regex = re.compile(input_validation['regex validate'])
+      except re.error, e:
+        self.spec_error = 'Invalid regex validate: %s: %s' % (input_validation['regex validate'], e)
+
+    if self.type == None:
+      self.spec_error = 'No type was specified for validation'
+    elif self.coerce == None:
+      self.spec_error = 'Unknown input validation type: %s' % self.type
+
+
+  def Validate(self, value):
+    """Returns the value, coerced to the input type.  Raises ValidationError if it is not valid."""
+    if self.spec_error:
+      raise ValidationError('Invalid input validation spec: Input "%s": %s' % (self.key, self.spec_error))
+
+    try:
+      validated_value = self.coerce(value)
+    except Exception, e:
+      raise ValidationError('Value is not of type %s (input_key="%s"): %s' % (self.type, self.key, value))
+
+    # Text: length limits
+    if self.type in TEXT_TYPES:
+      if self.min_length != None and len(validated_value) < self.min_length:
+        raise ValidationError('Value is less than minimum length (input_key="%s"): %s (min length = %s)' % (self.key, len(validated_value), self.min_length))
+
+      if self.max_length != None and len(validated_value) > self.max_length:
+        raise ValidationError('Value is more than maximum length (input_key="%s"): %s (max length = %s)' % (self.key, len(validated_value), self.max_length))
+
+    # Numeric: value limits
+    else:
+      if self.min != None and validated_value < self.min:
+        raise ValidationError('Value is less than minimum (input_key="%s"): %s < %s (min)' % (self.key, validated_value, self.min))
+
+      if self.max != None and validated_value > self.max:
+        raise ValidationError('Value is more than maximum (input_key="%s"): %s > %s (max)' % (self.key, validated_value, self.max))
+
+    # Regex match, against the value as text
+    if self.regex and not self.regex.search(str(validated_value)):
+      raise ValidationError('Regex match not found (input_key="%s"): %s (regex = "%s")' % (self.key, validated_value, self.regex.pattern))
+
+    return validated_value
+
+
+class Validator(object):
+  """A compiled validator for a job spec's input block"""
+  __slots__ = ('job_spec', 'job_spec_path', 'inputs')
+
+  def __init__(self, job_spec, job_spec_path=None):
+    self.job_spec = job_spec
+    self.job_spec_path = job_spec_path
+
+    # key: InputValidator
+    self.inputs = {}
+    for (key, input_validation) in (job_spec.get('input', None) or {}).items():
+      self.inputs[key] = InputValidator(key, input_validation or {})
+
+
+  def Validate(self, key, value):
+    """Returns the value for this input key, coerced to its type.  Raises ValidationError if it is not valid."""
+    if key not in self.inputs:
+      raise ValidationError('Unknown input key (input_key="%s")' % key)
+
+    return self.inputs[key].Validate(value)
+
+
+  def ValidateRecord(self, record):
+    """Returns tuple (validated, errors): dict of validated input, and dict of input key: error for every failure.
+
+    Every input key in the job spec is required, after defaulting missing keys from host facts.  Keys in the record
+    that are not input keys are ignored.
+    """
+    validated = {}
+    errors = {}
+
+    if isinstance(record, ValidationError):
+      errors[None] = str(record)
+      return (validated, errors)
+
+    if not isinstance(record, dict):
+      errors[None] = 'Record is not a mapping of input keys: %s' % type(record).__name__
+      return (validated, errors)
+
+    # Input keys that default to host facts
+    record = facts.ApplyInputDefaults(self.job_spec, record)
+
+    for (key, input_validator) in self.inputs.items():
+      if key not in record:
+        errors[key] = 'Missing input key (input_key="%s")' % key
+        continue
+
+      try:
+        validated[key] = input_validator.Validate(record[key])
+      except ValidationError, e:
+        errors[key] = str(e)
+
+    return (validated, errors)
+
+
+def LoadRecords(path):
+  """Yields input records from a JSON, YAML or JSONL file"""
+  # JSON lines: stream one record at a time
+  if path.endswith('.jsonl'):
+    fp = open(path)
+    try:
+      for line in fp:
+        if not line.strip():
+          continue
+
+        # A bad line is an invalid record, the rest of the file is still validated
+        try:
+          yield json.loads(line)
+        except ValueError, e:
+          yield ValidationError('Record is not valid JSON: %s' % e)
+    finally:
+      fp.close()
+    return
+
+  elif path.endswith('.json'):
+    fp = open(path)
+    try:
+      records = json.load(fp)
+    finally:
+      fp.close()
+
+  elif path.endswith('.yaml'):
+    records = specs.ParseYaml(path)
+
+  else:
+    raise ValidationError('Unknown input records file type (acceptable: .json, .yaml, .jsonl): %s' % path)
+
+  # A single record, or a list of them
+  if isinstance(records, dict):
+    records = [records]
+
+  for record in records or []:
+    yield record
+
+
+def ValidateRecords(validator, records):
+  """Returns dict, a report of validating every record: counts, and the errors of each invalid record.
+
+  Args:
+    validator: Validator, for the job's input
+    records: iterable of dicts, input records
+  """
+  report = {'records':0, 'valid':0, 'invalid':0, 'errors':[]}
+
+  for (index, record) in enumerate(records):
+    (validated, errors) = validator.ValidateRecord(record)
+
+    report['records'] += 1
+    if errors:
+      report['invalid'] += 1
+      report['errors'].append({'record':index, 'errors':errors})
+    else:
+      report['valid'] += 1
+
+  report['success'] = report['invalid'] == 0
+
+  return report
+
+
+def ValidateFile(job_spec_path, records_path):
+  """Returns dict, a report of validating every input record in records_path against the job spec.  See ValidateRecords()."""
+  validator = plan.GetPlan(job_spec_path).validator
+
+  report = ValidateRecords(validator, LoadRecords(records_path))
+  report['job_spec_path'] = job_spec_path
+  report['records_path'] = records_path
+
+  return report
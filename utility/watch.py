@@ -0,0 +1,156 @@
+"""
+Watch: Evaluate "during" tests against run item output as it streams in
+
+Tests with "when: during" on the stdout or stderr key, and a regex function, are evaluated on each chunk of output:
+  regex: succeeds as soon as the pattern matches.  Fails if it never matched when the process finishes.
+  not regex: fails as soon as the pattern matches.  If the test is critical, the run item is aborted right away: its
+    process group is sent SIGTERM, then SIGKILL if it is still running after KILL_GRACE seconds.
+
+Patterns are compiled once.  Matches across chunk boundaries are found by searching the end of the previous output
+(DURING_OVERLAP bytes) along with each new chunk, so a match may not be longer than that.
+"""
+
+
+import os
+import re
+import signal
+import threading
+
+from log import log
+
+
+# Bytes of previous output searched with each new chunk, so matches spanning chunks are found
+DURING_OVERLAP = 4096
+
+# Seconds an aborted run item has to exit after SIGTERM, before it is sent SIGKILL
+KILL_GRACE = 5.0
+
+# Keys and functions we can evaluate while output streams
+STREAM_KEYS = ('stdout', 'stderr')
+REGEX_FUNCTIONS = ('regex',)
+NOT_REGEX_FUNCTIONS = ('not regex', '!regex')
+
+
+def IsStreamTest(test_case):
+  """Returns boolean, True if this test case is evaluated on output as it streams in"""
+  return (test_case.get('when', None) == 'during' and test_case.get('key', None) in STREAM_KEYS and
+          test_case.get('function', None) in REGEX_FUNCTIONS + NOT_REGEX_FUNCTIONS)
+
+
+def IsStreamTestSuccess(test_case, match):
+  """Returns boolean, success of a stream test given its first match (None if it never matched)"""
+  if test_case['function'] in NOT_REGEX_FUNCTIONS:
+    return match == None
+  else:
+    return match != None
+
+
+def GetWatches(tests):
+  """Returns list of (test index, test case, compiled pattern), for the stream tests in a run item's tests"""
+  watches = []
+  for (index, test_case) in enumerate(tests or []):
+    if IsStreamTest(test_case):
+      watches.append((index, test_case, re.compile(str(test_case['value']))))
+
+  return watches
+
+
+class OutputWatcher(object):
+  """Watch a run item's output for its stream tests.  Kills the process if a critical test fails."""
+
+  def __init__(self, watches):
+    # (test index, test case, compiled pattern), from GetWatches() or a compiled plan
+    self.watches = watches
+
+    # End of the previous output for each stream, and the first match of each test: index: matched text
+    self.carry = {}
+    self.matches = {}
+
+    self.process = None
+    self.aborted = None
+    self.kill_timer = None
+    self.lock = threading.Lock()
+
+
+  def HasWatches(self):
+    """Returns boolean, True if there are any stream tests to watch for"""
+    return len(self.watches) > 0
+
+
+  def SetProcess(self, process):
+    """The process is running.  We kill its process group if a critical test fails."""
+    self.lock.acquire()
+    try:
+      self.process = process
+
+      # Failed before we knew the process
+      if self.aborted:
+        self.Kill()
+    finally:
+      self.lock.release()
+
+
+  def Output(self, name, data):
+    """Capture listener: evaluate stream tests against a new chunk of output"""
+    self.lock.acquire()
+    try:
+      text = self.carry.get(name, '') + data
+
+      for (index, test_case, pattern) in self.watches:
+        # Only the first match matters
+        if test_case['key'] != name or index in self.matches:
+          continue
+
+        match = pattern.search(text)
+        if not match:
+          continue
+
+        self.matches[index] = match.group(0)
+
+        # Critical failure, stop the run item now instead of waiting for it to finish
+        if not IsStreamTestSuccess(test_case, match.group(0)) and test_case.get('critical', False) and not self.aborted:
+          self.aborted = 'Critical during test failed on %s: %s' % (name, test_case['value'])
+          log('Aborting run item: %s: %s' % (self.aborted, match.group(0)))
+          self.Kill()
+
+      self.carry[name] = text[-DURING_OVERLAP:]
+    finally:
+      self.lock.release()
+
+
+  def Kill(self):
+    """Kill the process group: SIGTERM now, and SIGKILL if it is still running after KILL_GRACE.  Must hold the lock."""
+    if not self.process or self.kill_timer:
+      return
+
+    try:
+      os.killpg(self.process.pid, signal.SIGTERM)
+    except OSError, e:
+      log('Failed to kill aborted run item process: %s: %s' % (self.process.pid, e))
+      return
+
+    self.kill_timer = threading.Timer(KILL_GRACE, self._KillAfterGrace)
+    self.kill_timer.daemon = True
+    self.kill_timer.start()
+
+
+  def _KillAfterGrace(self):
+    """Kill timer: SIGKILL the process group, if the process ignored SIGTERM"""
+    #NOTE(g): Only while the process has not been waited for, after that its pid may belong to another process
+    if self.process.poll() != None:
+      return
+
+    log('Aborted run item process did not exit after %s seconds, killing: %s' % (KILL_GRACE, self.process.pid))
+    try:
+      os.killpg(self.process.pid, signal.SIGKILL)
+    except OSError, e:
+      log('Failed to kill aborted run item process: %s: %s' % (self.process.pid, e))
+
+
+  def GetMatches(self):
+    """Returns dict, test index: first matched text, for stream tests that matched"""
+    self.lock.acquire()
+    try:
+      return dict(self.matches)
+    finally:
+      self.lock.release()